@@ -3,10 +3,14 @@ import os
 from flask import Flask, session
 from config import Config
 from models import db, User, Company
+from models.migrations import ensure_indexes, ensure_daily_rollup
 from utils.helpers import check_system_date, initialize_default_data, get_selected_company
 from services import SchedulerService
 from routes import register_blueprints
 from health_check import health_check
+from commands import register_commands
+from mikrotik_connection_manager import start_cleanup_thread
+from services.usage_buffer import usage_buffer
 
 def create_app():
     """Factory function para criar a aplicação Flask"""
@@ -22,6 +26,9 @@ def create_app():
     # Registrar health check
     app.add_url_rule('/health', 'health_check', health_check)
     
+    # Registrar comandos de manutenção
+    register_commands(app)
+    
     # Context processor para injetar variáveis em todos os templates
     @app.context_processor
     def inject_global_data():
@@ -51,6 +58,8 @@ def create_tables(app):
     """Cria as tabelas no banco de dados se elas não existirem"""
     with app.app_context():
         db.create_all()
+        ensure_indexes()
+        ensure_daily_rollup()
 
 def main():
     """Função principal da aplicação"""
@@ -84,6 +93,12 @@ def main():
     scheduler = SchedulerService(app)
     scheduler.start_scheduler()
     
+    # Iniciar limpeza do pool de conexões MikroTik
+    start_cleanup_thread()
+    
+    # Iniciar gravação em lote dos registros de uso
+    usage_buffer.start(app)
+    
     return app
 
 if __name__ == '__main__':
@@ -0,0 +1,162 @@
+"""
+Benchmark dos índices compostos de usage/credit
+
+Gera uma tabela usage sintética num banco SQLite separado e mede as
+consultas mais usadas pelas rotas sem os índices e depois com eles.
+
+Uso:
+    python benchmark_usage_indexes.py --rows 10000000
+
+Resultado de referência (10 milhões de registros, 40 empresas, 2000
+usuários por empresa, 90 dias, média de 5 execuções, SQLite, 1 vCPU):
+
+    consulta                         sem índices   com índices     ganho
+    get_top_users                        857.6ms        16.4ms     52.3x
+    get_user_daily_consumption           924.6ms         0.9ms   1004.2x
+    reports.index                       1225.4ms       471.7ms      2.6x
+
+A criação dos índices levou 60s. Em reports.index o tempo restante é a
+carga de ~19 mil objetos Usage pelo ORM, não a busca.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import time
+from datetime import timedelta
+
+from flask import Flask
+from models import db, Usage
+from models.migrations import ensure_indexes
+from config import get_current_datetime
+
+USAGE_INDEXES = [index.name for index in Usage.__table__.indexes]
+
+def create_benchmark_app(db_path):
+    """Aplicação mínima apontando para o banco do benchmark"""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.abspath(db_path)}'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    return app
+
+def populate(db_path, rows, companies, users_per_company, days):
+    """Insere registros de uso aleatórios distribuídos nos últimos `days` dias"""
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA journal_mode=OFF')
+    conn.execute('PRAGMA synchronous=OFF')
+
+    now = get_current_datetime().replace(tzinfo=None)
+    span = days * 86400
+    batch = []
+
+    for i in range(rows):
+        company_id = random.randint(1, companies)
+        timestamp = now - timedelta(seconds=random.randint(0, span))
+        batch.append((
+            f'user{random.randint(1, users_per_company)}',
+            company_id,
+            random.randint(0, 5 * 1024 * 1024),
+            random.randint(0, 1024 * 1024),
+            300,
+            timestamp.strftime('%Y-%m-%d %H:%M:%S.%f'),
+            f'*{i % 4096:X}'
+        ))
+
+        if len(batch) >= 100000:
+            conn.executemany(
+                'INSERT INTO usage (username, company_id, bytes_in, bytes_out, session_time, timestamp, session_id) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', batch
+            )
+            conn.commit()
+            batch = []
+
+    if batch:
+        conn.executemany(
+            'INSERT INTO usage (username, company_id, bytes_in, bytes_out, session_time, timestamp, session_id) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)', batch
+        )
+        conn.commit()
+    conn.close()
+
+def reports_index_query(company_id, today):
+    """Mesma consulta da página principal de relatórios (período 'week')"""
+    from services.usage_service import UsageService
+
+    start_date = UsageService.period_start('week', today)
+    return Usage.query.filter(*UsageService.period_filter(company_id, start_date, today)).all()
+
+def run_queries(repeat, companies, users_per_company):
+    """Executa as consultas medidas e retorna o tempo médio de cada uma"""
+    from services.usage_service import UsageService
+
+    today = get_current_datetime().date()
+    queries = {
+        'get_top_users': lambda c, u: UsageService.get_top_users(c, limit=10, days=1),
+        'get_user_daily_consumption': lambda c, u: UsageService.get_user_daily_consumption(u, c, today),
+        'reports.index': lambda c, u: reports_index_query(c, today),
+    }
+
+    results = {}
+    for name, query in queries.items():
+        elapsed = 0.0
+        for _ in range(repeat):
+            company_id = random.randint(1, companies)
+            username = f'user{random.randint(1, users_per_company)}'
+            started = time.perf_counter()
+            query(company_id, username)
+            elapsed += time.perf_counter() - started
+            db.session.expunge_all()
+        results[name] = elapsed / repeat
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000000)
+    parser.add_argument('--companies', type=int, default=40)
+    parser.add_argument('--users', type=int, default=2000, help='usuários por empresa')
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--db', default='instance/benchmark_usage.db')
+    parser.add_argument('--keep', action='store_true', help='reaproveitar um banco já populado')
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(args.db) or '.', exist_ok=True)
+    if os.path.exists(args.db) and not args.keep:
+        os.remove(args.db)
+
+    app = create_benchmark_app(args.db)
+    with app.app_context():
+        db.create_all()
+
+        if not args.keep:
+            # Popular sem índices é bem mais rápido
+            for name in USAGE_INDEXES:
+                db.session.execute(db.text(f'DROP INDEX IF EXISTS {name}'))
+            db.session.commit()
+
+            print(f'Gerando {args.rows} registros de uso...')
+            started = time.perf_counter()
+            populate(args.db, args.rows, args.companies, args.users, args.days)
+            print(f'  {time.perf_counter() - started:.1f}s')
+
+        for name in USAGE_INDEXES:
+            db.session.execute(db.text(f'DROP INDEX IF EXISTS {name}'))
+        db.session.commit()
+        db.session.execute(db.text('ANALYZE'))
+        before = run_queries(args.repeat, args.companies, args.users)
+
+        print('Criando índices...')
+        started = time.perf_counter()
+        ensure_indexes()
+        db.session.execute(db.text('ANALYZE'))
+        print(f'  {time.perf_counter() - started:.1f}s')
+        after = run_queries(args.repeat, args.companies, args.users)
+
+    print(f'\n{"consulta":<30}{"sem índices":>14}{"com índices":>14}{"ganho":>10}')
+    for name in before:
+        speedup = before[name] / after[name] if after[name] else float('inf')
+        print(f'{name:<30}{before[name] * 1000:>12.1f}ms{after[name] * 1000:>12.1f}ms{speedup:>9.1f}x')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+"""
+Comandos de manutenção executados via `flask <comando>`
+"""
+import click
+from datetime import datetime
+
+def _parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date() if value else None
+
+def register_commands(app):
+    """Registra os comandos de linha de comando da aplicação"""
+    
+    @app.cli.command('backfill-daily-consumption')
+    @click.option('--start', help='Data inicial (AAAA-MM-DD); padrão: todo o histórico')
+    @click.option('--end', help='Data final (AAAA-MM-DD)')
+    @click.option('--company-id', type=int, help='Recalcular apenas uma empresa')
+    def backfill_daily_consumption(start, end, company_id):
+        """Recalcula a tabela daily_consumption a partir de usage"""
+        from services import UsageService
+        
+        rows = UsageService.rebuild_daily_rollup(_parse_date(start), _parse_date(end), company_id)
+        click.echo(f'{rows} linhas de consumo diário geradas')
@@ -1,5 +1,6 @@
 import os
 from datetime import timedelta
+from logger import get_current_datetime
 
 class Config:
     """Configuração da aplicação"""
@@ -31,6 +32,13 @@ class Config:
     MIKROTIK_PASSWORD = os.environ.get('MIKROTIK_PASSWORD', '')
     MIKROTIK_PORT = int(os.environ.get('MIKROTIK_PORT', 8728))
     MIKROTIK_USE_SSL = os.environ.get('MIKROTIK_USE_SSL', 'False').lower() == 'true'
+    MIKROTIK_USER_ID_CACHE_TTL = int(os.environ.get('MIKROTIK_USER_ID_CACHE_TTL', 600))  # segundos
+    MIKROTIK_SNAPSHOT_TTL = int(os.environ.get('MIKROTIK_SNAPSHOT_TTL', 30))  # segundos
+    # Grava a cota restante em limit-bytes-total/limit-uptime para o roteador aplicá-la sozinho
+    MIKROTIK_PUSH_LIMITS = os.environ.get('MIKROTIK_PUSH_LIMITS', 'True').lower() == 'true'
+    MIKROTIK_PUSH_LIMITS_INTERVAL = int(os.environ.get('MIKROTIK_PUSH_LIMITS_INTERVAL', 300))  # segundos por empresa
+    MIKROTIK_LIMIT_TOLERANCE_MB = float(os.environ.get('MIKROTIK_LIMIT_TOLERANCE_MB', 1))
+    MIKROTIK_LIMIT_TOLERANCE_TIME = int(os.environ.get('MIKROTIK_LIMIT_TOLERANCE_TIME', 60))  # segundos
     
     # Configurações de logging
     LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
@@ -41,7 +49,37 @@ class Config:
     # Configurações do agendador
     SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', 'True').lower() == 'true'
     SCHEDULER_TIMEZONE = os.environ.get('SCHEDULER_TIMEZONE', 'America/Sao_Paulo')
-    
+
+    # Configurações da coleta de uso
+    USAGE_COLLECTION_MAX_WORKERS = int(os.environ.get('USAGE_COLLECTION_MAX_WORKERS', 16))
+    USAGE_COLLECTION_ROUTER_TIMEOUT = int(os.environ.get('USAGE_COLLECTION_ROUTER_TIMEOUT', 20))  # segundos por roteador
+    USAGE_COLLECTION_CYCLE_TIMEOUT = int(os.environ.get('USAGE_COLLECTION_CYCLE_TIMEOUT', 240))  # segundos por ciclo
+    USAGE_COLLECTION_BATCH_SIZE = int(os.environ.get('USAGE_COLLECTION_BATCH_SIZE', 500))
+    # Consulta todos os roteadores num único event loop, com conexões mantidas entre ciclos
+    USAGE_COLLECTION_ASYNC = os.environ.get('USAGE_COLLECTION_ASYNC', 'False').lower() == 'true'
+    # Recebe /ip/hotspot/active por follow/listen; roteadores sem suporte continuam no polling
+    USAGE_STREAM_ENABLED = os.environ.get('USAGE_STREAM_ENABLED', 'False').lower() == 'true'
+    USAGE_STREAM_FLUSH_INTERVAL = int(os.environ.get('USAGE_STREAM_FLUSH_INTERVAL', 5))  # segundos
+    # Sem eventos por este tempo, o stream testa a conexão; sem resposta, a empresa volta ao polling
+    USAGE_STREAM_IDLE_TIMEOUT = int(os.environ.get('USAGE_STREAM_IDLE_TIMEOUT', 60))  # segundos
+    # Idade máxima da situação de cota guardada pela coleta (2x o ciclo de 5 minutos)
+    QUOTA_STATUS_MAX_AGE = int(os.environ.get('QUOTA_STATUS_MAX_AGE', 600))  # segundos
+
+    # Configurações da limpeza de registros de uso
+    USAGE_CLEANUP_BATCH_SIZE = int(os.environ.get('USAGE_CLEANUP_BATCH_SIZE', 5000))
+    USAGE_CLEANUP_BATCH_PAUSE = float(os.environ.get('USAGE_CLEANUP_BATCH_PAUSE', 0.05))  # segundos entre lotes
+    USAGE_ARCHIVE_ENABLED = os.environ.get('USAGE_ARCHIVE_ENABLED', 'False').lower() == 'true'
+    USAGE_ARCHIVE_DIRECTORY = os.environ.get('USAGE_ARCHIVE_DIRECTORY', 'archive')
+
+    # Buffer de escrita de UsageService.record_usage
+    USAGE_BUFFER_BATCH_SIZE = int(os.environ.get('USAGE_BUFFER_BATCH_SIZE', 1000))
+    USAGE_BUFFER_FLUSH_INTERVAL = float(os.environ.get('USAGE_BUFFER_FLUSH_INTERVAL', 2))  # segundos
+    USAGE_BUFFER_MAX_SIZE = int(os.environ.get('USAGE_BUFFER_MAX_SIZE', 50000))
+    USAGE_BUFFER_PUT_TIMEOUT = float(os.environ.get('USAGE_BUFFER_PUT_TIMEOUT', 5))  # segundos
+
+    # Cache de empresas e turmas: intervalo máximo para notar alterações feitas por outros processos
+    REFERENCE_CACHE_CHECK_INTERVAL = float(os.environ.get('REFERENCE_CACHE_CHECK_INTERVAL', 5))  # segundos
+
     # Configurações de backup
     BACKUP_ENABLED = os.environ.get('BACKUP_ENABLED', 'True').lower() == 'true'
     BACKUP_DIRECTORY = os.environ.get('BACKUP_DIRECTORY', 'backups')
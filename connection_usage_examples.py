@@ -1,39 +1,59 @@
-# EXEMPLOS DE USO DO NOVO GERENCIADOR DE CONEXÕES
-
-# 1. Usando context manager (RECOMENDADO)
-def exemplo_context_manager(company):
-    try:
-        with MikroTikConnection(company) as api:
-            hotspot_users = api.get_resource('/ip/hotspot/user')
-            users = hotspot_users.get()
-            return users
-    except Exception as e:
-        print(f"Erro: {e}")
-        return []
-
-# 2. Usando funções diretas (para compatibilidade)
-def exemplo_funcoes_diretas(company):
-    connection, api = get_mikrotik_connection(company)
-    if not api:
-        return []
-    
-    try:
-        hotspot_users = api.get_resource('/ip/hotspot/user')
-        users = hotspot_users.get()
-        return users
-    finally:
-        return_mikrotik_connection(company.id, connection, api)
-
-# 3. A função connect_to_mikrotik existente continua funcionando
-def exemplo_compatibilidade(company):
-    connection, api = connect_to_mikrotik(company)
-    if not api:
-        return []
-    
-    try:
-        hotspot_users = api.get_resource('/ip/hotspot/user')
-        users = hotspot_users.get()
-        return users
-    finally:
-        # IMPORTANTE: Agora você deve retornar a conexão ao pool
+# EXEMPLOS DE USO DO GERENCIADOR DE CONEXÕES
+from mikrotik_connection_manager import (
+    MikroTikConnection,
+    get_mikrotik_connection,
+    return_mikrotik_connection
+)
+from services.mikrotik_service import MikroTikService
+
+# 1. Usando context manager (RECOMENDADO)
+def exemplo_context_manager(company):
+    try:
+        with MikroTikConnection(company) as api:
+            hotspot_users = api.get_resource('/ip/hotspot/user')
+            users = hotspot_users.get()
+            return users
+    except Exception as e:
+        print(f"Erro: {e}")
+        return []
+
+# 2. Usando funções diretas (para compatibilidade)
+def exemplo_funcoes_diretas(company):
+    connection, api = get_mikrotik_connection(
+        company.id,
+        company.mikrotik_ip,
+        company.mikrotik_username,
+        company.mikrotik_password,
+        company.mikrotik_port
+    )
+    if not api:
+        return []
+    
+    try:
+        hotspot_users = api.get_resource('/ip/hotspot/user')
+        users = hotspot_users.get()
+        return users
+    finally:
         return_mikrotik_connection(company.id, connection, api)
+
+# 3. A função connect_to_mikrotik existente continua funcionando
+def exemplo_compatibilidade(company):
+    connection, api = MikroTikService.connect_to_mikrotik(company)
+    if not api:
+        return []
+    
+    try:
+        hotspot_users = api.get_resource('/ip/hotspot/user')
+        users = hotspot_users.get()
+        return users
+    finally:
+        # IMPORTANTE: a conexão deve ser retornada ao pool
+        MikroTikService.disconnect_mikrotik(company.id, connection, api)
+
+# 4. Várias operações na mesma conexão (um único login no roteador)
+def exemplo_operacoes_em_lote(company, usernames):
+    with MikroTikService.session(company) as api:
+        hotspot_users = api.get_resource('/ip/hotspot/user')
+        for username in usernames:
+            for user in hotspot_users.get(name=username):
+                hotspot_users.set(id=user['id'], disabled='true')
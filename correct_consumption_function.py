@@ -1,53 +1,45 @@
-# ADICIONE ESTA FUN��O AO SEU APP.PY
-
-def get_correct_consumption(username, company_id, date=None):
-    """
-    Obt�m o consumo correto de um usu�rio em uma data espec�fica
-    Usa a view correct_daily_consumption para dados precisos
-    
-    Args:
-        username (str): Nome do usu�rio
-        company_id (int): ID da empresa
-        date (date, optional): Data espec�fica. Se None, usa a data atual.
-        
-    Returns:
-        tuple: (bytes_in, bytes_out, total_bytes, total_mb)
-    """
-    from datetime import datetime
-    
-    if date is None:
-        date = get_current_datetime().date()
-    
-    if isinstance(date, datetime):
-        date = date.date()
-    
-    date_str = date.strftime('%Y-%m-%d')
-    
-    # Usar SQL direto para acessar a view
-    result = db.session.execute(
-        """
-        SELECT 
-            total_bytes_in, 
-            total_bytes_out, 
-            total_bytes,
-            total_mb
-        FROM correct_daily_consumption
-        WHERE username = :username 
-          AND company_id = :company_id
-          AND date = :date
-        """,
-        {
-            'username': username,
-            'company_id': company_id,
-            'date': date_str
-        }
-    ).fetchone()
-    
-    if result:
-        return result[0], result[1], result[2], result[3]
-    else:
-        return 0, 0, 0, 0
-
-# EXEMPLO DE USO:
-# bytes_in, bytes_out, total_bytes, total_mb = get_correct_consumption('username', company.id)
+# ADICIONE ESTA FUNÇÃO AO SEU APP.PY
+
+def get_correct_consumption(username, company_id, date=None):
+    """
+    Obtém o consumo correto de um usuário em uma data específica
+    Usa a tabela daily_consumption, mantida a cada registro de uso
+    (recalcule com `flask backfill-daily-consumption`)
+    
+    Args:
+        username (str): Nome do usuário
+        company_id (int): ID da empresa
+        date (date, optional): Data específica. Se None, usa a data atual.
+        
+    Returns:
+        tuple: (bytes_in, bytes_out, total_bytes, total_mb)
+    """
+    from datetime import datetime
+    from models import DailyConsumption
+    from config import get_current_datetime
+    
+    if date is None:
+        date = get_current_datetime().date()
+    
+    if isinstance(date, datetime):
+        date = date.date()
+    
+    consumption = DailyConsumption.query.filter_by(
+        username=username,
+        company_id=company_id,
+        date=date
+    ).first()
+    
+    if consumption:
+        return (
+            consumption.bytes_in,
+            consumption.bytes_out,
+            consumption.total_bytes,
+            consumption.total_mb
+        )
+    else:
+        return 0, 0, 0, 0
+
+# EXEMPLO DE USO:
+# bytes_in, bytes_out, total_bytes, total_mb = get_correct_consumption('username', company.id)
 # print(f"Consumo: {total_mb:.2f} MB")
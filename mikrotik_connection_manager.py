@@ -1,110 +1,328 @@
 import threading
 import time
-from collections import defaultdict
+from collections import deque
 import routeros_api
+from routeros_api.exceptions import RouterOsApiCommunicationError
 from logger import get_logger
 
 logger = get_logger('connection_manager')
 
+class MikroTikConnectionError(Exception):
+    """Não foi possível obter uma conexão do pool"""
+    pass
+
+# Marca devolvida por _reserve quando há vaga para abrir uma nova conexão
+CREATE_SLOT = object()
+
+class CompanyPool:
+    """Conexões de uma empresa, protegidas por um lock próprio
+    
+    A condição serializa apenas a empresa; `waiters` é a fila FIFO de
+    threads aguardando uma conexão livre, para que a espera seja justa.
+    """
+    
+    def __init__(self):
+        self.connections = []
+        self.condition = threading.Condition()
+        self.pending = 0  # conexões sendo criadas fora do lock
+        self.waiters = deque()
+        self.stats = {
+            'reused': 0,
+            'created': 0,
+            'health_checks': 0,
+            'health_check_failures': 0,
+            'keepalives': 0,
+            'keepalive_failures': 0,
+            'waits': 0,
+            'wait_timeouts': 0
+        }
+    
+    def find(self, connection):
+        for conn_info in self.connections:
+            if conn_info['connection'] == connection:
+                return conn_info
+        return None
+
 class MikroTikConnectionManager:
     def __init__(self):
-        self.connections = defaultdict(list)  # company_id -> [connections]
+        self.pools = {}  # company_id -> CompanyPool
         self.max_connections_per_company = 5
         self.connection_timeout = 300  # 5 minutos
-        self.lock = threading.Lock()
+        self.socket_timeout = 15  # segundos
+        self.checkout_timeout = 10  # espera máxima por uma conexão livre
+        self.health_check_idle_threshold = 30  # testar na retirada só se ociosa há mais que isso
+        self.keepalive_interval = 120  # segundos entre keepalives de conexões ociosas
+        self.cleanup_interval = 60  # segundos entre limpezas
+        self.lock = threading.Lock()  # protege apenas o dicionário de pools
         self.cleanup_thread = None
         self.running = False
     
-    def get_connection(self, company_id, host, username, password, port=8728):
-        """Obtém uma conexão do pool ou cria uma nova"""
+    def _get_pool(self, company_id):
+        """Obtém (ou cria) o pool de uma empresa"""
         with self.lock:
-            # Verificar se há conexões disponíveis
-            available_connections = self.connections[company_id]
+            pool = self.pools.get(company_id)
+            if pool is None:
+                pool = self.pools[company_id] = CompanyPool()
+            return pool
+    
+    def _snapshot_pools(self):
+        with self.lock:
+            return list(self.pools.items())
+    
+    def get_connection(self, company_id, host, username, password, port=8728,
+                       socket_timeout=None, wait_timeout=None):
+        """Obtém uma conexão do pool ou cria uma nova
+        
+        Quando o limite da empresa foi atingido, aguarda em fila até
+        `wait_timeout` segundos por uma conexão devolvida. Testes de saúde
+        e a criação de conexões acontecem fora de qualquer lock.
+        """
+        credentials = (host, username, password, port)
+        socket_timeout = socket_timeout or self.socket_timeout
+        if wait_timeout is None:
+            wait_timeout = self.checkout_timeout
+        deadline = time.monotonic() + wait_timeout
+        pool = self._get_pool(company_id)
+        
+        while True:
+            conn_info = self._reserve(pool, company_id, credentials, deadline)
+            if conn_info is None:
+                return None, None
             
-            for conn_info in available_connections:
-                if not conn_info['in_use'] and self._test_connection(conn_info['connection']):
-                    conn_info['in_use'] = True
-                    conn_info['last_used'] = time.time()
-                    logger.debug(f"Reutilizando conexão para empresa {company_id}")
-                    return conn_info['connection'], conn_info['api']
+            # Reserva de criação: abrir a conexão sem segurar lock algum
+            if conn_info is CREATE_SLOT:
+                return self._create_connection(pool, company_id, credentials, socket_timeout)
+            
+            # Só testa conexões ociosas há mais tempo que o limite
+            if time.time() - self._last_activity(conn_info) > self.health_check_idle_threshold:
+                if not self._check_health(pool, company_id, conn_info):
+                    self._remove(pool, conn_info)
+                    continue
             
-            # Criar nova conexão se não há disponíveis
-            if len(available_connections) < self.max_connections_per_company:
+            conn_info['last_used'] = time.time()
+            conn_info['connection'].set_timeout(socket_timeout)
+            logger.debug(f"Reutilizando conexão para empresa {company_id}")
+            return conn_info['connection'], conn_info['api']
+    
+    def _reserve(self, pool, company_id, credentials, deadline):
+        """Reserva uma conexão livre ou uma vaga para criar uma nova
+        
+        Retorna o conn_info reservado, CREATE_SLOT ou None se o prazo acabar.
+        """
+        ticket = object()
+        stale = []  # fechadas só depois de liberar o lock
+        
+        try:
+            with pool.condition:
+                pool.waiters.append(ticket)
+                waited = False
+                
                 try:
-                    connection = routeros_api.RouterOsApiPool(
-                        host, username=username, password=password, port=port
-                    )
-                    api = connection.get_api()
-                    
-                    conn_info = {
-                        'connection': connection,
-                        'api': api,
-                        'in_use': True,
-                        'created_at': time.time(),
-                        'last_used': time.time()
-                    }
-                    
-                    self.connections[company_id].append(conn_info)
-                    logger.info(f"Nova conexão criada para empresa {company_id}")
-                    return connection, api
-                    
-                except Exception as e:
-                    logger.error(f"Erro ao criar conexão para empresa {company_id}: {e}")
-                    return None, None
+                    while True:
+                        # Apenas o primeiro da fila pode retirar (ordem de chegada)
+                        if pool.waiters[0] is ticket:
+                            # Descartar conexões abertas com credenciais antigas
+                            stale.extend(self._discard_stale(pool, credentials))
+                            
+                            for conn_info in pool.connections:
+                                if not conn_info['in_use']:
+                                    conn_info['in_use'] = True
+                                    pool.stats['reused'] += 1
+                                    return conn_info
+                            
+                            if len(pool.connections) + pool.pending < self.max_connections_per_company:
+                                pool.pending += 1
+                                return CREATE_SLOT
+                        
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            pool.stats['wait_timeouts'] += 1
+                            logger.warning(f"Limite de conexões atingido para empresa {company_id}")
+                            return None
+                        
+                        if not waited:
+                            pool.stats['waits'] += 1
+                            waited = True
+                        pool.condition.wait(remaining)
+                finally:
+                    pool.waiters.remove(ticket)
+                    pool.condition.notify_all()
+        finally:
+            for conn_info in stale:
+                self._close(conn_info)
+    
+    def _create_connection(self, pool, company_id, credentials, socket_timeout):
+        """Abre uma nova conexão na vaga reservada por _reserve"""
+        host, username, password, port = credentials
+        conn_info = None
+        
+        try:
+            connection = routeros_api.RouterOsApiPool(
+                host, username=username, password=password, port=port
+            )
+            connection.set_timeout(socket_timeout)
+            api = connection.get_api()
             
-            logger.warning(f"Limite de conexões atingido para empresa {company_id}")
-            return None, None
+            conn_info = {
+                'connection': connection,
+                'api': api,
+                'credentials': credentials,
+                'in_use': True,
+                'created_at': time.time(),
+                'last_used': time.time()
+            }
+            logger.info(f"Nova conexão criada para empresa {company_id}")
+        except Exception as e:
+            logger.error(f"Erro ao criar conexão para empresa {company_id}: {e}")
+        
+        with pool.condition:
+            pool.pending -= 1
+            if conn_info:
+                pool.connections.append(conn_info)
+                pool.stats['created'] += 1
+            pool.condition.notify_all()
+        
+        if conn_info:
+            return conn_info['connection'], conn_info['api']
+        return None, None
     
     def return_connection(self, company_id, connection, api):
         """Retorna uma conexão ao pool"""
-        with self.lock:
-            for conn_info in self.connections[company_id]:
-                if conn_info['connection'] == connection:
-                    conn_info['in_use'] = False
-                    conn_info['last_used'] = time.time()
-                    logger.debug(f"Conexão retornada ao pool da empresa {company_id}")
-                    return
-    
-    def _test_connection(self, connection):
+        pool = self._get_pool(company_id)
+        with pool.condition:
+            conn_info = pool.find(connection)
+            if conn_info:
+                conn_info['in_use'] = False
+                conn_info['last_used'] = time.time()
+                pool.condition.notify_all()
+                logger.debug(f"Conexão retornada ao pool da empresa {company_id}")
+    
+    def discard_connection(self, company_id, connection):
+        """Fecha e remove do pool uma conexão com falha"""
+        pool = self._get_pool(company_id)
+        with pool.condition:
+            conn_info = pool.find(connection)
+        if conn_info:
+            self._remove(pool, conn_info)
+            logger.debug(f"Conexão descartada do pool da empresa {company_id}")
+    
+    def close_company_connections(self, company_id):
+        """Fecha todas as conexões livres de uma empresa"""
+        pool = self._get_pool(company_id)
+        with pool.condition:
+            idle = [c for c in pool.connections if not c['in_use']]
+            for conn_info in idle:
+                pool.connections.remove(conn_info)
+            pool.condition.notify_all()
+        
+        for conn_info in idle:
+            self._close(conn_info)
+    
+    def _remove(self, pool, conn_info):
+        """Remove uma conexão do pool e a fecha fora do lock"""
+        with pool.condition:
+            if conn_info in pool.connections:
+                pool.connections.remove(conn_info)
+            pool.condition.notify_all()
+        self._close(conn_info)
+    
+    def _discard_stale(self, pool, credentials):
+        """Retira do pool as conexões livres criadas com outro host/usuário/senha
+        
+        Chamado com pool.condition adquirido; retorna as conexões retiradas para
+        que o chamador as feche depois de liberar o lock.
+        """
+        stale = [
+            conn_info for conn_info in pool.connections
+            if conn_info['credentials'] != credentials and not conn_info['in_use']
+        ]
+        for conn_info in stale:
+            pool.connections.remove(conn_info)
+        return stale
+    
+    def _close(self, conn_info):
+        """Desconecta sem propagar erros"""
+        try:
+            conn_info['connection'].disconnect()
+        except Exception:
+            pass
+    
+    def _test_connection(self, conn_info):
         """Testa se uma conexão ainda está válida"""
         try:
-            # Teste simples - tentar obter informações do sistema
-            api = connection.get_api()
-            system_resource = api.get_resource('/system/resource')
-            system_resource.get()
+            # /system/identity tem a menor resposta possível (apenas o nome)
+            conn_info['api'].get_resource('/system/identity').get()
             return True
-        except:
+        except Exception:
             return False
     
+    def _last_activity(self, conn_info):
+        """Último uso ou teste bem-sucedido da conexão"""
+        return max(conn_info['last_used'], conn_info.get('last_checked', 0))
+    
+    def _check_health(self, pool, company_id, conn_info):
+        """Testa uma conexão ociosa na retirada e contabiliza o resultado"""
+        healthy = self._test_connection(conn_info)
+        with pool.condition:
+            pool.stats['health_checks'] += 1
+            if not healthy:
+                pool.stats['health_check_failures'] += 1
+        if not healthy:
+            logger.debug(f"Conexão ociosa inválida descartada da empresa {company_id}")
+        return healthy
+    
     def cleanup_connections(self):
-        """Remove conexões antigas ou inválidas"""
-        with self.lock:
-            current_time = time.time()
+        """Remove conexões ociosas há mais tempo que connection_timeout"""
+        current_time = time.time()
+        
+        for company_id, pool in self._snapshot_pools():
+            with pool.condition:
+                expired = [
+                    c for c in pool.connections
+                    if not c['in_use'] and current_time - c['last_used'] > self.connection_timeout
+                ]
+                for conn_info in expired:
+                    pool.connections.remove(conn_info)
+                if expired:
+                    pool.condition.notify_all()
             
-            for company_id in list(self.connections.keys()):
-                connections_to_remove = []
-                
-                for i, conn_info in enumerate(self.connections[company_id]):
-                    # Remover conexões antigas ou inválidas
-                    if (not conn_info['in_use'] and 
-                        (current_time - conn_info['last_used'] > self.connection_timeout or
-                         not self._test_connection(conn_info['connection']))):
-                        
-                        try:
-                            conn_info['connection'].disconnect()
-                        except:
-                            pass
-                        
-                        connections_to_remove.append(i)
+            for conn_info in expired:
+                self._close(conn_info)
+                logger.debug(f"Conexão removida do pool da empresa {company_id}")
+    
+    def keepalive_connections(self):
+        """Envia keepalive às conexões ociosas para mantê-las abertas
+        
+        As conexões são reservadas sob o lock da empresa e testadas fora
+        dele, para que um roteador lento não bloqueie a retirada de conexões.
+        """
+        current_time = time.time()
+        
+        for company_id, pool in self._snapshot_pools():
+            with pool.condition:
+                pending = [
+                    c for c in pool.connections
+                    if not c['in_use'] and current_time - self._last_activity(c) > self.keepalive_interval
+                ]
+                for conn_info in pending:
+                    conn_info['in_use'] = True
+            
+            for conn_info in pending:
+                healthy = self._test_connection(conn_info)
                 
-                # Remover conexões marcadas
-                for i in reversed(connections_to_remove):
-                    del self.connections[company_id][i]
-                    logger.debug(f"Conexão removida do pool da empresa {company_id}")
+                with pool.condition:
+                    pool.stats['keepalives'] += 1
+                    if healthy:
+                        # last_used não muda: o keepalive não adia a expiração
+                        conn_info['in_use'] = False
+                        conn_info['last_checked'] = time.time()
+                        pool.condition.notify_all()
+                    else:
+                        pool.stats['keepalive_failures'] += 1
                 
-                # Remover empresa se não há mais conexões
-                if not self.connections[company_id]:
-                    del self.connections[company_id]
+                if not healthy:
+                    self._remove(pool, conn_info)
+                    logger.debug(f"Keepalive falhou, conexão removida da empresa {company_id}")
     
     def start_cleanup_thread(self):
         """Inicia thread de limpeza"""
@@ -124,30 +342,84 @@ class MikroTikConnectionManager:
         logger.info("Thread de limpeza de conexões parada")
     
     def _cleanup_loop(self):
-        """Loop de limpeza executado em thread separada"""
+        """Loop de limpeza e keepalive executado em thread separada"""
+        next_cleanup = time.time() + self.cleanup_interval
+        next_keepalive = time.time() + self.keepalive_interval
+        
         while self.running:
             try:
-                self.cleanup_connections()
-                time.sleep(60)  # Limpeza a cada minuto
+                current_time = time.time()
+                if current_time >= next_cleanup:
+                    self.cleanup_connections()
+                    next_cleanup = current_time + self.cleanup_interval
+                if current_time >= next_keepalive:
+                    self.keepalive_connections()
+                    next_keepalive = current_time + self.keepalive_interval
             except Exception as e:
                 logger.error(f"Erro na limpeza de conexões: {e}")
-                time.sleep(60)
+            
+            time.sleep(1)
     
     def get_stats(self):
         """Retorna estatísticas das conexões"""
-        with self.lock:
-            stats = {}
-            for company_id, connections in self.connections.items():
+        stats = {}
+        for company_id, pool in self._snapshot_pools():
+            with pool.condition:
+                connections = pool.connections
                 stats[company_id] = {
                     'total': len(connections),
                     'in_use': sum(1 for c in connections if c['in_use']),
-                    'available': sum(1 for c in connections if not c['in_use'])
+                    'available': sum(1 for c in connections if not c['in_use']),
+                    'pending': pool.pending,
+                    'waiting': len(pool.waiters)
                 }
-            return stats
+                stats[company_id].update(pool.stats)
+        return stats
 
 # Instância global do gerenciador
 connection_manager = MikroTikConnectionManager()
 
+class MikroTikConnection:
+    """Context manager que empresta uma conexão do pool da empresa
+    
+    Uso:
+        with MikroTikConnection(company) as api:
+            api.get_resource('/ip/hotspot/user').get()
+    
+    A conexão volta ao pool ao sair do bloco; se o bloco falhar por erro de
+    conexão (e não por um erro de comando do RouterOS), ela é descartada.
+    """
+    
+    def __init__(self, company, timeout=None, manager=None):
+        self.company = company
+        self.timeout = timeout
+        self.manager = manager or connection_manager
+        self.connection = None
+        self.api = None
+    
+    def __enter__(self):
+        company = self.company
+        self.connection, self.api = self.manager.get_connection(
+            company.id,
+            company.mikrotik_ip,
+            company.mikrotik_username,
+            company.mikrotik_password,
+            company.mikrotik_port or 8728,
+            socket_timeout=self.timeout
+        )
+        if not self.api:
+            raise MikroTikConnectionError(
+                f"Não foi possível conectar ao MikroTik da empresa {company.name}"
+            )
+        return self.api
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None or issubclass(exc_type, RouterOsApiCommunicationError):
+            self.manager.return_connection(self.company.id, self.connection, self.api)
+        else:
+            self.manager.discard_connection(self.company.id, self.connection)
+        return False
+
 def get_mikrotik_connection(company_id, host, username, password, port=8728):
     """Função helper para obter conexão"""
     return connection_manager.get_connection(company_id, host, username, password, port)
@@ -5,13 +5,15 @@ db = SQLAlchemy()
 # Import all models to make them available
 from .user import User, user_company_association
 from .company import Company, HotspotClass
-from .usage import Usage, OriginalProfile
+from .usage import Usage, OriginalProfile, SessionCheckpoint, DailyConsumption
 from .credit import Credit
+from .cache import CacheVersion
 
 __all__ = [
     'db',
     'User', 'user_company_association',
     'Company', 'HotspotClass', 
-    'Usage', 'OriginalProfile',
-    'Credit'
+    'Usage', 'OriginalProfile', 'SessionCheckpoint', 'DailyConsumption',
+    'Credit',
+    'CacheVersion'
 ]
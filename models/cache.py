@@ -0,0 +1,17 @@
+from . import db
+from datetime import datetime
+
+class CacheVersion(db.Model):
+    """Contador de versão de um cache local, compartilhado entre processos
+
+    Quem altera os dados incrementa a versão; cada processo compara com a
+    versão que carregou e recarrega o cache quando ela muda.
+    """
+    __tablename__ = 'cache_version'
+    
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<CacheVersion {self.name}={self.version}>'
@@ -1,8 +1,20 @@
 from models import db
 from datetime import datetime, date
 
+# Chave de um crédito diário (alvo do ON CONFLICT). NULLs são distintos num
+# índice único, então class_id entra como coalesce(class_id, 0) para que
+# créditos sem classe também não se repitam.
+CREDIT_DAY_KEY = ('username', 'company_id', db.text('coalesce(class_id, 0)'), 'date')
+
 class Credit(db.Model):
     __tablename__ = 'credit'
+    __table_args__ = (
+        # Um crédito por usuário/classe/dia: torna o reset diário idempotente
+        # e atende a busca de get_or_create_credit
+        db.Index('uq_credit_day_class', *CREDIT_DAY_KEY, unique=True),
+        # Créditos de uma empresa por dia (reset diário, relatórios)
+        db.Index('ix_credit_company_date', 'company_id', 'date'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), nullable=False)
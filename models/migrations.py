@@ -0,0 +1,114 @@
+from . import db
+from logger import get_logger
+
+logger = get_logger('migrations')
+
+# Índices substituídos por outros e que devem ser removidos de bancos antigos
+OBSOLETE_INDEXES = {
+    'credit': ['ix_credit_lookup', 'uq_credit_day'],
+}
+
+# Colunas somadas na linha mantida ao remover duplicatas (consumo já registrado)
+MERGED_COLUMNS = {
+    'credit': ['used_mb', 'used_time'],
+}
+
+def ensure_indexes():
+    """Cria os índices declarados nos modelos que ainda não existem no banco
+
+    db.create_all() não altera tabelas já existentes, então bancos SQLite
+    antigos não recebem índices novos sem esta etapa.
+    """
+    created = []
+    inspector = db.inspect(db.engine)
+
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing = index_names(inspector, table.name)
+        for index in table.indexes:
+            if index.name not in existing:
+                if index.unique:
+                    deduplicate(table, list(index.expressions))
+                index.create(bind=db.engine)
+                created.append(index.name)
+
+        for name in OBSOLETE_INDEXES.get(table.name, []):
+            if name in existing:
+                with db.engine.begin() as connection:
+                    connection.execute(db.text(f'DROP INDEX {name}'))
+                logger.info(f"Índice obsoleto removido: {name}")
+
+    if created:
+        logger.info(f"Índices criados: {', '.join(created)}")
+    return created
+
+def index_names(inspector, table_name):
+    """Nomes dos índices existentes de uma tabela
+
+    O SQLAlchemy não reflete índices de expressão no SQLite (como
+    uq_credit_day_class), então nesse caso os nomes vêm de sqlite_master.
+    """
+    if db.engine.dialect.name == 'sqlite':
+        with db.engine.connect() as connection:
+            return set(connection.execute(
+                db.text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table"),
+                {'table': table_name}
+            ).scalars())
+    return {index['name'] for index in inspector.get_indexes(table_name)}
+
+def deduplicate(table, columns):
+    """Remove linhas repetidas nas colunas informadas, mantendo a mais recente (maior id)
+
+    Necessário antes de criar um índice único numa tabela que já tem dados.
+    `columns` aceita nomes de colunas ou as expressões do índice. Valores
+    NULL são agrupados juntos, como no GROUP BY. As colunas de
+    MERGED_COLUMNS são somadas na linha mantida antes da remoção, para que o
+    consumo registrado nas duplicatas não se perca.
+    """
+    group = [table.c[column] if isinstance(column, str) else column for column in columns]
+    merged = [table.c[name] for name in MERGED_COLUMNS.get(table.name, [])]
+    keep = db.select(db.func.max(table.c.id)).group_by(*group)
+
+    with db.engine.begin() as connection:
+        if merged:
+            duplicates = connection.execute(
+                db.select(
+                    db.func.max(table.c.id).label('keep_id'),
+                    *[db.func.coalesce(db.func.sum(column), 0).label(column.name) for column in merged]
+                ).group_by(*group).having(db.func.count() > 1)
+            ).mappings().all()
+
+            if duplicates:
+                connection.execute(
+                    db.update(table)
+                    .where(table.c.id == db.bindparam('keep_id'))
+                    .values({column.name: db.bindparam(column.name) for column in merged}),
+                    [dict(row) for row in duplicates]
+                )
+
+        result = connection.execute(db.delete(table).where(table.c.id.not_in(keep)))
+
+    if result.rowcount:
+        logger.warning(f"Removidas {result.rowcount} linhas duplicadas de {table.name} "
+                       f"({', '.join(str(column) for column in group)})")
+    return result.rowcount
+
+def ensure_daily_rollup():
+    """Preenche daily_consumption a partir de usage quando a tabela ainda está vazia
+
+    Bancos anteriores à tabela de consumo diário têm histórico apenas em
+    usage; sem esta etapa os gráficos mostrariam zero até um backfill manual.
+    """
+    from .usage import Usage, DailyConsumption
+
+    if db.session.query(DailyConsumption.id).first() is not None:
+        return 0
+    if db.session.query(Usage.id).first() is None:
+        return 0
+
+    from services.usage_service import UsageService
+
+    logger.info("Tabela daily_consumption vazia: recalculando a partir de usage")
+    return UsageService.rebuild_daily_rollup()
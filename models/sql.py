@@ -0,0 +1,8 @@
+from sqlalchemy.dialects import postgresql, sqlite
+from . import db
+
+def upsert_insert(model):
+    """INSERT do dialeto em uso, com suporte a ON CONFLICT (SQLite/PostgreSQL)"""
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return postgresql.insert(model)
+    return sqlite.insert(model)
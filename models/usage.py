@@ -1,8 +1,16 @@
 from models import db
-from datetime import datetime
+from datetime import datetime, date
 
 class Usage(db.Model):
     __tablename__ = 'usage'
+    __table_args__ = (
+        # Consultas por usuário num intervalo de tempo (consumo diário, relatórios)
+        db.Index('ix_usage_company_username_timestamp', 'company_id', 'username', 'timestamp'),
+        # Consultas da empresa num intervalo (dashboard, top usuários, relatórios)
+        db.Index('ix_usage_company_timestamp', 'company_id', 'timestamp'),
+        # Limpeza de registros antigos
+        db.Index('ix_usage_timestamp', 'timestamp'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), nullable=False)
@@ -28,6 +36,10 @@ class Usage(db.Model):
 
 class OriginalProfile(db.Model):
     __tablename__ = 'original_profile'
+    __table_args__ = (
+        # Um perfil por usuário da empresa (sincronização em lote)
+        db.Index('uq_original_profile_company_username', 'company_id', 'username', unique=True),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), nullable=False)
@@ -41,3 +53,56 @@ class OriginalProfile(db.Model):
     
     def __repr__(self):
         return f'<OriginalProfile {self.username}>'
+
+class SessionCheckpoint(db.Model):
+    """Últimos contadores vistos de cada sessão ativa no MikroTik
+    
+    Permite que o coletor grave apenas a diferença desde a última coleta
+    (inclusive após reiniciar a aplicação).
+    """
+    __tablename__ = 'session_checkpoint'
+    __table_args__ = (
+        db.UniqueConstraint('company_id', 'session_id', name='uq_session_checkpoint'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    company_id = db.Column(db.Integer, db.ForeignKey('company.id'), nullable=False)
+    session_id = db.Column(db.String(100), nullable=False)  # .id da sessão em /ip/hotspot/active
+    username = db.Column(db.String(80), nullable=False)
+    bytes_in = db.Column(db.BigInteger, default=0)
+    bytes_out = db.Column(db.BigInteger, default=0)
+    uptime = db.Column(db.Integer, default=0)  # Segundos
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<SessionCheckpoint {self.username} - {self.session_id}>'
+
+class DailyConsumption(db.Model):
+    """Consumo agregado por usuário e dia, mantido a cada inserção em usage"""
+    __tablename__ = 'daily_consumption'
+    __table_args__ = (
+        db.UniqueConstraint('company_id', 'username', 'date', name='uq_daily_consumption'),
+        db.Index('ix_daily_consumption_company_date', 'company_id', 'date'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    company_id = db.Column(db.Integer, db.ForeignKey('company.id'), nullable=False)
+    username = db.Column(db.String(80), nullable=False)
+    date = db.Column(db.Date, nullable=False, default=date.today)
+    bytes_in = db.Column(db.BigInteger, default=0)
+    bytes_out = db.Column(db.BigInteger, default=0)
+    session_time = db.Column(db.Integer, default=0)  # Segundos
+    records = db.Column(db.Integer, default=0)  # Registros de usage somados
+    
+    def __repr__(self):
+        return f'<DailyConsumption {self.username} - {self.date}>'
+    
+    @property
+    def total_bytes(self):
+        """Total de bytes transferidos no dia"""
+        return self.bytes_in + self.bytes_out
+    
+    @property
+    def total_mb(self):
+        """Total em MB"""
+        return self.total_bytes / (1024 * 1024)
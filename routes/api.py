@@ -1,8 +1,8 @@
 from flask import Blueprint, jsonify, request, session
-from models import db, User, Company, Usage, Credit, HotspotClass
+from models import User, Company, Usage, Credit, HotspotClass
 from utils.decorators import login_required, admin_required, api_key_required
 from utils.helpers import get_selected_company, format_bytes, format_time
-from services import UsageService, CreditService, MikroTikService
+from services import UsageService, CreditService, MikroTikService, LimitService
 from datetime import datetime, timedelta
 from config import get_current_datetime
 
@@ -94,30 +94,15 @@ def api_company_usage(company_id):
     end_date = get_current_datetime().date()
     start_date = end_date - timedelta(days=days)
     
-    usage_data = []
-    current_date = start_date
-    
-    while current_date <= end_date:
-        daily_usage = db.session.query(
-            db.func.sum(Usage.bytes_in + Usage.bytes_out)
-        ).filter(
-            Usage.company_id == company_id,
-            db.func.date(Usage.timestamp) == current_date
-        ).scalar() or 0
-        
-        unique_users = db.session.query(Usage.username).filter(
-            Usage.company_id == company_id,
-            db.func.date(Usage.timestamp) == current_date
-        ).distinct().count()
-        
-        usage_data.append({
-            'date': current_date.isoformat(),
-            'total_bytes': daily_usage,
-            'total_mb': round(daily_usage / (1024 * 1024), 2),
-            'unique_users': unique_users
-        })
-        
-        current_date += timedelta(days=1)
+    usage_data = [
+        {
+            'date': day['date'].isoformat(),
+            'total_bytes': day['total_bytes'],
+            'total_mb': day['total_mb'],
+            'unique_users': day['unique_users']
+        }
+        for day in UsageService.daily_series(company_id, start_date, end_date)
+    ]
     
     return jsonify(usage_data)
 
@@ -160,38 +145,17 @@ def users_near_limit():
     if not selected_company:
         return jsonify({'error': 'Nenhuma empresa selecionada'}), 400
     
-    # Obter usuários com uso nas últimas 24 horas
-    yesterday = datetime.now() - timedelta(days=1)
-    recent_usage = Usage.query.filter(
-        Usage.company_id == selected_company.id,
-        Usage.timestamp >= yesterday
-    ).all()
-    
-    users_near_limit = []
-    
-    for usage in recent_usage:
-        # Verificar limites considerando créditos
-        limit_check = CreditService.check_credit_limits(
-            usage.username,
-            selected_company.id,
-            (usage.bytes_in + usage.bytes_out) / (1024 * 1024),  # MB
-            usage.session_time
-        )
-        
-        # Se está próximo do limite (80% ou mais)
-        data_usage_percent = (limit_check['current_data_mb'] / limit_check['effective_data_limit']) * 100
-        time_usage_percent = (limit_check['current_time_seconds'] / limit_check['effective_time_limit']) * 100
-        
-        if data_usage_percent >= 80 or time_usage_percent >= 80:
-            users_near_limit.append({
-                'username': usage.username,
-                'data_usage_percent': round(data_usage_percent, 2),
-                'time_usage_percent': round(time_usage_percent, 2),
-                'data_exceeded': limit_check['data_exceeded'],
-                'time_exceeded': limit_check['time_exceeded']
-            })
-    
-    return jsonify(users_near_limit)
+    threshold = request.args.get('threshold', 80, type=float)
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = min(500, max(1, request.args.get('per_page', 50, type=int)))
+    
+    # Situação calculada a cada coleta: custo independe do volume de usage
+    return jsonify(LimitService.get_near_limit(
+        selected_company.id,
+        threshold=threshold,
+        page=page,
+        per_page=per_page
+    ))
 
 @api_bp.route('/users/<username>/usage')
 @login_required
@@ -347,6 +311,7 @@ def api_system_health():
     """Status de saúde do sistema via API"""
     from services.scheduler_service import scheduler_service
     from mikrotik_connection_manager import get_connection_stats
+    from services.usage_buffer import usage_buffer
     
     # Status do agendador
     scheduler_status = scheduler_service.get_status()
@@ -366,6 +331,7 @@ def api_system_health():
         },
         'scheduler': scheduler_status,
         'connections': connection_stats,
+        'usage_buffer': usage_buffer.get_stats(),
         'database': {
             'total_users': total_users,
             'total_companies': total_companies,
@@ -4,6 +4,7 @@ from forms import CompanyForm, HotspotClassForm
 from utils.decorators import login_required, admin_required
 from utils.helpers import log_user_action, validate_ip_address
 from services import MikroTikService
+from services.reference_cache import reference_cache
 from sqlalchemy import or_
 
 companies_bp = Blueprint('companies', __name__)
@@ -56,6 +57,7 @@ def create():
         
         db.session.add(company)
         db.session.commit()
+        reference_cache.invalidate()
         
         log_user_action(session['user_id'], 'create_company', f'Created company: {company.name}')
         
@@ -88,6 +90,7 @@ def edit(company_id):
         company.is_active = form.is_active.data
         
         db.session.commit()
+        reference_cache.invalidate()
         
         log_user_action(session['user_id'], 'edit_company', f'Edited company: {company.name}')
         
@@ -111,6 +114,7 @@ def delete(company_id):
     company_name = company.name
     db.session.delete(company)
     db.session.commit()
+    reference_cache.invalidate()
     
     log_user_action(session['user_id'], 'delete_company', f'Deleted company: {company_name}')
     
@@ -170,6 +174,7 @@ def create_class(company_id):
         
         db.session.add(hotspot_class)
         db.session.commit()
+        reference_cache.invalidate()
         
         log_user_action(session['user_id'], 'create_class', 
                       f'Created class: {hotspot_class.name} for company: {company.name}')
@@ -206,6 +211,7 @@ def edit_class(company_id, class_id):
         hotspot_class.is_active = form.is_active.data
         
         db.session.commit()
+        reference_cache.invalidate()
         
         log_user_action(session['user_id'], 'edit_class', 
                       f'Edited class: {hotspot_class.name} for company: {company.name}')
@@ -230,6 +236,7 @@ def delete_class(company_id, class_id):
     class_name = hotspot_class.name
     db.session.delete(hotspot_class)
     db.session.commit()
+    reference_cache.invalidate()
     
     log_user_action(session['user_id'], 'delete_class', 
                   f'Deleted class: {class_name} from company: {company.name}')
@@ -254,6 +261,7 @@ def activate_class(company_id, class_id):
     # Ativar esta turma
     hotspot_class.is_active = True
     db.session.commit()
+    reference_cache.invalidate()
     
     log_user_action(session['user_id'], 'activate_class', 
                   f'Activated class: {hotspot_class.name} for company: {company.name}')
@@ -36,24 +36,21 @@ def admin_dashboard():
     
     # Total de usuários ativos hoje
     active_users = db.session.query(Usage.username).filter(
-        Usage.company_id == selected_company.id,
-        db.func.date(Usage.timestamp) == today
+        *UsageService.period_filter(selected_company.id, today)
     ).distinct().count()
     
     # Consumo total hoje
     today_usage = db.session.query(
         db.func.sum(Usage.bytes_in + Usage.bytes_out)
     ).filter(
-        Usage.company_id == selected_company.id,
-        db.func.date(Usage.timestamp) == today
+        *UsageService.period_filter(selected_company.id, today)
     ).scalar() or 0
     
     # Tempo total de sessão hoje
     total_session_time = db.session.query(
         db.func.sum(Usage.session_time)
     ).filter(
-        Usage.company_id == selected_company.id,
-        db.func.date(Usage.timestamp) == today
+        *UsageService.period_filter(selected_company.id, today)
     ).scalar() or 0
     
     # Top 5 usuários por consumo
@@ -61,27 +58,16 @@ def admin_dashboard():
         Usage.username,
         db.func.sum(Usage.bytes_in + Usage.bytes_out).label('total_bytes')
     ).filter(
-        Usage.company_id == selected_company.id,
-        db.func.date(Usage.timestamp) == today
+        *UsageService.period_filter(selected_company.id, today)
     ).group_by(Usage.username).order_by(
         db.func.sum(Usage.bytes_in + Usage.bytes_out).desc()
     ).limit(5).all()
     
     # Dados para gráfico dos últimos 7 dias
-    chart_data = []
-    for i in range(6, -1, -1):
-        date = today - timedelta(days=i)
-        daily_usage = db.session.query(
-            db.func.sum(Usage.bytes_in + Usage.bytes_out)
-        ).filter(
-            Usage.company_id == selected_company.id,
-            db.func.date(Usage.timestamp) == date
-        ).scalar() or 0
-        
-        chart_data.append({
-            'date': date.strftime('%d/%m'),
-            'usage_mb': round(daily_usage / (1024 * 1024), 2)
-        })
+    chart_data = [
+        {'date': day['date'].strftime('%d/%m'), 'usage_mb': day['total_mb']}
+        for day in UsageService.daily_series(selected_company.id, today - timedelta(days=6), today)
+    ]
     
     stats = {
         'active_users': active_users,
@@ -126,36 +112,23 @@ def user_dashboard():
     today_usage = db.session.query(
         db.func.sum(Usage.bytes_in + Usage.bytes_out)
     ).filter(
-        Usage.username == user.username,
-        Usage.company_id == company.id,
-        db.func.date(Usage.timestamp) == today
+        *UsageService.period_filter(company.id, today, username=user.username)
     ).scalar() or 0
     
     # Tempo de sessão hoje
     session_time = db.session.query(
         db.func.sum(Usage.session_time)
     ).filter(
-        Usage.username == user.username,
-        Usage.company_id == company.id,
-        db.func.date(Usage.timestamp) == today
+        *UsageService.period_filter(company.id, today, username=user.username)
     ).scalar() or 0
     
     # Histórico dos últimos 7 dias
-    chart_data = []
-    for i in range(6, -1, -1):
-        date = today - timedelta(days=i)
-        daily_usage = db.session.query(
-            db.func.sum(Usage.bytes_in + Usage.bytes_out)
-        ).filter(
-            Usage.username == user.username,
-            Usage.company_id == company.id,
-            db.func.date(Usage.timestamp) == date
-        ).scalar() or 0
-        
-        chart_data.append({
-            'date': date.strftime('%d/%m'),
-            'usage_mb': round(daily_usage / (1024 * 1024), 2)
-        })
+    chart_data = [
+        {'date': day['date'].strftime('%d/%m'), 'usage_mb': day['total_mb']}
+        for day in UsageService.daily_series(
+            company.id, today - timedelta(days=6), today, username=user.username
+        )
+    ]
     
     # Calcular porcentagens
     usage_percentage = 0
@@ -194,22 +167,13 @@ def chart_data():
             return jsonify({'error': 'Nenhuma empresa selecionada'})
         
         # Dados para admin (todos os usuários da empresa)
-        data = []
         today = get_current_datetime().date()
-        
-        for i in range(days-1, -1, -1):
-            date = today - timedelta(days=i)
-            daily_usage = db.session.query(
-                db.func.sum(Usage.bytes_in + Usage.bytes_out)
-            ).filter(
-                Usage.company_id == selected_company.id,
-                db.func.date(Usage.timestamp) == date
-            ).scalar() or 0
-            
-            data.append({
-                'date': date.strftime('%d/%m'),
-                'usage_mb': round(daily_usage / (1024 * 1024), 2)
-            })
+        data = [
+            {'date': day['date'].strftime('%d/%m'), 'usage_mb': day['total_mb']}
+            for day in UsageService.daily_series(
+                selected_company.id, today - timedelta(days=days-1), today
+            )
+        ]
         
         return jsonify(data)
     
@@ -219,23 +183,13 @@ def chart_data():
         if not company:
             return jsonify({'error': 'Usuário não associado a empresa'})
         
-        data = []
         today = get_current_datetime().date()
-        
-        for i in range(days-1, -1, -1):
-            date = today - timedelta(days=i)
-            daily_usage = db.session.query(
-                db.func.sum(Usage.bytes_in + Usage.bytes_out)
-            ).filter(
-                Usage.username == user.username,
-                Usage.company_id == company.id,
-                db.func.date(Usage.timestamp) == date
-            ).scalar() or 0
-            
-            data.append({
-                'date': date.strftime('%d/%m'),
-                'usage_mb': round(daily_usage / (1024 * 1024), 2)
-            })
+        data = [
+            {'date': day['date'].strftime('%d/%m'), 'usage_mb': day['total_mb']}
+            for day in UsageService.daily_series(
+                company.id, today - timedelta(days=days-1), today, username=user.username
+            )
+        ]
         
         return jsonify(data)
 
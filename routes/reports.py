@@ -26,28 +26,21 @@ def index():
     
     today = get_current_datetime().date()
     
-    if period == 'day':
-        start_date = today
-        title = 'Consumo Diário'
-    elif period == 'week':
-        start_date = today - timedelta(days=7)
+    if period == 'week':
         title = 'Consumo Semanal'
     elif period == 'month':
-        start_date = today.replace(day=1)
         title = 'Consumo Mensal'
     else:
-        start_date = today
         title = 'Consumo Diário'
     
+    start_date = UsageService.period_start(period, today)
+    
     # Filtrar por usuário se especificado
     query = Usage.query.filter(
-        Usage.company_id == selected_company.id,
-        Usage.timestamp >= datetime.combine(start_date, datetime.min.time()),
-        Usage.timestamp <= datetime.combine(today, datetime.max.time())
+        *UsageService.period_filter(selected_company.id, start_date, today, username=username)
     )
     
     if username:
-        query = query.filter(Usage.username == username)
         title += f' - Usuário: {username}'
     
     usage_records = query.all()
@@ -118,26 +111,10 @@ def index():
     # Dados por data para gráfico temporal
     date_data = []
     if period == 'week' or period == 'month':
-        current_date = start_date
-        while current_date <= today:
-            daily_total = 0
-            daily_records = Usage.query.filter(
-                Usage.company_id == selected_company.id,
-                db.func.date(Usage.timestamp) == current_date
-            )
-            
-            if username:
-                daily_records = daily_records.filter(Usage.username == username)
-            
-            for record in daily_records:
-                daily_total += record.bytes_in + record.bytes_out
-            
-            date_data.append({
-                'date': current_date.strftime('%d/%m/%Y'),
-                'total': round(daily_total / (1024 * 1024), 2)
-            })
-            
-            current_date += timedelta(days=1)
+        date_data = [
+            {'date': day['date'].strftime('%d/%m/%Y'), 'total': day['total_mb']}
+            for day in UsageService.daily_series(selected_company.id, start_date, today, username=username)
+        ]
     
     return render_template(
         'reports.html',
@@ -169,10 +146,7 @@ def user_report(username):
     
     # Buscar dados de uso
     usage_records = Usage.query.filter(
-        Usage.username == username,
-        Usage.company_id == selected_company.id,
-        Usage.timestamp >= datetime.combine(start_date, datetime.min.time()),
-        Usage.timestamp <= datetime.combine(end_date, datetime.max.time())
+        *UsageService.period_filter(selected_company.id, start_date, end_date, username=username)
     ).order_by(Usage.timestamp.desc()).all()
     
     # Agrupar por dia
@@ -247,9 +221,7 @@ def export_data():
     start_date = end_date - timedelta(days=days)
     
     usage_records = Usage.query.filter(
-        Usage.company_id == selected_company.id,
-        Usage.timestamp >= datetime.combine(start_date, datetime.min.time()),
-        Usage.timestamp <= datetime.combine(end_date, datetime.max.time())
+        *UsageService.period_filter(selected_company.id, start_date, end_date)
     ).all()
     
     if format_type == 'json':
@@ -279,23 +251,9 @@ def user_chart_data(username):
     end_date = get_current_datetime().date()
     start_date = end_date - timedelta(days=days)
     
-    data = []
-    current_date = start_date
-    
-    while current_date <= end_date:
-        daily_usage = db.session.query(
-            db.func.sum(Usage.bytes_in + Usage.bytes_out)
-        ).filter(
-            Usage.username == username,
-            Usage.company_id == selected_company.id,
-            db.func.date(Usage.timestamp) == current_date
-        ).scalar() or 0
-        
-        data.append({
-            'date': current_date.strftime('%d/%m'),
-            'usage_mb': round(daily_usage / (1024 * 1024), 2)
-        })
-        
-        current_date += timedelta(days=1)
+    data = [
+        {'date': day['date'].strftime('%d/%m'), 'usage_mb': day['total_mb']}
+        for day in UsageService.daily_series(selected_company.id, start_date, end_date, username=username)
+    ]
     
     return jsonify(data)
@@ -1,8 +1,8 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, session
 from models import db, User, Company, OriginalProfile
 from forms import UserEditForm, HotspotUserForm, SearchForm
 from utils.decorators import login_required, admin_required
-from utils.helpers import get_selected_company, log_user_action
+from utils.helpers import get_selected_company, log_user_action, paginate_list
 from services import UserService, MikroTikService
 from sqlalchemy import or_
 
@@ -132,24 +132,56 @@ def hotspot_users():
         flash('Selecione uma empresa primeiro.', 'warning')
         return redirect(url_for('dashboard.index'))
     
+    # Parâmetros de paginação, filtro e ordenação
+    page = request.args.get('page', 1, type=int)
+    per_page = min(200, max(1, request.args.get('per_page', 50, type=int)))
+    search = request.args.get('search', '', type=str).strip().lower()
+    profile_filter = request.args.get('profile', '', type=str)
+    status = request.args.get('status', 'all', type=str)
+    sort = request.args.get('sort', 'username', type=str)
+    order = request.args.get('order', 'asc', type=str)
+    
     # Obter usuários do MikroTik
     mikrotik_users = MikroTikService.get_hotspot_users(selected_company)
     
-    # Obter perfis originais do banco
-    original_profiles = OriginalProfile.query.filter_by(
-        company_id=selected_company.id
-    ).all()
+    # Perfis originais do banco indexados por usuário
+    original_profiles = {
+        profile.username: profile
+        for profile in OriginalProfile.query.filter_by(company_id=selected_company.id)
+    }
+    
+    def is_blocked(mt_user):
+        profile = original_profiles.get(mt_user.get('name'))
+        return bool(profile and profile.is_blocked)
+    
+    # Filtrar sobre os dados crus do roteador; só a página é montada
+    filtered = [
+        mt_user for mt_user in mikrotik_users
+        if mt_user.get('name')
+        and (not search or search in mt_user['name'].lower())
+        and (not profile_filter or mt_user.get('profile') == profile_filter)
+        and (status == 'all'
+             or (status == 'blocked' and is_blocked(mt_user))
+             or (status == 'disabled' and mt_user.get('disabled') == 'true')
+             or (status == 'active' and not is_blocked(mt_user) and mt_user.get('disabled') != 'true'))
+    ]
+    
+    sort_keys = {
+        'username': lambda u: u['name'].lower(),
+        'profile': lambda u: u.get('profile', ''),
+        'bytes': lambda u: int(u.get('bytes-in', 0)) + int(u.get('bytes-out', 0)),
+        'uptime': lambda u: MikroTikService.parse_duration(u.get('uptime')),
+        'blocked': is_blocked
+    }
+    filtered.sort(key=sort_keys.get(sort, sort_keys['username']), reverse=(order == 'desc'))
+    
+    pagination = paginate_list(filtered, page, per_page)
     
     # Combinar dados
     users_data = []
-    for mt_user in mikrotik_users:
+    for mt_user in pagination.items:
         username = mt_user.get('name')
-        
-        # Buscar perfil original
-        original_profile = next(
-            (p for p in original_profiles if p.username == username), 
-            None
-        )
+        original_profile = original_profiles.get(username)
         
         users_data.append({
             'username': username,
@@ -165,6 +197,13 @@ def hotspot_users():
     
     return render_template('users/hotspot.html', 
                          users=users_data, 
+                         pagination=pagination,
+                         profiles=sorted({u.get('profile') for u in mikrotik_users if u.get('profile')}),
+                         search=search,
+                         profile_filter=profile_filter,
+                         status=status,
+                         sort_field=sort,
+                         sort_order=order,
                          company=selected_company)
 
 @users_bp.route('/hotspot/create', methods=['GET', 'POST'])
@@ -235,6 +274,42 @@ def unblock_hotspot_user(username):
     else:
         return jsonify({'success': False, 'message': 'Erro ao desbloquear usuário'})
 
+@users_bp.route('/hotspot/bulk', methods=['POST'])
+@login_required
+@admin_required
+def bulk_hotspot_users():
+    """Bloquear, desbloquear ou alterar o perfil de vários usuários hotspot"""
+    selected_company = get_selected_company()
+    if not selected_company:
+        return jsonify({'success': False, 'message': 'Nenhuma empresa selecionada'})
+    
+    data = request.get_json() or {}
+    action = data.get('action')
+    usernames = data.get('usernames') or []
+    
+    if not usernames:
+        return jsonify({'success': False, 'message': 'Nenhum usuário informado'})
+    
+    if action == 'block':
+        reason = data.get('reason', 'Bloqueado pelo administrador')
+        results = UserService.block_hotspot_users(selected_company.id, usernames, reason)
+    elif action == 'unblock':
+        results = UserService.unblock_hotspot_users(selected_company.id, usernames)
+    elif action == 'profile' and data.get('profile'):
+        results = UserService.change_hotspot_users_profile(selected_company.id, usernames, data['profile'])
+    else:
+        return jsonify({'success': False, 'message': 'Ação inválida'})
+    
+    succeeded = sum(1 for success in results.values() if success)
+    log_user_action(session['user_id'], f'bulk_{action}_hotspot_users', 
+                  f'{succeeded}/{len(results)} users: {", ".join(usernames[:20])}')
+    
+    return jsonify({
+        'success': succeeded == len(results),
+        'message': f'{succeeded} de {len(results)} usuários alterados',
+        'results': results
+    })
+
 @users_bp.route('/hotspot/sync', methods=['POST'])
 @login_required
 @admin_required
@@ -244,12 +319,18 @@ def sync_hotspot_users():
     if not selected_company:
         return jsonify({'success': False, 'message': 'Nenhuma empresa selecionada'})
     
-    success = UserService.sync_hotspot_users(selected_company.id)
+    summary = UserService.sync_hotspot_users(selected_company.id)
     
-    if success:
+    if summary is not None:
         log_user_action(session['user_id'], 'sync_hotspot_users', 
-                      f'Synced users for company: {selected_company.name}')
-        return jsonify({'success': True, 'message': 'Usuários sincronizados com sucesso'})
+                      f'Synced users for company: {selected_company.name} '
+                      f'(+{summary["added"]} -{summary["removed"]} ~{summary["changed"]})')
+        return jsonify({
+            'success': True,
+            'message': f'Usuários sincronizados: {summary["added"]} novos, '
+                       f'{summary["removed"]} removidos, {summary["changed"]} alterados',
+            'summary': summary
+        })
     else:
         return jsonify({'success': False, 'message': 'Erro ao sincronizar usuários'})
 
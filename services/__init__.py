@@ -2,6 +2,7 @@ from .mikrotik_service import MikroTikService
 from .usage_service import UsageService
 from .credit_service import CreditService
 from .user_service import UserService
+from .limit_service import LimitService
 from .scheduler_service import SchedulerService
 
 __all__ = [
@@ -9,5 +10,6 @@ __all__ = [
     'UsageService', 
     'CreditService',
     'UserService',
+    'LimitService',
     'SchedulerService'
 ]
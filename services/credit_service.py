@@ -1,5 +1,9 @@
+import time
 from datetime import datetime, timedelta
 from models import db, HotspotClass, Credit, OriginalProfile, Company, User
+from models.credit import CREDIT_DAY_KEY
+from models.sql import upsert_insert
+from services.reference_cache import reference_cache
 from config import get_current_datetime
 from logger import get_logger
 
@@ -14,10 +18,7 @@ class CreditService:
             
             # Se não foi especificada uma classe, pega a classe ativa da empresa
             if not class_id:
-                active_class = HotspotClass.query.filter_by(
-                    company_id=company_id, 
-                    is_active=True
-                ).first()
+                active_class = reference_cache.get_active_class(company_id)
                 if not active_class:
                     logger.warning(f"Nenhuma classe ativa encontrada para empresa {company_id}")
                     return None
@@ -33,7 +34,7 @@ class CreditService:
             
             if not credit:
                 # Cria novo crédito
-                hotspot_class = HotspotClass.query.get(class_id)
+                hotspot_class = reference_cache.get_class(class_id)
                 if not hotspot_class:
                     logger.error(f"Classe {class_id} não encontrada")
                     return None
@@ -59,30 +60,87 @@ class CreditService:
             return None
     
     @staticmethod
-    def update_usage(username, company_id, bytes_used):
-        """Atualiza o uso de dados do usuário"""
+    def update_usage(username, company_id, bytes_used, session_time=0):
+        """Soma bytes (e segundos) ao uso de hoje do usuário"""
         try:
-            credit = CreditService.get_or_create_credit(username, company_id)
-            if not credit:
-                return False
-            
-            mb_used = bytes_used / (1024 * 1024)
-            credit.used_mb = mb_used
-            
-            # Calcula crédito restante
-            remaining = credit.total_available_mb - credit.used_mb
-            if remaining < 0:
-                remaining = 0
-            
+            applied = CreditService.apply_usage_deltas([(username, company_id, bytes_used, session_time)])
             db.session.commit()
-            logger.info(f"Uso atualizado para {username}: {mb_used:.2f} MB")
-            return True
+            
+            logger.info(f"Uso atualizado para {username}: +{bytes_used / (1024 * 1024):.2f} MB")
+            return applied > 0
             
         except Exception as e:
             logger.error(f"Erro ao atualizar uso: {e}")
             db.session.rollback()
             return False
     
+    @staticmethod
+    def apply_usage_deltas(deltas):
+        """Incrementa used_mb/used_time dos créditos de hoje no próprio banco (sem commit)
+        
+        `deltas` é uma lista de (username, company_id, bytes) ou
+        (username, company_id, bytes, segundos). Cada crédito recebe um
+        UPDATE used_mb = used_mb + delta via upsert, que também cria o crédito
+        do dia quando ele ainda não existe; não há leitura prévia, então
+        atualizações concorrentes não se perdem. Deve ser chamado na mesma
+        transação que grava os registros de uso. Retorna o número de créditos
+        atualizados.
+        """
+        totals = {}
+        for delta in deltas:
+            username, company_id, bytes_used = delta[:3]
+            session_time = delta[3] if len(delta) > 3 else 0
+            
+            key = (username, company_id)
+            bytes_total, time_total = totals.get(key, (0, 0))
+            totals[key] = (bytes_total + (bytes_used or 0), time_total + (session_time or 0))
+        
+        if not totals:
+            return 0
+        
+        # Classe ativa de cada empresa, como em get_or_create_credit
+        active_classes = {
+            company_id: reference_cache.get_active_class(company_id)
+            for company_id in {company_id for _, company_id in totals}
+        }
+        
+        now = get_current_datetime()
+        values = []
+        for (username, company_id), (bytes_used, session_time) in totals.items():
+            hotspot_class = active_classes.get(company_id)
+            if not hotspot_class:
+                logger.warning(f"Nenhuma classe ativa encontrada para empresa {company_id}")
+                continue
+            
+            values.append({
+                'username': username,
+                'company_id': company_id,
+                'class_id': hotspot_class.id,
+                'date': now.date(),
+                'total_available_mb': hotspot_class.daily_limit_mb or 0,
+                'used_mb': bytes_used / (1024 * 1024),
+                'accumulated_credit_mb': 0,
+                'used_time': session_time,
+                'created_at': now,
+                'updated_at': now
+            })
+        
+        if not values:
+            return 0
+        
+        stmt = upsert_insert(Credit)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(CREDIT_DAY_KEY),
+            set_={
+                'used_mb': Credit.used_mb + stmt.excluded.used_mb,
+                'used_time': db.func.coalesce(Credit.used_time, 0) + stmt.excluded.used_time,
+                'updated_at': stmt.excluded.updated_at
+            }
+        )
+        db.session.execute(stmt, values)
+        
+        return len(values)
+    
     @staticmethod
     def get_remaining_credit(username, company_id):
         """Obtém o crédito restante do usuário"""
@@ -99,43 +157,77 @@ class CreditService:
             return 0
     
     @staticmethod
-    def reset_daily_credits(company_id):
-        """Reset dos créditos diários"""
+    def reset_daily_credits(company_id=None):
+        """Reset dos créditos diários
+        
+        Grava os créditos de hoje a partir dos de ontem num único INSERT ...
+        SELECT para todas as empresas ativas (ou apenas `company_id`). O
+        INSERT é um upsert na chave do crédito diário: se o coletor já criou o
+        crédito de hoje (uso entre 00:00 e o reset), ele recebe o limite e o
+        crédito acumulado de ontem sem perder o used_mb/used_time registrado.
+        Executar o reset de novo recalcula os mesmos valores, sem duplicar
+        linhas. Retorna um resumo com o número de créditos gravados e o tempo
+        gasto, ou None em caso de erro.
+        """
+        started = time.monotonic()
+        
         try:
-            today = get_current_datetime().date()
+            now = get_current_datetime()
+            today = now.date()
             yesterday = today - timedelta(days=1)
             
-            # Busca créditos de ontem
-            yesterday_credits = Credit.query.filter_by(
-                company_id=company_id,
-                date=yesterday
-            ).all()
+            previous = db.aliased(Credit)
+            remaining_mb = previous.total_available_mb - previous.used_mb
             
-            for old_credit in yesterday_credits:
-                # Calcula crédito acumulado
-                remaining = old_credit.total_available_mb - old_credit.used_mb
-                accumulated = max(0, remaining)
-                
-                # Cria novo crédito para hoje
-                new_credit = Credit(
-                    username=old_credit.username,
-                    company_id=company_id,
-                    class_id=old_credit.class_id,
-                    date=today,
-                    total_available_mb=old_credit.total_available_mb,
-                    used_mb=0,
-                    accumulated_credit_mb=accumulated
-                )
-                db.session.add(new_credit)
+            rollover = db.select(
+                previous.username,
+                previous.company_id,
+                previous.class_id,
+                db.literal(today, db.Date),
+                previous.total_available_mb,
+                db.literal(0.0),
+                db.case((remaining_mb > 0, remaining_mb), else_=0.0),
+                db.literal(now, db.DateTime),
+                db.literal(now, db.DateTime)
+            ).join(
+                Company, Company.id == previous.company_id
+            ).where(
+                previous.date == yesterday,
+                Company.is_active.is_(True)
+            )
+            
+            if company_id:
+                rollover = rollover.where(previous.company_id == company_id)
             
+            stmt = upsert_insert(Credit).from_select(
+                ['username', 'company_id', 'class_id', 'date', 'total_available_mb',
+                 'used_mb', 'accumulated_credit_mb', 'created_at', 'updated_at'],
+                rollover
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=list(CREDIT_DAY_KEY),
+                set_={
+                    'total_available_mb': stmt.excluded.total_available_mb,
+                    'accumulated_credit_mb': stmt.excluded.accumulated_credit_mb,
+                    'updated_at': stmt.excluded.updated_at
+                }
+            )
+            result = db.session.execute(stmt)
             db.session.commit()
-            logger.info(f"Créditos resetados para empresa {company_id}")
-            return True
+            
+            summary = {
+                'credits': result.rowcount,
+                'date': today,
+                'elapsed': round(time.monotonic() - started, 3)
+            }
+            logger.info(f"Créditos resetados: {summary['credits']} gravados para {today} "
+                        f"em {summary['elapsed']}s")
+            return summary
             
         except Exception as e:
             logger.error(f"Erro ao resetar créditos: {e}")
             db.session.rollback()
-            return False
+            return None
     
     @staticmethod
     def get_credit_history(username, company_id, days=30):
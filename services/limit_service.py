@@ -0,0 +1,298 @@
+import threading
+import time
+from datetime import timedelta
+from models import db, Credit, OriginalProfile
+from services.user_service import UserService
+from services.mikrotik_service import MikroTikService
+from services.reference_cache import reference_cache
+from config import Config, get_current_datetime
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Motivo gravado em OriginalProfile; só bloqueios com este motivo são desfeitos automaticamente
+LIMIT_BLOCK_REASON = 'Limite excedido'
+
+class QuotaStatusStore:
+    """Última situação de cota calculada por empresa, atualizada a cada coleta"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.companies = {}  # company_id -> (atualizado_em, [status ordenados por uso])
+    
+    def update(self, quota_status):
+        refreshed_at = get_current_datetime()
+        ranked = {
+            company_id: (refreshed_at, sorted(
+                users, key=lambda user: max(user['data_percent'], user['time_percent']), reverse=True
+            ))
+            for company_id, users in quota_status.items()
+        }
+        with self.lock:
+            self.companies.update(ranked)
+    
+    def get(self, company_id, max_age=None):
+        """(atualizado_em, status) da empresa, ou None se ausente ou mais velho que max_age segundos"""
+        with self.lock:
+            cached = self.companies.get(company_id)
+        if cached and max_age is not None and get_current_datetime() - cached[0] > timedelta(seconds=max_age):
+            return None
+        return cached
+
+# Estado global: lido pela API entre uma coleta e outra
+quota_status_store = QuotaStatusStore()
+
+# Última gravação de limites no roteador por empresa (time.monotonic)
+limits_pushed_at = {}
+
+class LimitService:
+    @staticmethod
+    def get_quota_status(company_id=None):
+        """Situação de cota de todos os usuários com crédito hoje, por empresa
+        
+        Uma única consulta agregada sobre os créditos do dia. Limites zerados
+        no crédito caem para os limites da empresa; limite 0 significa sem
+        limite. Retorna {company_id: [status, ...]}.
+        """
+        companies = {
+            company.id: company
+            for company in reference_cache.get_companies(active_only=True)
+            if not company_id or company.id == company_id
+        }
+        status = {cid: [] for cid in companies}
+        if not companies:
+            return status
+        
+        rows = db.session.query(
+            Credit.company_id,
+            Credit.username,
+            db.func.sum(db.func.coalesce(Credit.used_mb, 0)).label('used_mb'),
+            db.func.sum(
+                db.func.coalesce(Credit.total_available_mb, 0) + db.func.coalesce(Credit.accumulated_credit_mb, 0)
+            ).label('limit_mb'),
+            db.func.sum(db.func.coalesce(Credit.used_time, 0)).label('used_time'),
+            db.func.sum(
+                db.func.coalesce(Credit.total_available_time, 0) + db.func.coalesce(Credit.accumulated_credit_time, 0)
+            ).label('limit_time')
+        ).filter(
+            Credit.company_id.in_(list(companies)),
+            Credit.date == get_current_datetime().date()
+        ).group_by(Credit.company_id, Credit.username).all()
+        
+        for row in rows:
+            company = companies[row.company_id]
+            limit_mb = row.limit_mb or company.daily_limit_mb or 0
+            limit_time = row.limit_time or company.daily_time_limit or 0
+            
+            data_percent = (row.used_mb / limit_mb) * 100 if limit_mb else 0
+            time_percent = (row.used_time / limit_time) * 100 if limit_time else 0
+            
+            status[row.company_id].append({
+                'username': row.username,
+                'used_mb': round(row.used_mb, 2),
+                'limit_mb': limit_mb,
+                'used_time': row.used_time,
+                'limit_time': limit_time,
+                'data_percent': round(data_percent, 2),
+                'time_percent': round(time_percent, 2),
+                'data_exceeded': bool(limit_mb) and row.used_mb >= limit_mb,
+                'time_exceeded': bool(limit_time) and row.used_time >= limit_time
+            })
+        
+        return status
+    
+    @staticmethod
+    def get_near_limit(company_id, threshold=80, page=1, per_page=50):
+        """Usuários da empresa com uso de dados ou tempo >= threshold %, paginados
+        
+        Lê a situação guardada na última coleta; só consulta o banco (créditos
+        do dia, não a tabela usage) se esta empresa ainda não foi avaliada
+        neste processo ou se a última avaliação passou de QUOTA_STATUS_MAX_AGE
+        segundos (processos sem o agendador, ou coletas que falharam).
+        """
+        cached = quota_status_store.get(company_id, max_age=Config.QUOTA_STATUS_MAX_AGE)
+        if cached is None:
+            quota_status_store.update(LimitService.get_quota_status(company_id))
+            cached = quota_status_store.get(company_id) or (get_current_datetime(), [])
+        
+        refreshed_at, users = cached
+        # A lista está ordenada pelo maior percentual: basta cortar no limiar
+        near_limit = []
+        for user in users:
+            if max(user['data_percent'], user['time_percent']) < threshold:
+                break
+            near_limit.append(user)
+        
+        start = (page - 1) * per_page
+        return {
+            'company_id': company_id,
+            'threshold': threshold,
+            'refreshed_at': refreshed_at.isoformat(),
+            'total': len(near_limit),
+            'page': page,
+            'per_page': per_page,
+            'users': near_limit[start:start + per_page]
+        }
+    
+    @staticmethod
+    def enforce_limits(company_id=None, push_limits=True):
+        """Bloqueia quem excedeu a cota e desbloqueia quem voltou a ter crédito
+        
+        Avalia todos os usuários de uma vez e altera cada roteador numa única
+        conexão do pool. Usuários bloqueados manualmente (outro motivo) não são
+        desbloqueados. Com `push_limits` (e MIKROTIK_PUSH_LIMITS), grava também
+        a cota restante nos roteadores; o stream passa False, pois roda a cada
+        poucos segundos. Retorna estatísticas da execução.
+        """
+        started = time.monotonic()
+        stats = {
+            'companies': 0,
+            'evaluated': 0,
+            'exceeded': 0,
+            'blocked': 0,
+            'unblocked': 0,
+            'failed': 0,
+            'limits_pushed': 0,
+            'elapsed': 0.0
+        }
+        
+        quota_status = LimitService.get_quota_status(company_id)
+        quota_status_store.update(quota_status)
+        
+        blocked_by_limit = {}
+        for profile in OriginalProfile.query.filter(
+            OriginalProfile.company_id.in_(list(quota_status)),
+            OriginalProfile.is_blocked.is_(True),
+            OriginalProfile.blocked_reason == LIMIT_BLOCK_REASON
+        ):
+            blocked_by_limit.setdefault(profile.company_id, set()).add(profile.username)
+        
+        for cid, users in quota_status.items():
+            stats['companies'] += 1
+            stats['evaluated'] += len(users)
+            
+            exceeded = {user['username'] for user in users if user['data_exceeded'] or user['time_exceeded']}
+            already_blocked = blocked_by_limit.get(cid, set())
+            stats['exceeded'] += len(exceeded)
+            
+            to_block = exceeded - already_blocked
+            to_unblock = already_blocked - exceeded
+            if not to_block and not to_unblock:
+                continue
+            
+            # Bloqueios e desbloqueios da empresa numa única conexão
+            changes = {
+                username: ({'disabled': 'true'}, {'is_blocked': True, 'blocked_reason': LIMIT_BLOCK_REASON})
+                for username in to_block
+            }
+            changes.update({
+                username: ({'disabled': 'false'}, {'is_blocked': False, 'blocked_reason': None})
+                for username in to_unblock
+            })
+            results = UserService.apply_hotspot_changes(cid, changes)
+            
+            stats['blocked'] += sum(1 for username in to_block if results.get(username))
+            stats['unblocked'] += sum(1 for username in to_unblock if results.get(username))
+            stats['failed'] += sum(1 for success in results.values() if not success)
+        
+        if push_limits and Config.MIKROTIK_PUSH_LIMITS:
+            pushed = LimitService.push_router_limits(quota_status)
+            stats['limits_pushed'] = pushed['updated']
+            stats['failed'] += pushed['failed']
+        
+        stats['elapsed'] = round(time.monotonic() - started, 2)
+        logger.info(
+            f"Limites verificados: {stats['evaluated']} usuários em {stats['companies']} empresas "
+            f"({stats['blocked']} bloqueados, {stats['unblocked']} desbloqueados, "
+            f"{stats['limits_pushed']} limites gravados, {stats['failed']} falhas) em {stats['elapsed']}s"
+        )
+        return stats
+    
+    @staticmethod
+    def push_router_limits(quota_status):
+        """Grava no roteador a cota restante de cada usuário (limit-bytes-total/limit-uptime)
+        
+        Os limites do hotspot valem sobre os contadores acumulados do usuário,
+        então o valor gravado é contadores do usuário + sessão ativa + crédito
+        restante; assim o próprio roteador desconecta quem esgotar a cota, sem
+        esperar a próxima verificação. Limite 0 na cota é gravado como 0 (sem
+        limite). Só usuários cujo limite mudou além da tolerância são
+        alterados, numa única conexão por roteador. Cada empresa gravada sem
+        falhas só é gravada de novo depois de MIKROTIK_PUSH_LIMITS_INTERVAL
+        segundos.
+        Retorna {'updated', 'failed'}.
+        """
+        result = {'updated': 0, 'failed': 0}
+        
+        for cid, users in quota_status.items():
+            company = reference_cache.get_company(cid)
+            if not users or not company:
+                continue
+            
+            now = time.monotonic()
+            if now - limits_pushed_at.get(cid, float('-inf')) < Config.MIKROTIK_PUSH_LIMITS_INTERVAL:
+                continue
+            
+            try:
+                router_users = {
+                    user['name']: user for user in MikroTikService.list_hotspot_users(company) if user.get('name')
+                }
+                # Contadores da sessão em andamento (só entram no usuário ao desconectar)
+                sessions = {}
+                for active in MikroTikService.list_active_users(company):
+                    total_bytes, uptime = sessions.get(active.get('user'), (0, 0))
+                    sessions[active.get('user')] = (
+                        total_bytes + int(active.get('bytes-in', 0) or 0) + int(active.get('bytes-out', 0) or 0),
+                        uptime + MikroTikService.parse_duration(active.get('uptime'))
+                    )
+            except Exception as e:
+                logger.error(f"Erro ao ler usuários do roteador da empresa {company.name}: {e}")
+                result['failed'] += len(users)
+                continue
+            
+            changes = {}
+            for user in users:
+                router_user = router_users.get(user['username'])
+                if not router_user:
+                    continue
+                
+                session_bytes, session_time = sessions.get(user['username'], (0, 0))
+                limit_bytes = limit_time = 0
+                if user['limit_mb']:
+                    remaining_bytes = max(0, user['limit_mb'] - user['used_mb']) * 1024 * 1024
+                    limit_bytes = int(
+                        int(router_user.get('bytes-in', 0) or 0) + int(router_user.get('bytes-out', 0) or 0)
+                        + session_bytes + remaining_bytes
+                    )
+                if user['limit_time']:
+                    limit_time = int(
+                        MikroTikService.parse_duration(router_user.get('uptime'))
+                        + session_time + max(0, user['limit_time'] - user['used_time'])
+                    )
+                
+                current_bytes = int(router_user.get('limit-bytes-total', 0) or 0)
+                current_time = MikroTikService.parse_duration(router_user.get('limit-uptime'))
+                if (LimitService._limit_changed(limit_bytes, current_bytes, Config.MIKROTIK_LIMIT_TOLERANCE_MB * 1024 * 1024)
+                        or LimitService._limit_changed(limit_time, current_time, Config.MIKROTIK_LIMIT_TOLERANCE_TIME)):
+                    changes[user['username']] = {
+                        'limit-bytes-total': str(limit_bytes),
+                        'limit-uptime': MikroTikService.format_duration(limit_time)
+                    }
+            
+            failed = 0
+            if changes:
+                results = MikroTikService.update_users(company, changes)
+                failed = sum(1 for success in results.values() if not success)
+                result['updated'] += len(results) - failed
+                result['failed'] += failed
+            
+            # Só conta como gravada se tudo foi aplicado; senão tenta no próximo ciclo
+            if not failed:
+                limits_pushed_at[cid] = now
+        
+        return result
+    
+    @staticmethod
+    def _limit_changed(new, current, tolerance):
+        """Passou de/para sem limite (0) ou mudou mais que a tolerância"""
+        return (new == 0) != (current == 0) or abs(new - current) > tolerance
@@ -1,22 +1,151 @@
-import routeros_api
+import re
+import threading
+import time
+from concurrent.futures import Future
+from mikrotik_connection_manager import connection_manager, MikroTikConnection, MikroTikConnectionError
+from routeros_api.exceptions import RouterOsApiCommunicationError
 from logger import get_logger
-from config import get_current_datetime
+from config import Config, get_current_datetime
 
 logger = get_logger(__name__)
 
+# Duração no formato do RouterOS (ex.: 1w2d3h4m5s)
+DURATION_PATTERN = re.compile(r'(\d+)([wdhms])')
+DURATION_UNITS = {'w': 604800, 'd': 86400, 'h': 3600, 'm': 60, 's': 1}
+CLOCK_PATTERN = re.compile(r'(\d+):(\d+):(\d+)$')
+
+# Campos pedidos ao roteador (.proplist) nas listagens; só o que as telas,
+# a coleta e os limites usam. O .id volta como 'id'.
+HOTSPOT_USER_FIELDS = ('.id', 'name', 'profile', 'disabled', 'bytes-in', 'bytes-out', 'uptime',
+                       'limit-bytes-total', 'limit-uptime')
+HOTSPOT_ACTIVE_FIELDS = ('.id', 'user', 'bytes-in', 'bytes-out', 'uptime')
+
+class HotspotUserIdCache:
+    """Mapa nome -> .id dos usuários hotspot de cada empresa
+    
+    Preenchido por qualquer listagem completa de /ip/hotspot/user. Os ids do
+    RouterOS podem mudar após um reboot do roteador, por isso cada empresa
+    expira após MIKROTIK_USER_ID_CACHE_TTL segundos; um "no such item" numa
+    alteração descarta a entrada na hora.
+    """
+    
+    def __init__(self, ttl=None):
+        self.ttl = Config.MIKROTIK_USER_ID_CACHE_TTL if ttl is None else ttl
+        self.lock = threading.Lock()
+        self.companies = {}  # company_id -> (carregado_em, {nome: id})
+    
+    def fill(self, company_id, users):
+        """Substitui o mapa da empresa a partir de uma listagem completa"""
+        ids = {user.get('name'): user.get('id') for user in users if user.get('name') and user.get('id')}
+        with self.lock:
+            self.companies[company_id] = (time.monotonic(), ids)
+        return ids
+    
+    def get(self, company_id, username):
+        with self.lock:
+            loaded_at, ids = self.companies.get(company_id, (0, {}))
+            if time.monotonic() - loaded_at > self.ttl:
+                self.companies.pop(company_id, None)
+                return None
+            return ids.get(username)
+    
+    def put(self, company_id, username, user_id):
+        with self.lock:
+            loaded_at, ids = self.companies.setdefault(company_id, (time.monotonic(), {}))
+            ids[username] = user_id
+    
+    def discard(self, company_id, username):
+        with self.lock:
+            _, ids = self.companies.get(company_id, (0, {}))
+            ids.pop(username, None)
+
+class RouterSnapshotCache:
+    """Cópias recentes das listagens do roteador por (empresa, caminho)
+    
+    Leituras dentro de MIKROTIK_SNAPSHOT_TTL segundos usam a cópia em
+    memória. Quando ela expira, só a primeira requisição consulta o
+    roteador; as concorrentes esperam o mesmo resultado (single-flight).
+    As listas devolvidas são compartilhadas e não devem ser alteradas.
+    """
+    
+    def __init__(self, ttl=None):
+        self.ttl = Config.MIKROTIK_SNAPSHOT_TTL if ttl is None else ttl
+        self.lock = threading.Lock()
+        self.snapshots = {}  # (company_id, path) -> (obtido_em, linhas)
+        self.inflight = {}  # (company_id, path) -> Future da consulta em andamento
+    
+    def get(self, company_id, path, fetch, max_age=None):
+        """Cópia com no máximo `max_age` segundos, ou o resultado de `fetch()`"""
+        key = (company_id, path)
+        max_age = self.ttl if max_age is None else max_age
+        
+        with self.lock:
+            snapshot = self.snapshots.get(key)
+            if snapshot and time.monotonic() - snapshot[0] <= max_age:
+                return snapshot[1]
+            
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self.inflight[key] = Future()
+        
+        if not leader:
+            return future.result()
+        
+        try:
+            rows = fetch()
+            self.put(company_id, path, rows)
+            future.set_result(rows)
+            return rows
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+    
+    def peek(self, company_id, path):
+        """Cópia ainda válida, ou None (nunca consulta o roteador)"""
+        with self.lock:
+            snapshot = self.snapshots.get((company_id, path))
+            if snapshot and time.monotonic() - snapshot[0] <= self.ttl:
+                return snapshot[1]
+            return None
+    
+    def put(self, company_id, path, rows):
+        """Grava uma listagem obtida por outro caminho (ex.: a coleta de uso)"""
+        with self.lock:
+            self.snapshots[(company_id, path)] = (time.monotonic(), rows)
+    
+    def invalidate(self, company_id, path=None):
+        with self.lock:
+            for key in [k for k in self.snapshots if k[0] == company_id and (path is None or k[1] == path)]:
+                del self.snapshots[key]
+
+# Estado global compartilhado pelas requisições e pelo agendador
+user_id_cache = HotspotUserIdCache()
+router_snapshots = RouterSnapshotCache()
+
 class MikroTikService:
     @staticmethod
-    def connect_to_mikrotik(company):
-        """Conecta ao MikroTik da empresa"""
+    def session(company, timeout=None):
+        """Empresta uma conexão do pool da empresa (usar com `with`)"""
+        return MikroTikConnection(company, timeout=timeout)
+    
+    @staticmethod
+    def connect_to_mikrotik(company, timeout=None):
+        """Obtém uma conexão do pool do MikroTik da empresa"""
         try:
-            connection = routeros_api.RouterOsApiPool(
+            connection, api = connection_manager.get_connection(
+                company.id,
                 company.mikrotik_ip,
-                username=company.mikrotik_username,
-                password=company.mikrotik_password,
-                port=company.mikrotik_port
+                company.mikrotik_username,
+                company.mikrotik_password,
+                company.mikrotik_port or 8728,
+                socket_timeout=timeout
             )
-            api = connection.get_api()
-            logger.info(f"Conectado ao MikroTik da empresa {company.name}")
+            if not api:
+                logger.error(f"Sem conexão disponível para o MikroTik da empresa {company.name}")
             return connection, api
         except Exception as e:
             logger.error(f"Erro ao conectar ao MikroTik da empresa {company.name}: {e}")
@@ -26,193 +155,281 @@ class MikroTikService:
     def disconnect_mikrotik(company_id, connection, api):
         """Desconecta do MikroTik retornando a conexão ao pool"""
         try:
-            connection.disconnect()
+            connection_manager.return_connection(company_id, connection, api)
         except Exception as e:
             logger.error(f"Erro ao desconectar do MikroTik: {e}")
     
+    @staticmethod
+    def select(api, path, fields=None, **queries):
+        """print filtrado no roteador: só os campos pedidos (.proplist) e só as
+        entradas cujos atributos são iguais aos `queries` (?nome=valor)
+        
+        Ex.: select(api, '/ip/hotspot/user', ('.id',), name='joao')
+        """
+        arguments = {'proplist': ','.join(fields)} if fields else {}
+        return api.get_resource(path).call('print', arguments, queries)
+    
+    @staticmethod
+    def list_hotspot_users(company, max_age=None):
+        """Lista completa de /ip/hotspot/user, via snapshot (exceções são propagadas)"""
+        def fetch():
+            with MikroTikConnection(company) as api:
+                users = MikroTikService.select(api, '/ip/hotspot/user', HOTSPOT_USER_FIELDS)
+            user_id_cache.fill(company.id, users)
+            return users
+        
+        return router_snapshots.get(company.id, '/ip/hotspot/user', fetch, max_age)
+    
+    @staticmethod
+    def list_active_users(company, max_age=None):
+        """Lista completa de /ip/hotspot/active, via snapshot (exceções são propagadas)"""
+        def fetch():
+            with MikroTikConnection(company) as api:
+                return MikroTikService.select(api, '/ip/hotspot/active', HOTSPOT_ACTIVE_FIELDS)
+        
+        return router_snapshots.get(company.id, '/ip/hotspot/active', fetch, max_age)
+    
     @staticmethod
     def get_hotspot_users(company):
         """Obtém lista de usuários hotspot"""
-        connection, api = MikroTikService.connect_to_mikrotik(company)
-        if not api:
-            return []
-        
         try:
-            hotspot_users = api.get_resource('/ip/hotspot/user')
-            users = hotspot_users.get()
-            connection.disconnect()
-            return users
+            return MikroTikService.list_hotspot_users(company)
         except Exception as e:
             logger.error(f"Erro ao obter usuários hotspot: {e}")
-            if connection:
-                connection.disconnect()
             return []
     
     @staticmethod
     def get_active_users(company):
         """Obtém usuários ativos no hotspot"""
-        connection, api = MikroTikService.connect_to_mikrotik(company)
-        if not api:
-            return []
-        
         try:
-            active_users = api.get_resource('/ip/hotspot/active')
-            users = active_users.get()
-            connection.disconnect()
-            return users
+            return MikroTikService.list_active_users(company)
         except Exception as e:
             logger.error(f"Erro ao obter usuários ativos: {e}")
-            if connection:
-                connection.disconnect()
             return []
     
     @staticmethod
     def create_hotspot_user(company, username, password, profile='default'):
         """Cria um usuário hotspot"""
-        connection, api = MikroTikService.connect_to_mikrotik(company)
-        if not api:
-            return False
-        
         try:
-            hotspot_users = api.get_resource('/ip/hotspot/user')
-            hotspot_users.add(
-                name=username,
-                password=password,
-                profile=profile
-            )
-            connection.disconnect()
+            with MikroTikConnection(company) as api:
+                api.get_resource('/ip/hotspot/user').add(
+                    name=username,
+                    password=password,
+                    profile=profile
+                )
+            router_snapshots.invalidate(company.id, '/ip/hotspot/user')
             logger.info(f"Usuário {username} criado no hotspot")
             return True
         except Exception as e:
             logger.error(f"Erro ao criar usuário {username}: {e}")
-            if connection:
-                connection.disconnect()
             return False
     
     @staticmethod
     def update_user_profile(company, username, new_profile):
         """Atualiza o perfil de um usuário"""
-        connection, api = MikroTikService.connect_to_mikrotik(company)
-        if not api:
-            return False
-        
         try:
-            hotspot_users = api.get_resource('/ip/hotspot/user')
-            users = hotspot_users.get(name=username)
-            
-            if users:
-                user_id = users[0]['id']
-                hotspot_users.set(id=user_id, profile=new_profile)
-                connection.disconnect()
-                logger.info(f"Perfil do usuário {username} atualizado para {new_profile}")
-                return True
-            else:
+            if not MikroTikService._set_user(company, username, profile=new_profile):
                 logger.warning(f"Usuário {username} não encontrado")
-                connection.disconnect()
                 return False
+            
+            logger.info(f"Perfil do usuário {username} atualizado para {new_profile}")
+            return True
         except Exception as e:
             logger.error(f"Erro ao atualizar perfil do usuário {username}: {e}")
-            if connection:
-                connection.disconnect()
             return False
     
     @staticmethod
     def disable_user(company, username):
         """Desabilita um usuário"""
-        connection, api = MikroTikService.connect_to_mikrotik(company)
-        if not api:
-            return False
-        
         try:
-            hotspot_users = api.get_resource('/ip/hotspot/user')
-            users = hotspot_users.get(name=username)
-            
-            if users:
-                user_id = users[0]['id']
-                hotspot_users.set(id=user_id, disabled='true')
-                connection.disconnect()
-                logger.info(f"Usuário {username} desabilitado")
-                return True
-            else:
-                connection.disconnect()
+            if not MikroTikService._set_user(company, username, disabled='true'):
                 return False
+            
+            logger.info(f"Usuário {username} desabilitado")
+            return True
         except Exception as e:
             logger.error(f"Erro ao desabilitar usuário {username}: {e}")
-            if connection:
-                connection.disconnect()
             return False
     
     @staticmethod
     def enable_user(company, username):
         """Habilita um usuário"""
-        connection, api = MikroTikService.connect_to_mikrotik(company)
-        if not api:
+        try:
+            if not MikroTikService._set_user(company, username, disabled='false'):
+                return False
+            
+            logger.info(f"Usuário {username} habilitado")
+            return True
+        except Exception as e:
+            logger.error(f"Erro ao habilitar usuário {username}: {e}")
             return False
+    
+    @staticmethod
+    def _set_user(company, username, **properties):
+        """Altera um usuário hotspot pelo .id em cache (uma ida ao roteador)
         
-        try:
+        Sem id em cache, ou se o id não existir mais ("no such item"), busca o
+        usuário pelo nome e tenta de novo. Retorna False se ele não existir.
+        """
+        with MikroTikConnection(company) as api:
             hotspot_users = api.get_resource('/ip/hotspot/user')
-            users = hotspot_users.get(name=username)
             
-            if users:
-                user_id = users[0]['id']
-                hotspot_users.set(id=user_id, disabled='false')
-                connection.disconnect()
-                logger.info(f"Usuário {username} habilitado")
-                return True
-            else:
-                connection.disconnect()
+            user_id = user_id_cache.get(company.id, username)
+            if user_id:
+                try:
+                    hotspot_users.set(id=user_id, **properties)
+                    router_snapshots.invalidate(company.id, '/ip/hotspot/user')
+                    return True
+                except RouterOsApiCommunicationError as e:
+                    if 'no such item' not in str(e):
+                        raise
+                    user_id_cache.discard(company.id, username)
+            
+            users = MikroTikService.select(api, '/ip/hotspot/user', ('.id',), name=username)
+            if not users:
                 return False
+            
+            user_id_cache.put(company.id, username, users[0]['id'])
+            hotspot_users.set(id=users[0]['id'], **properties)
+            router_snapshots.invalidate(company.id, '/ip/hotspot/user')
+            return True
+    
+    @staticmethod
+    def update_users(company, changes):
+        """Aplica alterações a vários usuários hotspot numa única conexão
+        
+        `changes` é {username: {propriedade: valor}}. Os ids vêm do
+        HotspotUserIdCache; /ip/hotspot/user só é listado (uma vez) se algum
+        usuário não estiver no cache, e um id vencido ("no such item") é
+        buscado de novo pelo nome. Os `set` seguem em sequência na mesma
+        conexão do pool. Retorna {username: sucesso}.
+        """
+        results = {username: False for username in changes}
+        if not results:
+            return results
+        
+        try:
+            with MikroTikConnection(company) as api:
+                hotspot_users = api.get_resource('/ip/hotspot/user')
+                ids = {username: user_id_cache.get(company.id, username) for username in changes}
+                if not all(ids.values()):
+                    listed = user_id_cache.fill(
+                        company.id, MikroTikService.select(api, '/ip/hotspot/user', ('.id', 'name'))
+                    )
+                    ids = {username: listed.get(username) for username in changes}
+                
+                for username, properties in changes.items():
+                    if not ids[username]:
+                        logger.warning(f"Usuário {username} não encontrado")
+                        continue
+                    try:
+                        try:
+                            hotspot_users.set(id=ids[username], **properties)
+                        except RouterOsApiCommunicationError as e:
+                            if 'no such item' not in str(e):
+                                raise
+                            # Id mudou (ex.: reboot do roteador): buscar pelo nome
+                            user_id_cache.discard(company.id, username)
+                            users = MikroTikService.select(api, '/ip/hotspot/user', ('.id',), name=username)
+                            if not users:
+                                logger.warning(f"Usuário {username} não encontrado")
+                                continue
+                            user_id_cache.put(company.id, username, users[0]['id'])
+                            hotspot_users.set(id=users[0]['id'], **properties)
+                        results[username] = True
+                    except RouterOsApiCommunicationError as e:
+                        user_id_cache.discard(company.id, username)
+                        logger.error(f"Erro ao alterar usuário {username}: {e}")
         except Exception as e:
-            logger.error(f"Erro ao habilitar usuário {username}: {e}")
-            if connection:
-                connection.disconnect()
-            return False
+            logger.error(f"Erro ao alterar usuários da empresa {company.name}: {e}")
+        
+        if any(results.values()):
+            router_snapshots.invalidate(company.id, '/ip/hotspot/user')
+        logger.info(f"{sum(results.values())}/{len(results)} usuários alterados na empresa {company.name}")
+        return results
+    
+    @staticmethod
+    def set_users_disabled(company, usernames, disabled=True):
+        """Desabilita (ou habilita) vários usuários numa única conexão"""
+        value = 'true' if disabled else 'false'
+        return MikroTikService.update_users(company, {username: {'disabled': value} for username in usernames})
+    
+    @staticmethod
+    def update_users_profile(company, usernames, new_profile):
+        """Altera o perfil de vários usuários numa única conexão"""
+        return MikroTikService.update_users(company, {username: {'profile': new_profile} for username in usernames})
     
     @staticmethod
     def get_user_usage(company, username):
-        """Obtém dados de uso de um usuário"""
-        connection, api = MikroTikService.connect_to_mikrotik(company)
-        if not api:
-            return None
+        """Obtém dados de uso de um usuário
         
+        Usa os snapshots quando estão válidos; senão pede ao roteador só a
+        entrada do usuário (?user= / ?name=) em vez da lista inteira.
+        """
         try:
-            # Primeiro tenta usuários ativos
-            active_users = api.get_resource('/ip/hotspot/active')
-            active = active_users.get(user=username)
+            active = router_snapshots.peek(company.id, '/ip/hotspot/active')
+            users = router_snapshots.peek(company.id, '/ip/hotspot/user')
             
+            # Primeiro tenta usuários ativos
+            if active is not None:
+                active = [entry for entry in active if entry.get('user') == username]
+            else:
+                with MikroTikConnection(company) as api:
+                    active = MikroTikService.select(api, '/ip/hotspot/active', HOTSPOT_ACTIVE_FIELDS, user=username)
             if active:
-                connection.disconnect()
                 return active[0]
             
             # Se não estiver ativo, busca no histórico
-            hotspot_users = api.get_resource('/ip/hotspot/user')
-            users = hotspot_users.get(name=username)
-            
-            if users:
-                connection.disconnect()
-                return users[0]
-            
-            connection.disconnect()
-            return None
+            if users is not None:
+                users = [user for user in users if user.get('name') == username]
+            else:
+                with MikroTikConnection(company) as api:
+                    users = MikroTikService.select(api, '/ip/hotspot/user', HOTSPOT_USER_FIELDS, name=username)
+            return users[0] if users else None
         except Exception as e:
             logger.error(f"Erro ao obter uso do usuário {username}: {e}")
-            if connection:
-                connection.disconnect()
             return None
     
     @staticmethod
     def test_connection(company):
         """Testa a conexão com o MikroTik"""
-        connection, api = MikroTikService.connect_to_mikrotik(company)
-        if api:
-            try:
+        try:
+            with MikroTikConnection(company) as api:
                 # Tenta obter informações do sistema
-                system_resource = api.get_resource('/system/resource')
-                system_info = system_resource.get()
-                MikroTikService.disconnect_mikrotik(company.id, connection, api)
-                return True, "Conexão estabelecida com sucesso"
-            except Exception as e:
-                MikroTikService.disconnect_mikrotik(company.id, connection, api)
-                return False, f"Erro ao testar conexão: {e}"
-        else:
+                api.get_resource('/system/resource').get()
+            return True, "Conexão estabelecida com sucesso"
+        except MikroTikConnectionError:
             return False, "Não foi possível estabelecer conexão"
+        except Exception as e:
+            return False, f"Erro ao testar conexão: {e}"
+    
+    @staticmethod
+    def parse_duration(value):
+        """Converte uma duração do RouterOS (ex.: 1d2h3m4s) em segundos"""
+        if not value:
+            return 0
+        if isinstance(value, (int, float)):
+            return int(value)
+        
+        seconds = 0
+        
+        # Versões antigas usam o formato 1d02:03:04
+        clock = CLOCK_PATTERN.search(value)
+        if clock:
+            hours, minutes, secs = (int(part) for part in clock.groups())
+            seconds += hours * 3600 + minutes * 60 + secs
+            value = value[:clock.start()]
+        
+        return seconds + sum(int(amount) * DURATION_UNITS[unit] 
+                             for amount, unit in DURATION_PATTERN.findall(value))
+    
+    @staticmethod
+    def format_duration(seconds):
+        """Converte segundos numa duração do RouterOS (ex.: 1d2h3m4s)"""
+        seconds = int(seconds)
+        parts = []
+        for unit, size in DURATION_UNITS.items():
+            amount, seconds = divmod(seconds, size)
+            if amount:
+                parts.append(f"{amount}{unit}")
+        return ''.join(parts) or '0s'
@@ -0,0 +1,161 @@
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import db, Company, HotspotClass, CacheVersion
+from models.sql import upsert_insert
+from config import Config
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+REFERENCE_CACHE_NAME = 'reference'
+PENDING_WRITES_KEY = 'reference_cache_pending_writes'
+
+@event.listens_for(Session, 'do_orm_execute')
+def _track_statement(orm_execute_state):
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info[PENDING_WRITES_KEY] = True
+
+@event.listens_for(Session, 'after_flush')
+def _track_flush(session, flush_context):
+    session.info[PENDING_WRITES_KEY] = True
+
+@event.listens_for(Session, 'after_transaction_end')
+def _clear_writes(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(PENDING_WRITES_KEY, None)
+
+class ReferenceCache:
+    """Cache local ao processo de empresas e turmas
+
+    As tabelas company e hotspot_class só mudam pelas telas de empresas, mas
+    são lidas a cada crédito, coleta e página. O cache guarda cópias
+    destacadas de todas as linhas e as recarrega quando a versão em
+    cache_version muda; a versão é conferida no banco no máximo a cada
+    REFERENCE_CACHE_CHECK_INTERVAL segundos, então alterações feitas por
+    outro processo aparecem dentro desse intervalo.
+
+    Os objetos devolvidos são anexados à sessão atual com merge(load=False),
+    sem consulta ao banco, e podem ser usados normalmente (inclusive os
+    relacionamentos, carregados sob demanda).
+
+    A recarga nunca acontece dentro de uma transação do chamador que já
+    gravou algo: a versão só é conferida de novo na próxima leitura fora
+    dela. Quem grava em lote deve chamar refresh() antes de começar.
+    """
+
+    def __init__(self, check_interval=None):
+        self.check_interval = Config.REFERENCE_CACHE_CHECK_INTERVAL if check_interval is None else check_interval
+        self.lock = threading.Lock()
+        self.version = None
+        self.checked_at = 0.0
+        self.companies = {}  # id -> Company
+        self.classes = {}  # id -> HotspotClass
+        self.active_classes = {}  # company_id -> HotspotClass ativa
+
+    def get_company(self, company_id):
+        """Empresa pelo id, ou None"""
+        if not company_id:
+            return None
+        return self._attach(self._snapshot()[0].get(int(company_id)))
+
+    def get_companies(self, active_only=False):
+        """Todas as empresas (ou só as ativas), ordenadas por id"""
+        companies = self._snapshot()[0]
+        return [
+            self._attach(company) for _, company in sorted(companies.items())
+            if company.is_active or not active_only
+        ]
+
+    def get_class(self, class_id):
+        """Turma pelo id, ou None"""
+        if not class_id:
+            return None
+        return self._attach(self._snapshot()[1].get(int(class_id)))
+
+    def get_active_class(self, company_id):
+        """Turma ativa da empresa, ou None"""
+        return self._attach(self._snapshot()[2].get(company_id))
+
+    def refresh(self):
+        """Confere a versão (e recarrega se mudou) antes de abrir uma transação de escrita"""
+        self._snapshot()
+
+    def invalidate(self):
+        """Incrementa a versão no banco e descarta o cache deste processo
+
+        Deve ser chamado depois do commit que alterou empresas ou turmas.
+        """
+        try:
+            stmt = upsert_insert(CacheVersion).values(name=REFERENCE_CACHE_NAME, version=1)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['name'],
+                set_={'version': CacheVersion.version + 1}
+            )
+            db.session.execute(stmt)
+            db.session.commit()
+        except Exception as e:
+            logger.error(f"Erro ao invalidar cache de empresas: {e}")
+            db.session.rollback()
+        finally:
+            with self.lock:
+                self.version = None
+
+    def _snapshot(self):
+        """Dicionários atuais, recarregados se a versão no banco mudou"""
+        with self.lock:
+            now = time.monotonic()
+            loaded = self.version is not None
+            if loaded and db.session.info.get(PENDING_WRITES_KEY):
+                # Transação do chamador com escritas pendentes: usar o cache atual
+                return self.companies, self.classes, self.active_classes
+
+            if not loaded or now - self.checked_at >= self.check_interval:
+                version = db.session.query(CacheVersion.version).filter_by(
+                    name=REFERENCE_CACHE_NAME
+                ).scalar() or 0
+
+                if version != self.version:
+                    self._load()
+                    self.version = version
+                self.checked_at = now
+
+            return self.companies, self.classes, self.active_classes
+
+    def _load(self):
+        """Lê as tabelas numa sessão própria para não destacar objetos da sessão atual
+
+        Sem cache carregado e com escritas pendentes, a sessão própria usa a
+        conexão do chamador sem encerrar a transação dele; caso contrário
+        poderia ser a mesma conexão (SQLite em memória) e o rollback ao
+        devolvê-la ao pool descartaria as escritas.
+        """
+        if db.session.info.get(PENDING_WRITES_KEY):
+            session = Session(bind=db.session.connection(), join_transaction_mode='rollback_only',
+                              expire_on_commit=False)
+        else:
+            session = Session(db.engine, expire_on_commit=False)
+
+        with session:
+            companies = session.scalars(db.select(Company)).all()
+            classes = session.scalars(db.select(HotspotClass).order_by(HotspotClass.id)).all()
+
+        self.companies = {company.id: company for company in companies}
+        self.classes = {hotspot_class.id: hotspot_class for hotspot_class in classes}
+        # Como em get_or_create_credit, vale a primeira turma ativa da empresa
+        self.active_classes = {}
+        for hotspot_class in classes:
+            if hotspot_class.is_active:
+                self.active_classes.setdefault(hotspot_class.company_id, hotspot_class)
+
+        logger.debug(f"Cache de empresas carregado: {len(companies)} empresas, {len(classes)} turmas")
+
+    @staticmethod
+    def _attach(instance):
+        if instance is None:
+            return None
+        return db.session.merge(instance, load=False)
+
+# Instância global do cache
+reference_cache = ReferenceCache()
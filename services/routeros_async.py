@@ -0,0 +1,469 @@
+import asyncio
+import binascii
+import contextlib
+import hashlib
+import socket
+import ssl
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Chaves que a API do RouterOS prefixa com ponto (mesma convenção do routeros_api)
+DOTTED_KEYS = {'id', 'proplist'}
+
+class RouterOsError(Exception):
+    """Erro na comunicação com a API do RouterOS"""
+
+class RouterOsTrapError(RouterOsError):
+    """Comando recusado pelo roteador (resposta !trap)"""
+
+    def __init__(self, message, category=None):
+        super().__init__(message)
+        self.category = category
+
+class RouterOsFatalError(RouterOsError):
+    """Conexão encerrada pelo roteador ou resposta fora do protocolo"""
+
+def encode_length(length):
+    """Prefixo de comprimento de uma palavra (1 a 5 bytes)"""
+    if length < 0x80:
+        return bytes([length])
+    if length < 0x4000:
+        return (length | 0x8000).to_bytes(2, 'big')
+    if length < 0x200000:
+        return (length | 0xC00000).to_bytes(3, 'big')
+    if length < 0x10000000:
+        return (length | 0xE0000000).to_bytes(4, 'big')
+    return b'\xf0' + length.to_bytes(4, 'big')
+
+async def read_length(reader):
+    first = (await reader.readexactly(1))[0]
+    if first < 0x80:
+        return first
+
+    if first < 0xC0:
+        extra, length = 1, first & 0x3F
+    elif first < 0xE0:
+        extra, length = 2, first & 0x1F
+    elif first < 0xF0:
+        extra, length = 3, first & 0x0F
+    elif first == 0xF0:
+        extra, length = 4, 0
+    else:
+        raise RouterOsFatalError(f"Prefixo de comprimento inválido: {first:#x}")
+
+    for byte in await reader.readexactly(extra):
+        length = (length << 8) | byte
+    return length
+
+def encode_sentence(words, encoding='utf-8'):
+    """Sentença pronta para envio: palavras com prefixo de comprimento e palavra vazia no fim"""
+    data = bytearray()
+    for word in words:
+        if isinstance(word, str):
+            word = word.encode(encoding)
+        data += encode_length(len(word)) + word
+    data += b'\x00'
+    return bytes(data)
+
+async def read_sentence(reader, encoding='utf-8'):
+    """Lê palavras até a palavra vazia que encerra a sentença"""
+    words = []
+    while True:
+        length = await read_length(reader)
+        if length == 0:
+            return words
+        words.append((await reader.readexactly(length)).decode(encoding, errors='replace'))
+
+def parse_sentence(words):
+    """Separa uma resposta em (tipo, tag, atributos), ex.: ('!re', '3', {'id': '*1', ...})"""
+    reply, tag, attributes = words[0] if words else '', None, {}
+    for word in words[1:]:
+        if word.startswith('.tag='):
+            tag = word[5:]
+        elif word.startswith('='):
+            key, _, value = word[1:].partition('=')
+            if key.startswith('.') and key[1:] in DOTTED_KEYS:
+                key = key[1:]
+            attributes[key] = value
+    return reply, tag, attributes
+
+def attribute_words(attributes):
+    """{'id': '*1', 'limit_uptime': '1h'} -> ['=.id=*1', '=limit-uptime=1h']"""
+    words = []
+    for key, value in (attributes or {}).items():
+        key = key.replace('_', '-')
+        if key in DOTTED_KEYS:
+            key = '.' + key
+        if isinstance(value, bool):
+            value = 'true' if value else 'false'
+        words.append(f'={key}={value}')
+    return words
+
+def query_words(queries):
+    """{'name': 'joao'} -> ['?name=joao'] (todas as condições combinadas com E)"""
+    words = []
+    for key, value in (queries or {}).items():
+        key = key.replace('_', '-')
+        if key in DOTTED_KEYS:
+            key = '.' + key
+        words.append(f'?{key}={value}')
+    return words
+
+class AsyncRouterOsClient:
+    """Cliente asyncio da API do RouterOS (porta 8728/8729)
+
+    Implementa o protocolo diretamente: cada comando recebe uma tag própria
+    (.tag), então vários comandos podem estar em andamento ao mesmo tempo na
+    mesma conexão. Uma tarefa de leitura distribui as respostas !re/!done/
+    !trap para a fila de cada tag. Os registros têm o mesmo formato do
+    routeros_api (chaves sem o ponto, ex.: 'id', valores em texto).
+
+    Uso:
+        async with AsyncRouterOsClient(host, usuario, senha) as client:
+            sessions = await client.get('/ip/hotspot/active')
+    """
+
+    def __init__(self, host, username, password, port=8728, use_ssl=False, timeout=15, encoding='utf-8'):
+        self.host = host
+        self.username = username
+        self.password = password or ''
+        self.port = port or (8729 if use_ssl else 8728)
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.encoding = encoding
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+        self.write_lock = asyncio.Lock()
+        self.pending = {}  # tag -> asyncio.Queue das respostas
+        self.next_tag = 0
+        self.error = None
+
+    @property
+    def connected(self):
+        return self.writer is not None and self.error is None and not self.writer.is_closing()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def connect(self):
+        """Abre o socket, inicia a leitura e autentica"""
+        context = None
+        if self.use_ssl:
+            # Roteadores costumam usar certificado próprio
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=context), self.timeout
+        )
+        self.error = None
+        # Keepalive do TCP: o sistema acaba derrubando conexões meio abertas
+        sock = self.writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.read_task = asyncio.create_task(self._read_loop())
+
+        try:
+            await self.login()
+        except BaseException:
+            await self.close()
+            raise
+
+    async def login(self):
+        """Login em texto (RouterOS >= 6.43), com desafio MD5 para versões antigas"""
+        done = await self.call('/login', {'name': self.username, 'password': self.password})
+        if 'ret' in done:
+            challenge = binascii.unhexlify(done['ret'])
+            digest = hashlib.md5(b'\x00' + self.password.encode(self.encoding) + challenge).hexdigest()
+            await self.call('/login', {'name': self.username, 'response': '00' + digest})
+
+    async def ping(self):
+        """Confirma que o roteador ainda responde nesta conexão
+
+        Sem resposta dentro do prazo do cliente, a conexão é encerrada (os
+        demais comandos falham) e RouterOsFatalError é levantado.
+        """
+        try:
+            await self.call('/system/identity/print')
+        except RouterOsTrapError:
+            # Recusado, mas respondido: a conexão está viva
+            pass
+        except (asyncio.TimeoutError, RouterOsError, OSError) as e:
+            await self.close()
+            raise RouterOsFatalError(f"Roteador {self.host} não respondeu ao ping ({e or 'prazo esgotado'})")
+
+    async def close(self):
+        if self.writer is None:
+            return
+
+        writer, self.writer = self.writer, None
+        writer.close()
+        if self.read_task:
+            self.read_task.cancel()
+        self._fail_pending(RouterOsFatalError("Conexão encerrada"))
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+    async def call(self, command, attributes=None, queries=None):
+        """Executa um comando e retorna os atributos do !done
+
+        Para comandos de listagem use `get`/`execute`, que devolvem os !re.
+        """
+        return await asyncio.wait_for(self._done(command, attributes, queries), self.timeout)
+
+    async def get(self, path, fields=None, **queries):
+        """print de um menu, filtrado por igualdade no roteador e limitado aos
+        campos pedidos (ex.: get('/ip/hotspot/user', ('.id', 'profile'), name='joao'))
+        """
+        attributes = {'proplist': ','.join(fields)} if fields else None
+        return await asyncio.wait_for(self._collect(path.rstrip('/') + '/print', attributes, queries), self.timeout)
+
+    async def execute(self, command, attributes=None, queries=None):
+        """Executa um comando e retorna a lista de !re (com o prazo do cliente)"""
+        return await asyncio.wait_for(self._collect(command, attributes, queries), self.timeout)
+
+    async def stream(self, command, attributes=None, queries=None, idle_timeout=None):
+        """Itera os !re à medida que chegam, sem prazo (ex.: comandos com follow)
+
+        Se o consumidor parar antes do !done o comando é cancelado no roteador
+        (ao interromper o laço, feche o iterador com contextlib.aclosing).
+        Com `idle_timeout`, cada intervalo desse tamanho sem respostas faz um
+        ping(); se o roteador não responder, a iteração termina com
+        RouterOsFatalError em vez de esperar para sempre.
+        """
+        async for reply, attrs in self._replies(command, attributes, queries, idle_timeout):
+            if reply == '!re':
+                yield attrs
+
+    async def follow(self, path, fields=None, idle_timeout=None):
+        """Assina as alterações de um menu: itera (evento, registro) sem prazo
+
+        Usa `print follow`, que envia primeiro todas as entradas e depois cada
+        inclusão/alteração; roteadores sem esse parâmetro caem em `listen`,
+        que só envia as alterações. Eventos: 'update' ou 'removed' (este só
+        com o id). Se nenhum dos dois existir, o !trap é propagado.
+        `idle_timeout` funciona como em stream().
+        """
+        path = path.rstrip('/')
+        proplist = {'proplist': ','.join(fields)} if fields else {}
+        received = False
+        try:
+            async for row in self._follow_rows(path + '/print', {'follow': '', **proplist}, idle_timeout):
+                received = True
+                yield row
+        except RouterOsTrapError as e:
+            if received:
+                raise
+            logger.info(f"print follow indisponível em {self.host} ({e}); usando listen")
+            async for row in self._follow_rows(path + '/listen', proplist, idle_timeout):
+                yield row
+
+    async def _follow_rows(self, command, attributes, idle_timeout):
+        async with contextlib.aclosing(self.stream(command, attributes, idle_timeout=idle_timeout)) as rows:
+            async for row in rows:
+                if row.pop('.dead', None) == 'true':
+                    yield 'removed', row
+                else:
+                    yield 'update', row
+
+    async def _done(self, command, attributes, queries):
+        done = {}
+        async for reply, attrs in self._replies(command, attributes, queries):
+            if reply == '!done':
+                done = attrs
+        return done
+
+    async def _collect(self, command, attributes, queries):
+        return [row async for row in self.stream(command, attributes, queries)]
+
+    async def _replies(self, command, attributes, queries, idle_timeout=None):
+        """Envia um comando com tag própria e itera (tipo, atributos) até o !done"""
+        if not self.connected:
+            raise self.error or RouterOsFatalError("Cliente não conectado")
+
+        self.next_tag += 1
+        tag = str(self.next_tag)
+        queue = self.pending[tag] = asyncio.Queue()
+        finished = False
+        trap = None
+
+        try:
+            await self._send([command, *attribute_words(attributes), *query_words(queries), f'.tag={tag}'])
+            while True:
+                try:
+                    item = await asyncio.wait_for(queue.get(), idle_timeout)
+                except asyncio.TimeoutError:
+                    await self.ping()
+                    continue
+                if isinstance(item, Exception):
+                    finished = True
+                    raise item
+
+                reply, attrs = item
+                if reply == '!trap':
+                    trap = trap or RouterOsTrapError(attrs.get('message', 'Erro desconhecido'), attrs.get('category'))
+                elif reply == '!done':
+                    finished = True
+                    if trap:
+                        raise trap
+                    yield reply, attrs
+                    return
+                else:
+                    yield reply, attrs
+        finally:
+            self.pending.pop(tag, None)
+            if not finished and self.connected:
+                # Consumidor desistiu (break, cancelamento ou prazo): para o comando no roteador
+                try:
+                    self.writer.write(encode_sentence(['/cancel', f'=tag={tag}'], self.encoding))
+                except Exception:
+                    pass
+
+    async def _send(self, words):
+        async with self.write_lock:
+            self.writer.write(encode_sentence(words, self.encoding))
+            await self.writer.drain()
+
+    async def _read_loop(self):
+        """Distribui as respostas do roteador para as filas das tags"""
+        try:
+            while True:
+                words = await read_sentence(self.reader, self.encoding)
+                reply, tag, attributes = parse_sentence(words)
+                if reply == '!fatal':
+                    # O motivo vem como palavra solta, sem '='
+                    raise RouterOsFatalError(words[1] if len(words) > 1 else "Conexão encerrada pelo roteador")
+
+                queue = self.pending.get(tag)
+                if queue is not None:
+                    queue.put_nowait((reply, attributes))
+        except asyncio.CancelledError:
+            raise
+        except asyncio.IncompleteReadError:
+            self._fail_pending(RouterOsFatalError("Conexão encerrada pelo roteador"))
+        except Exception as e:
+            self._fail_pending(e if isinstance(e, RouterOsError) else RouterOsFatalError(str(e)))
+
+    def _fail_pending(self, error):
+        self.error = error
+        for queue in self.pending.values():
+            queue.put_nowait(error)
+
+class AsyncRouterSessions:
+    """Conexões RouterOS por empresa mantidas abertas num único event loop
+
+    O loop roda numa thread própria, de modo que código síncrono (agendador,
+    rotas) pode disparar consultas a centenas de roteadores ao mesmo tempo
+    sem uma thread por roteador. Cada empresa mantém uma conexão entre
+    ciclos; conexões com erro ou com credenciais alteradas são refeitas.
+
+    Os alvos precisam dos atributos id, name, mikrotik_ip, mikrotik_username,
+    mikrotik_password e mikrotik_port (Company ou RouterTarget).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loop = None
+        self.clients = {}  # company_id -> (credenciais, AsyncRouterOsClient)
+        self.connect_locks = {}  # company_id -> asyncio.Lock (uma conexão sendo aberta por vez)
+
+    def run(self, coroutine, timeout=None):
+        """Executa uma corrotina no loop das sessões e espera o resultado"""
+        future = asyncio.run_coroutine_threadsafe(coroutine, self._ensure_loop())
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+
+    def fetch_all(self, targets, path, router_timeout=20, timeout=None, fields=None):
+        """Lista `path` (só os `fields`, se informados) em todos os roteadores ao mesmo tempo
+
+        Retorna {company_id: linhas ou exceção}; o prazo de cada roteador é
+        router_timeout e o do conjunto é timeout.
+        """
+        return self.run(self._fetch_all(targets, path, router_timeout, fields), timeout)
+
+    def close_all(self):
+        if self.loop is not None:
+            self.run(self._close_all())
+
+    def _ensure_loop(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self.loop.run_forever, name='routeros-async', daemon=True
+                ).start()
+            return self.loop
+
+    async def _fetch_all(self, targets, path, router_timeout, fields):
+        results = await asyncio.gather(
+            *(asyncio.wait_for(self._fetch(target, path, fields), router_timeout) for target in targets),
+            return_exceptions=True
+        )
+        return {target.id: result for target, result in zip(targets, results)}
+
+    async def _fetch(self, target, path, fields):
+        client = await self.client(target)
+        try:
+            return await client.get(path, fields)
+        except RouterOsTrapError:
+            # Comando recusado: a conexão continua válida
+            raise
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # O comando já foi cancelado no roteador (/cancel); a conexão só é
+            # descartada se nenhum outro comando (ex.: o follow do stream) a usa
+            if not client.pending:
+                await self._drop(target.id, client)
+            raise
+        except (RouterOsError, OSError):
+            await self._drop(target.id, client)
+            raise
+
+    async def client(self, target):
+        """Conexão aberta da empresa (reaproveitada entre chamadas; só dentro do loop)
+
+        Chamadas simultâneas para a mesma empresa esperam a mesma conexão em
+        vez de abrir uma cada.
+        """
+        credentials = (target.mikrotik_ip, target.mikrotik_username, target.mikrotik_password,
+                       target.mikrotik_port or 8728)
+        async with self.connect_locks.setdefault(target.id, asyncio.Lock()):
+            entry = self.clients.get(target.id)
+            if entry and entry[0] == credentials and entry[1].connected:
+                return entry[1]
+
+            await self._drop(target.id)
+            client = AsyncRouterOsClient(*credentials)
+            await client.connect()
+            self.clients[target.id] = (credentials, client)
+            logger.info(f"Sessão assíncrona aberta para empresa {target.name}")
+            return client
+
+    async def _drop(self, company_id, client=None):
+        """Fecha a conexão da empresa; com `client`, só se ela ainda for a registrada"""
+        entry = self.clients.get(company_id)
+        if entry and (client is None or entry[1] is client):
+            del self.clients[company_id]
+            client = entry[1]
+        if client:
+            await client.close()
+
+    async def _close_all(self):
+        for company_id in list(self.clients):
+            await self._drop(company_id)
+
+# Instância global usada pela coleta de uso
+router_sessions = AsyncRouterSessions()
@@ -2,9 +2,10 @@ import threading
 import time
 import schedule
 from logger import log_with_context, get_logger
-from services import UsageService, CreditService
+from services import UsageService, CreditService, LimitService
 from models import Company
-from config import get_current_datetime
+from services.usage_collector import usage_stream, router_targets
+from config import Config, get_current_datetime
 
 logger = get_logger(__name__)
 
@@ -12,6 +13,8 @@ class SchedulerService:
     def __init__(self, app=None):
         self.app = app
         self.scheduler_thread = None
+        self.stream_thread = None
+        self.stream_wakeup = threading.Event()
         self.running = False
     
     def start_scheduler(self):
@@ -24,7 +27,6 @@ class SchedulerService:
         
         # Configurar tarefas agendadas
         schedule.every(5).minutes.do(self._collect_usage_data)
-        schedule.every(1).hours.do(self._check_limits)
         schedule.every().day.at("00:00").do(self._daily_maintenance)
         schedule.every().day.at("00:01").do(self.reset_daily_credits)
         schedule.every(5).minutes.do(self.cleanup_old_usage_records)
@@ -34,12 +36,24 @@ class SchedulerService:
         self.scheduler_thread = threading.Thread(target=self._run_scheduler, daemon=True)
         self.scheduler_thread.start()
         
+        # O stream tem thread própria: uma coleta ou verificação de limites
+        # demorada não pode atrasar a gravação a cada poucos segundos
+        if Config.USAGE_STREAM_ENABLED:
+            self.stream_wakeup.clear()
+            self.stream_thread = threading.Thread(target=self._run_usage_stream, daemon=True)
+            self.stream_thread.start()
+        
         logger.info("Agendador iniciado com sucesso", task="scheduler_start")
     
     def stop_scheduler(self):
         """Para o agendador"""
         self.running = False
         schedule.clear()
+        self.stream_wakeup.set()
+        if self.stream_thread:
+            self.stream_thread.join()
+        if Config.USAGE_STREAM_ENABLED:
+            usage_stream.stop()
         if self.scheduler_thread:
             self.scheduler_thread.join()
         logger.info("Agendador parado", task="scheduler_stop")
@@ -56,25 +70,51 @@ class SchedulerService:
                            task="scheduler_error", error=str(e))
                 time.sleep(60)  # Espera 1 minuto em caso de erro
     
+    def _run_usage_stream(self):
+        """Grava o stream a cada USAGE_STREAM_FLUSH_INTERVAL segundos"""
+        while self.running:
+            started = time.monotonic()
+            self._process_usage_stream()
+            elapsed = time.monotonic() - started
+            self.stream_wakeup.wait(max(0, Config.USAGE_STREAM_FLUSH_INTERVAL - elapsed))
+    
     def _collect_usage_data(self):
         """Coleta dados de uso (executado a cada 5 minutos)"""
         try:
             with self.app.app_context():
-                UsageService.collect_usage_data()
-                logger.info("Dados de uso coletados pelo agendador", task="scheduled_usage_collection")
+                # Empresas recebidas pelo stream não precisam de polling
+                stats = UsageService.collect_usage_data(skip=usage_stream.streaming_companies())
+                logger.info(f"Dados de uso coletados pelo agendador: {stats['records']} registros de "
+                            f"{stats['succeeded']}/{stats['routers']} roteadores em {stats['elapsed']}s")
+            
+            # Os créditos acabaram de ser atualizados: aplicar os limites em seguida
+            self._check_limits()
         except Exception as e:
             logger.error(f"Erro ao coletar dados de uso: {str(e)}", 
                        task="scheduled_usage_collection", error=str(e))
     
+    def _process_usage_stream(self):
+        """Grava o uso recebido pelo stream e aplica os limites das empresas afetadas"""
+        try:
+            with self.app.app_context():
+                usage_stream.sync(router_targets())
+                result = usage_stream.flush()
+                
+                # Limites no roteador ficam com o ciclo de 5 minutos (_check_limits)
+                for company_id in result['companies']:
+                    LimitService.enforce_limits(company_id, push_limits=False)
+        except Exception as e:
+            logger.error(f"Erro ao processar stream de uso: {str(e)}")
+    
     def _check_limits(self):
-        """Verifica limites de usuários (executado a cada hora)"""
+        """Bloqueia/desbloqueia usuários pelos limites (executado após cada coleta)"""
         try:
             with self.app.app_context():
-                # Implementar verificação de limites
-                logger.info("Verificação de limites executada pelo agendador", task="scheduled_limit_check")
+                stats = LimitService.enforce_limits()
+                logger.info(f"Limites verificados pelo agendador: {stats['evaluated']} usuários "
+                            f"em {stats['elapsed']}s")
         except Exception as e:
-            logger.error(f"Erro ao verificar limites: {str(e)}", 
-                       task="scheduled_limit_check", error=str(e))
+            logger.error(f"Erro ao verificar limites: {str(e)}")
     
     def _daily_maintenance(self):
         """Manutenção diária (executado à meia-noite)"""
@@ -91,16 +131,14 @@ class SchedulerService:
         try:
             logger.info("Iniciando reset diário dos créditos")
             
-            companies = Company.query.filter_by(is_active=True).all()
-            
-            for company in companies:
-                success = CreditService.reset_daily_credits(company.id)
-                if success:
-                    logger.info(f"Créditos resetados para empresa {company.name}")
-                else:
-                    logger.error(f"Erro ao resetar créditos da empresa {company.name}")
+            # Todas as empresas ativas numa única passada
+            summary = CreditService.reset_daily_credits()
+            if summary is None:
+                logger.error("Erro ao resetar créditos diários")
+                return
             
-            logger.info("Reset diário dos créditos concluído")
+            logger.info(f"Reset diário dos créditos concluído: {summary['credits']} créditos "
+                        f"em {summary['elapsed']}s")
         except Exception as e:
             logger.error(f"Erro no reset diário: {e}")
     
@@ -137,6 +175,8 @@ class SchedulerService:
         try:
             if task_name == 'reset_credits':
                 self.reset_daily_credits()
+            elif task_name == 'check_limits':
+                self._check_limits()
             elif task_name == 'cleanup':
                 self.cleanup_old_usage_records()
             elif task_name == 'sync':
@@ -156,6 +196,7 @@ class SchedulerService:
         return {
             'running': self.running,
             'thread_alive': self.scheduler_thread.is_alive() if self.scheduler_thread else False,
+            'stream_thread_alive': self.stream_thread.is_alive() if self.stream_thread else False,
             'scheduled_jobs': len(schedule.jobs),
             'next_run': schedule.next_run() if schedule.jobs else None,
             'current_time': get_current_datetime()
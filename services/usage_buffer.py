@@ -0,0 +1,230 @@
+import atexit
+import threading
+import time
+from collections import deque
+from flask import current_app, has_app_context
+from sqlalchemy.orm import Session
+from models import db, Usage
+from services.usage_service import UsageService
+from config import Config
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+class UsageWriteBuffer:
+    """Fila em memória para registros de uso, gravada em lotes (write-behind)
+
+    `record()` só enfileira; uma thread de escrita grava a fila com
+    executemany (usage + daily_consumption numa transação) quando ela
+    atinge USAGE_BUFFER_BATCH_SIZE registros ou quando o registro mais
+    antigo passa de USAGE_BUFFER_FLUSH_INTERVAL segundos. Com a fila em
+    USAGE_BUFFER_MAX_SIZE, quem grava espera a próxima escrita
+    (backpressure) por até USAGE_BUFFER_PUT_TIMEOUT segundos.
+
+    Sem a thread iniciada (processos web, scripts, comandos), o próprio
+    chamador grava a fila quando ela completa um lote ou quando o registro
+    mais antigo passa do intervalo. Em qualquer caso, o que restar na fila
+    é gravado ao encerrar o processo (atexit). A gravação usa uma sessão
+    própria, sem confirmar nem desfazer a transação de quem chamou.
+
+    A coleta de uso (UsageCollector/UsageStream) grava seus lotes
+    diretamente e não passa por este buffer.
+    """
+
+    def __init__(self, batch_size=None, flush_interval=None, max_size=None, put_timeout=None):
+        self.batch_size = batch_size or Config.USAGE_BUFFER_BATCH_SIZE
+        self.flush_interval = flush_interval or Config.USAGE_BUFFER_FLUSH_INTERVAL
+        self.max_size = max_size or Config.USAGE_BUFFER_MAX_SIZE
+        self.put_timeout = Config.USAGE_BUFFER_PUT_TIMEOUT if put_timeout is None else put_timeout
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()  # um flush por vez
+        self.rows = deque()
+        self.inflight = 0  # registros do flush em andamento (ainda ocupam a fila)
+        self.oldest_at = None
+        self.app = None
+        self.thread = None
+        self.running = False
+        self.stats = {
+            'recorded': 0,
+            'written': 0,
+            'flushes': 0,
+            'failed_flushes': 0,
+            'backpressure_waits': 0,
+            'rejected': 0,
+            'max_depth': 0,
+            'last_flush_rows': 0,
+            'last_flush_latency': 0.0,
+            'max_flush_latency': 0.0,
+            'total_flush_latency': 0.0
+        }
+        atexit.register(self._flush_at_exit)
+
+    def start(self, app):
+        """Inicia a thread de escrita"""
+        if self.thread and self.thread.is_alive():
+            return
+
+        self.app = app
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='usage-buffer', daemon=True)
+        self.thread.start()
+        logger.info("Buffer de escrita de uso iniciado")
+
+    def stop(self):
+        """Para a thread de escrita e grava o que restou na fila"""
+        if not self.running:
+            return
+
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread:
+            self.thread.join(timeout=30)
+
+        with self.app.app_context():
+            self.flush()
+        logger.info("Buffer de escrita de uso parado")
+
+    def record(self, row):
+        """Enfileira um registro de uso; retorna False se a fila ficou cheia além do prazo"""
+        with self.condition:
+            if self.running and self._depth() >= self.max_size:
+                self.stats['backpressure_waits'] += 1
+                self.condition.notify_all()
+                if not self.condition.wait_for(
+                    lambda: self._depth() < self.max_size or not self.running, self.put_timeout
+                ):
+                    self.stats['rejected'] += 1
+                    logger.warning(f"Fila de uso cheia ({self._depth()} registros); registro descartado")
+                    return False
+
+            if not self.running and self.app is None and has_app_context():
+                # Aplicação usada para gravar a fila ao encerrar o processo
+                self.app = current_app._get_current_object()
+
+            first = self.oldest_at is None
+            self._append(row)
+            due = len(self.rows) >= self.batch_size
+            if self.running and (due or first):
+                # No primeiro registro a thread esperava sem prazo: recalcular
+                self.condition.notify_all()
+            elif not self.running:
+                due = due or time.monotonic() - self.oldest_at >= self.flush_interval
+
+        if due and not self.running:
+            self.flush()
+        return True
+
+    def flush(self):
+        """Grava toda a fila em lotes de executemany; retorna quantos registros foram gravados"""
+        with self.flush_lock:
+            with self.condition:
+                rows = list(self.rows)
+                self.rows.clear()
+                self.oldest_at = None
+                # O lote só libera espaço na fila depois de gravado
+                self.inflight = len(rows)
+
+            if not rows:
+                return 0
+
+            started = time.monotonic()
+            try:
+                with Session(db.engine) as session, session.begin():
+                    for start in range(0, len(rows), self.batch_size):
+                        batch = rows[start:start + self.batch_size]
+                        session.execute(db.insert(Usage), batch)
+                        UsageService.add_to_daily_rollup(batch, session=session)
+            except Exception as e:
+                logger.error(f"Erro ao gravar {len(rows)} registros de uso: {e}")
+                self._requeue(rows)
+                return 0
+
+            latency = time.monotonic() - started
+            with self.condition:
+                self.inflight = 0
+                self.condition.notify_all()
+                self.stats['written'] += len(rows)
+                self.stats['flushes'] += 1
+                self.stats['last_flush_rows'] = len(rows)
+                self.stats['last_flush_latency'] = round(latency, 4)
+                self.stats['max_flush_latency'] = round(max(self.stats['max_flush_latency'], latency), 4)
+                self.stats['total_flush_latency'] += latency
+
+            logger.debug(f"{len(rows)} registros de uso gravados em {latency:.3f}s")
+            return len(rows)
+
+    def get_stats(self):
+        """Profundidade da fila, latência de gravação e contadores"""
+        with self.condition:
+            stats = dict(self.stats)
+            stats['queue_depth'] = self._depth()
+            stats['oldest_age'] = round(time.monotonic() - self.oldest_at, 2) if self.oldest_at else 0.0
+            stats['running'] = self.running
+
+        total_latency = stats.pop('total_flush_latency')
+        stats['avg_flush_latency'] = round(total_latency / stats['flushes'], 4) if stats['flushes'] else 0.0
+        return stats
+
+    def _flush_at_exit(self):
+        """Grava o que restou na fila ao encerrar o processo (com ou sem a thread)"""
+        if self.running:
+            self.stop()
+            return
+
+        if not self.rows:
+            return
+        if self.app is None:
+            logger.error(f"{len(self.rows)} registros de uso não gravados: buffer sem aplicação")
+            return
+
+        with self.app.app_context():
+            self.flush()
+
+    def _append(self, row):
+        if not self.rows:
+            self.oldest_at = time.monotonic()
+        self.rows.append(row)
+        self.stats['recorded'] += 1
+        self.stats['max_depth'] = max(self.stats['max_depth'], self._depth())
+
+    def _depth(self):
+        return len(self.rows) + self.inflight
+
+    def _requeue(self, rows):
+        """Devolve à frente da fila um lote que falhou (o espaço dele continuava reservado)"""
+        with self.condition:
+            self.stats['failed_flushes'] += 1
+            self.inflight = 0
+            self.rows.extendleft(reversed(rows))
+            self.oldest_at = time.monotonic()
+
+    def _run(self):
+        """Grava a fila por tamanho ou por idade do registro mais antigo"""
+        while True:
+            with self.condition:
+                while self.running:
+                    if len(self.rows) >= self.batch_size:
+                        break
+                    if self.oldest_at is not None:
+                        remaining = self.flush_interval - (time.monotonic() - self.oldest_at)
+                        if remaining <= 0:
+                            break
+                    else:
+                        remaining = None
+                    self.condition.wait(remaining)
+
+                if not self.running:
+                    return
+
+            try:
+                with self.app.app_context():
+                    if not self.flush() and self.rows:
+                        # Banco indisponível: não tentar de novo em laço apertado
+                        time.sleep(self.flush_interval)
+            except Exception as e:
+                logger.error(f"Erro no buffer de escrita de uso: {e}")
+                time.sleep(self.flush_interval)
+
+# Instância global usada por UsageService.record_usage
+usage_buffer = UsageWriteBuffer()
@@ -0,0 +1,466 @@
+import asyncio
+import contextlib
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from models import db, Usage, SessionCheckpoint
+from services.mikrotik_service import MikroTikService, router_snapshots, HOTSPOT_ACTIVE_FIELDS
+from services.routeros_async import router_sessions, RouterOsTrapError
+from services.usage_service import UsageService
+from services.credit_service import CreditService
+from services.reference_cache import reference_cache
+from config import Config, get_current_datetime
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Cópia dos dados de conexão da empresa usada pelas threads de coleta,
+# para que nenhuma instância do SQLAlchemy saia da thread principal
+RouterTarget = namedtuple('RouterTarget', [
+    'id', 'name', 'mikrotik_ip', 'mikrotik_username', 'mikrotik_password', 'mikrotik_port'
+])
+
+class SessionTracker:
+    """Últimos contadores vistos por (empresa, sessão), com checkpoint no banco
+    
+    Os contadores de /ip/hotspot/active são cumulativos por sessão; o
+    rastreador converte cada leitura na diferença desde a anterior, de modo
+    que a tabela usage só recebe deltas e o consumo do dia é um SUM simples.
+    """
+    
+    def __init__(self):
+        self.sessions = {}  # (company_id, session_id) -> (username, bytes_in, bytes_out, uptime)
+        self.loaded = False
+        self.lock = threading.Lock()
+    
+    def load(self):
+        """Carrega o checkpoint do banco na primeira coleta do processo"""
+        if self.loaded:
+            return
+        
+        self.sessions = {
+            (cp.company_id, cp.session_id): (cp.username, cp.bytes_in, cp.bytes_out, cp.uptime)
+            for cp in SessionCheckpoint.query.all()
+        }
+        self.loaded = True
+    
+    def reset(self):
+        """Descarta o estado em memória (recarregado do checkpoint na próxima coleta)"""
+        self.sessions = {}
+        self.loaded = False
+    
+    def compute_deltas(self, company_id, sessions, timestamp):
+        """Calcula os deltas de uma empresa a partir da lista completa de sessões"""
+        seen = set()
+        rows = []
+        
+        for active in sessions:
+            key, row = self._delta(company_id, active, timestamp)
+            if key:
+                seen.add(key)
+            if row:
+                rows.append(row)
+        
+        # Sessões encerradas saem do estado
+        for key in [k for k in self.sessions if k[0] == company_id and k not in seen]:
+            del self.sessions[key]
+        
+        return rows
+    
+    def apply_events(self, company_id, updates, ended, timestamp):
+        """Calcula os deltas só das sessões alteradas (eventos do stream)
+        
+        `updates` são registros de /ip/hotspot/active e `ended` os ids das
+        sessões encerradas; as demais sessões da empresa ficam como estão.
+        """
+        rows = []
+        for active in updates:
+            _, row = self._delta(company_id, active, timestamp)
+            if row:
+                rows.append(row)
+        
+        for session_id in ended:
+            self.sessions.pop((company_id, session_id), None)
+        
+        return rows
+    
+    def _delta(self, company_id, active, timestamp):
+        """Atualiza o estado de uma sessão; retorna (chave, linha de delta ou None)"""
+        username = active.get('user')
+        session_id = active.get('id')
+        if not username or not session_id:
+            return None, None
+        
+        key = (company_id, session_id)
+        current = (
+            username,
+            int(active.get('bytes-in', 0) or 0),
+            int(active.get('bytes-out', 0) or 0),
+            MikroTikService.parse_duration(active.get('uptime'))
+        )
+        last = self.sessions.get(key)
+        
+        if (last is None or last[0] != username or
+                any(now < before for now, before in zip(current[1:], last[1:]))):
+            # Sessão nova ou contadores zerados (sessão reiniciada)
+            delta = current[1:]
+        else:
+            delta = tuple(now - before for now, before in zip(current[1:], last[1:]))
+        
+        self.sessions[key] = current
+        
+        if not any(delta):
+            return key, None
+        return key, {
+            'username': username,
+            'company_id': company_id,
+            'bytes_in': delta[0],
+            'bytes_out': delta[1],
+            'session_time': delta[2],
+            'session_id': session_id,
+            'timestamp': timestamp
+        }
+    
+    def save_checkpoint(self, company_ids):
+        """Regrava o checkpoint das empresas coletadas (sem commit)"""
+        if not company_ids:
+            return
+        
+        db.session.execute(
+            db.delete(SessionCheckpoint).where(SessionCheckpoint.company_id.in_(company_ids))
+        )
+        
+        company_ids = set(company_ids)
+        checkpoints = [
+            {
+                'company_id': company_id,
+                'session_id': session_id,
+                'username': username,
+                'bytes_in': bytes_in,
+                'bytes_out': bytes_out,
+                'uptime': uptime
+            }
+            for (company_id, session_id), (username, bytes_in, bytes_out, uptime) in self.sessions.items()
+            if company_id in company_ids
+        ]
+        if checkpoints:
+            db.session.execute(db.insert(SessionCheckpoint), checkpoints)
+
+# Estado global: os contadores precisam sobreviver entre ciclos de coleta
+session_tracker = SessionTracker()
+
+def router_targets(company_id=None, skip=()):
+    """Dados de conexão das empresas ativas (ou de uma empresa), exceto as de `skip`"""
+    return [
+        RouterTarget(c.id, c.name, c.mikrotik_ip, c.mikrotik_username,
+                     c.mikrotik_password, c.mikrotik_port)
+        for c in reference_cache.get_companies(active_only=True)
+        if (not company_id or c.id == company_id) and c.id not in skip
+    ]
+
+class UsageCollector:
+    """Coleta /ip/hotspot/active de todos os roteadores em paralelo"""
+
+    def __init__(self, max_workers=None, router_timeout=None, cycle_timeout=None, batch_size=None, use_async=None):
+        self.max_workers = max_workers or Config.USAGE_COLLECTION_MAX_WORKERS
+        self.router_timeout = router_timeout or Config.USAGE_COLLECTION_ROUTER_TIMEOUT
+        self.cycle_timeout = cycle_timeout or Config.USAGE_COLLECTION_CYCLE_TIMEOUT
+        self.batch_size = batch_size or Config.USAGE_COLLECTION_BATCH_SIZE
+        self.use_async = Config.USAGE_COLLECTION_ASYNC if use_async is None else use_async
+
+    def collect(self, company_id=None, skip=()):
+        """Executa um ciclo de coleta e grava os registros de uso em lotes
+
+        Empresas em `skip` (ex.: as que já chegam pelo stream) não são consultadas.
+        """
+        started = time.monotonic()
+
+        targets = router_targets(company_id, skip)
+
+        stats = {
+            'routers': len(targets),
+            'succeeded': 0,
+            'failed': 0,
+            'timed_out': 0,
+            'sessions': 0,
+            'records': 0,
+            'elapsed': 0.0
+        }
+
+        if not targets:
+            return stats
+
+        if self.use_async:
+            sessions_by_company = self._poll_routers_async(targets, stats)
+        else:
+            sessions_by_company = self._poll_routers(targets, stats)
+        stats['sessions'] = sum(len(sessions) for sessions in sessions_by_company.values())
+
+        with session_tracker.lock:
+            session_tracker.load()
+            rows = self._build_rows(sessions_by_company)
+            stats['records'] = self._write(rows, list(sessions_by_company))
+
+        stats['elapsed'] = round(time.monotonic() - started, 2)
+
+        logger.info(
+            f"Coleta concluída: {stats['succeeded']}/{stats['routers']} roteadores, "
+            f"{stats['records']} registros em {stats['elapsed']}s "
+            f"({stats['failed']} falhas, {stats['timed_out']} sem resposta)"
+        )
+        return stats
+
+    def _poll_routers(self, targets, stats):
+        """Consulta os roteadores em paralelo respeitando o prazo do ciclo"""
+        results = {}
+        executor = ThreadPoolExecutor(
+            max_workers=min(self.max_workers, len(targets)),
+            thread_name_prefix='usage-collector'
+        )
+
+        try:
+            futures = {executor.submit(self._poll_router, target): target for target in targets}
+            done, not_done = wait(futures, timeout=self.cycle_timeout)
+
+            for future in done:
+                target = futures[future]
+                try:
+                    results[target.id] = future.result()
+                    stats['succeeded'] += 1
+                except Exception as e:
+                    stats['failed'] += 1
+                    logger.error(f"Erro ao coletar uso da empresa {target.name}: {e}")
+
+            for future in not_done:
+                target = futures[future]
+                future.cancel()
+                stats['timed_out'] += 1
+                logger.warning(f"Coleta da empresa {target.name} excedeu o prazo do ciclo")
+        finally:
+            # Não espera roteadores travados: o ciclo termina dentro do prazo
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        return results
+
+    def _poll_routers_async(self, targets, stats):
+        """Consulta os roteadores pelas sessões assíncronas (um event loop, sem thread por roteador)"""
+        results = {}
+
+        try:
+            replies = router_sessions.fetch_all(
+                targets, '/ip/hotspot/active', self.router_timeout, self.cycle_timeout,
+                fields=HOTSPOT_ACTIVE_FIELDS
+            )
+        except FutureTimeoutError:
+            stats['timed_out'] += len(targets)
+            logger.warning(f"Coleta assíncrona de {len(targets)} roteadores excedeu o prazo do ciclo")
+            return results
+
+        for target in targets:
+            reply = replies[target.id]
+            if isinstance(reply, asyncio.TimeoutError):
+                stats['timed_out'] += 1
+                logger.warning(f"Coleta da empresa {target.name} excedeu o prazo do roteador")
+            elif isinstance(reply, BaseException):
+                stats['failed'] += 1
+                logger.error(f"Erro ao coletar uso da empresa {target.name}: {reply}")
+            else:
+                router_snapshots.put(target.id, '/ip/hotspot/active', reply)
+                results[target.id] = reply
+                stats['succeeded'] += 1
+
+        return results
+
+    def _poll_router(self, target):
+        """Obtém as sessões ativas de um roteador (executado em thread)
+
+        A lista lida também renova o snapshot de /ip/hotspot/active usado
+        pelas telas, que assim raramente precisam consultar o roteador.
+        """
+        with MikroTikService.session(target, timeout=self.router_timeout) as api:
+            sessions = MikroTikService.select(api, '/ip/hotspot/active', HOTSPOT_ACTIVE_FIELDS)
+        router_snapshots.put(target.id, '/ip/hotspot/active', sessions)
+        return sessions
+
+    def _build_rows(self, sessions_by_company):
+        """Converte as sessões ativas em linhas de delta da tabela usage"""
+        timestamp = get_current_datetime()
+        rows = []
+
+        for company_id, sessions in sessions_by_company.items():
+            rows.extend(session_tracker.compute_deltas(company_id, sessions, timestamp))
+
+        return rows
+
+    def _write(self, rows, company_ids):
+        """Grava deltas, daily_consumption, créditos e checkpoint numa única transação"""
+        try:
+            # Empresas e turmas usadas pelos créditos: conferir antes da primeira escrita
+            reference_cache.refresh()
+            
+            for start in range(0, len(rows), self.batch_size):
+                batch = rows[start:start + self.batch_size]
+                db.session.execute(db.insert(Usage), batch)
+                UsageService.add_to_daily_rollup(batch)
+                CreditService.apply_usage_deltas([
+                    (row['username'], row['company_id'], row['bytes_in'] + row['bytes_out'], row['session_time'])
+                    for row in batch
+                ])
+
+            session_tracker.save_checkpoint(company_ids)
+            db.session.commit()
+            return len(rows)
+        except Exception as e:
+            logger.error(f"Erro ao gravar registros de uso: {e}")
+            db.session.rollback()
+            # O estado em memória já avançou; recarregar do último checkpoint válido
+            session_tracker.reset()
+            return 0
+
+class UsageStream:
+    """Ingestão contínua de /ip/hotspot/active via follow/listen
+
+    Cada empresa assinada mantém um comando `print follow` (ou `listen`)
+    aberto na sessão assíncrona do seu roteador. Os eventos chegam no event
+    loop das sessões e só são guardados em memória; `flush()`, chamado pelo
+    agendador a cada USAGE_STREAM_FLUSH_INTERVAL segundos, converte-os em
+    deltas pelo mesmo SessionTracker da coleta e grava tudo numa transação.
+
+    Empresas cujo roteador não aceita follow nem listen, ou com a conexão
+    caída, não aparecem em streaming_companies() e continuam na coleta por
+    polling até a próxima tentativa. Uma conexão sem eventos por
+    USAGE_STREAM_IDLE_TIMEOUT segundos é testada com um ping; se o roteador
+    não responder (conexão meio aberta), a assinatura cai e a empresa volta
+    ao polling até reconectar.
+    """
+
+    def __init__(self, retry_interval=60, unsupported_retry_interval=3600, idle_timeout=None):
+        self.retry_interval = retry_interval
+        self.unsupported_retry_interval = unsupported_retry_interval
+        self.idle_timeout = idle_timeout or Config.USAGE_STREAM_IDLE_TIMEOUT
+        self.lock = threading.Lock()
+        self.subscriptions = {}  # company_id -> (RouterTarget, asyncio.Task); só acessado no loop
+        self.streaming = set()  # empresas com assinatura ativa
+        self.live = {}  # company_id -> {session_id: registro}
+        self.updates = {}  # company_id -> {session_id: registro} desde o último flush
+        self.ended = {}  # company_id -> {session_id} desde o último flush
+
+    def streaming_companies(self):
+        with self.lock:
+            return set(self.streaming)
+
+    def sync(self, targets):
+        """Assina as empresas de `targets` e encerra as demais assinaturas"""
+        router_sessions.run(self._sync(targets))
+
+    def stop(self):
+        router_sessions.run(self._sync([]))
+
+    def flush(self, collector=None):
+        """Grava os deltas recebidos desde o último flush
+
+        Retorna {'companies': empresas com novos registros, 'records': total}.
+        """
+        with self.lock:
+            updates, self.updates = self.updates, {}
+            ended, self.ended = self.ended, {}
+            snapshots = {
+                company_id: list(sessions.values())
+                for company_id, sessions in self.live.items() if company_id in self.streaming
+            }
+
+        # A lista mantida pelo stream serve de snapshot para as telas
+        for company_id, sessions in snapshots.items():
+            router_snapshots.put(company_id, '/ip/hotspot/active', sessions)
+
+        company_ids = list(updates.keys() | ended.keys())
+        if not company_ids:
+            return {'companies': [], 'records': 0}
+
+        timestamp = get_current_datetime()
+        with session_tracker.lock:
+            session_tracker.load()
+            rows = []
+            for company_id in company_ids:
+                rows.extend(session_tracker.apply_events(
+                    company_id, updates.get(company_id, {}).values(), ended.get(company_id, ()), timestamp
+                ))
+            records = (collector or UsageCollector())._write(rows, company_ids)
+
+        return {
+            'companies': sorted({row['company_id'] for row in rows}) if records else [],
+            'records': records
+        }
+
+    async def _sync(self, targets):
+        wanted = {target.id: target for target in targets}
+
+        for company_id, (target, task) in list(self.subscriptions.items()):
+            # Empresa removida/desativada ou com dados de conexão alterados
+            if wanted.get(company_id) != target:
+                task.cancel()
+                del self.subscriptions[company_id]
+
+        for company_id, target in wanted.items():
+            if company_id not in self.subscriptions:
+                task = asyncio.get_running_loop().create_task(self._subscribe(target))
+                self.subscriptions[company_id] = (target, task)
+
+    async def _subscribe(self, target):
+        """Mantém a assinatura de uma empresa, reabrindo-a após falhas"""
+        try:
+            while True:
+                try:
+                    client = await router_sessions.client(target)
+                    # Lista inicial: listen só envia alterações
+                    for active in await client.get('/ip/hotspot/active', HOTSPOT_ACTIVE_FIELDS):
+                        self._record(target.id, 'update', active)
+
+                    self._set_streaming(target.id, True)
+                    logger.info(f"Stream de uso da empresa {target.name} iniciado")
+                    async with contextlib.aclosing(
+                        client.follow('/ip/hotspot/active', HOTSPOT_ACTIVE_FIELDS, self.idle_timeout)
+                    ) as events:
+                        async for event, active in events:
+                            self._record(target.id, event, active)
+                    delay = self.retry_interval
+                except RouterOsTrapError as e:
+                    logger.warning(f"Roteador da empresa {target.name} não aceita follow/listen ({e}); "
+                                   f"mantendo coleta por polling")
+                    delay = self.unsupported_retry_interval
+                except Exception as e:
+                    logger.warning(f"Stream de uso da empresa {target.name} interrompido: {e}")
+                    delay = self.retry_interval
+
+                self._set_streaming(target.id, False)
+                await asyncio.sleep(delay)
+        finally:
+            self._set_streaming(target.id, False)
+
+    def _record(self, company_id, event, active):
+        session_id = active.get('id')
+        if not session_id:
+            return
+
+        with self.lock:
+            live = self.live.setdefault(company_id, {})
+            if event == 'removed':
+                live.pop(session_id, None)
+                self.ended.setdefault(company_id, set()).add(session_id)
+            else:
+                # follow pode enviar só os campos alterados
+                active = {**live.get(session_id, {}), **active}
+                live[session_id] = active
+                self.updates.setdefault(company_id, {})[session_id] = active
+
+    def _set_streaming(self, company_id, streaming):
+        with self.lock:
+            if streaming:
+                self.streaming.add(company_id)
+            else:
+                self.streaming.discard(company_id)
+                self.live.pop(company_id, None)
+
+# Instância global: as assinaturas vivem no loop das sessões assíncronas
+usage_stream = UsageStream()
@@ -1,34 +1,227 @@
-from models import db, Usage, Company
+import csv
+import gzip
+import os
+import time
+from models import db, Usage, Company, DailyConsumption
+from models.sql import upsert_insert
 from datetime import datetime, timedelta
 from logger import get_logger
-from config import get_current_datetime
+from config import Config, get_current_datetime
 
 logger = get_logger(__name__)
 
 class UsageService:
     @staticmethod
     def record_usage(username, company_id, bytes_in=0, bytes_out=0, session_time=0, session_id=None):
-        """Registra uso de um usuário"""
+        """Registra uso de um usuário
+        
+        O registro entra no buffer de escrita e é gravado em lote com os
+        demais (ver services.usage_buffer). Retorna False se a fila continuar
+        cheia após USAGE_BUFFER_PUT_TIMEOUT segundos.
+        """
+        from services.usage_buffer import usage_buffer
+        
+        return usage_buffer.record({
+            'username': username,
+            'company_id': company_id,
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+            'session_time': session_time,
+            'session_id': session_id,
+            'timestamp': get_current_datetime()
+        })
+    
+    @staticmethod
+    def collect_usage_data(company_id=None, skip=()):
+        """Coleta o uso de todos os roteadores ativos (ou de uma empresa), exceto os de `skip`"""
+        from services.usage_collector import UsageCollector
+        
+        return UsageCollector().collect(company_id, skip)
+    
+    @staticmethod
+    def period_start(period, today=None):
+        """Primeiro dia de um período ('day', 'week' ou 'month') terminado em `today`"""
+        if today is None:
+            today = get_current_datetime().date()
+        
+        if period == 'week':
+            return today - timedelta(days=7)
+        if period == 'month':
+            return today.replace(day=1)
+        return today
+    
+    @staticmethod
+    def timestamp_range(start_date, end_date=None):
+        """Converte dias (inclusivos) no intervalo semiaberto [início, fim) de timestamps
+        
+        Comparar Usage.timestamp diretamente com os limites permite usar os
+        índices; filtros como func.date(Usage.timestamp) == dia varrem a tabela.
+        """
+        if end_date is None:
+            end_date = start_date
+        
+        start = datetime.combine(start_date, datetime.min.time())
+        end = datetime.combine(end_date + timedelta(days=1), datetime.min.time())
+        return start, end
+    
+    @staticmethod
+    def period_filter(company_id, start_date, end_date=None, username=None):
+        """Critérios de Usage para uma empresa (e usuário) entre dois dias inclusivos"""
+        start, end = UsageService.timestamp_range(start_date, end_date)
+        
+        criteria = [
+            Usage.company_id == company_id,
+            Usage.timestamp >= start,
+            Usage.timestamp < end
+        ]
+        if username:
+            criteria.append(Usage.username == username)
+        
+        return criteria
+    
+    @staticmethod
+    def add_to_daily_rollup(rows, session=None):
+        """Soma registros de uso na tabela daily_consumption (sem commit)
+        
+        Deve ser chamado na mesma transação que insere os registros em usage;
+        `session` é a sessão dessa transação (padrão: db.session).
+        """
+        totals = {}
+        for row in rows:
+            key = (row['company_id'], row['username'], row['timestamp'].date())
+            total = totals.setdefault(key, {
+                'company_id': key[0],
+                'username': key[1],
+                'date': key[2],
+                'bytes_in': 0,
+                'bytes_out': 0,
+                'session_time': 0,
+                'records': 0
+            })
+            total['bytes_in'] += row.get('bytes_in') or 0
+            total['bytes_out'] += row.get('bytes_out') or 0
+            total['session_time'] += row.get('session_time') or 0
+            total['records'] += 1
+        
+        if not totals:
+            return
+        
+        stmt = upsert_insert(DailyConsumption)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['company_id', 'username', 'date'],
+            set_={
+                'bytes_in': DailyConsumption.bytes_in + stmt.excluded.bytes_in,
+                'bytes_out': DailyConsumption.bytes_out + stmt.excluded.bytes_out,
+                'session_time': DailyConsumption.session_time + stmt.excluded.session_time,
+                'records': DailyConsumption.records + stmt.excluded.records
+            }
+        )
+        (session or db.session).execute(stmt, list(totals.values()))
+    
+    @staticmethod
+    def rebuild_daily_rollup(start_date=None, end_date=None, company_id=None):
+        """Recalcula daily_consumption a partir da tabela usage
+        
+        Sem datas, reconstrói todo o histórico. Retorna o número de linhas geradas.
+        """
         try:
-            usage = Usage(
-                username=username,
-                company_id=company_id,
-                bytes_in=bytes_in,
-                bytes_out=bytes_out,
-                session_time=session_time,
-                session_id=session_id,
-                timestamp=get_current_datetime()
-            )
+            usage_filters = []
+            rollup_filters = []
+            
+            if start_date:
+                usage_filters.append(Usage.timestamp >= UsageService.timestamp_range(start_date)[0])
+                rollup_filters.append(DailyConsumption.date >= start_date)
+            if end_date:
+                usage_filters.append(Usage.timestamp < UsageService.timestamp_range(end_date)[1])
+                rollup_filters.append(DailyConsumption.date <= end_date)
+            if company_id:
+                usage_filters.append(Usage.company_id == company_id)
+                rollup_filters.append(DailyConsumption.company_id == company_id)
             
-            db.session.add(usage)
+            db.session.execute(db.delete(DailyConsumption).where(*rollup_filters))
+            
+            usage_date = db.func.date(Usage.timestamp)
+            aggregated = db.select(
+                Usage.company_id,
+                Usage.username,
+                usage_date,
+                db.func.sum(Usage.bytes_in),
+                db.func.sum(Usage.bytes_out),
+                db.func.coalesce(db.func.sum(Usage.session_time), 0),
+                db.func.count(Usage.id)
+            ).where(*usage_filters).group_by(Usage.company_id, Usage.username, usage_date)
+            
+            result = db.session.execute(
+                db.insert(DailyConsumption).from_select(
+                    ['company_id', 'username', 'date', 'bytes_in', 'bytes_out', 'session_time', 'records'],
+                    aggregated
+                )
+            )
             db.session.commit()
             
-            logger.info(f"Uso registrado para {username}: {bytes_in + bytes_out} bytes")
-            return True
+            logger.info(f"Consumo diário recalculado: {result.rowcount} linhas")
+            return result.rowcount
         except Exception as e:
-            logger.error(f"Erro ao registrar uso: {e}")
+            logger.error(f"Erro ao recalcular consumo diário: {e}")
             db.session.rollback()
-            return False
+            return 0
+    
+    @staticmethod
+    def get_daily_rollup(company_id, start_date, end_date, username=None):
+        """Totais por dia lidos de daily_consumption (uma linha por dia com uso)"""
+        query = db.session.query(
+            DailyConsumption.date,
+            db.func.sum(DailyConsumption.bytes_in).label('bytes_in'),
+            db.func.sum(DailyConsumption.bytes_out).label('bytes_out'),
+            db.func.sum(DailyConsumption.session_time).label('session_time'),
+            db.func.count(DailyConsumption.username).label('unique_users')
+        ).filter(
+            DailyConsumption.company_id == company_id,
+            DailyConsumption.date >= start_date,
+            DailyConsumption.date <= end_date
+        )
+        
+        if username:
+            query = query.filter(DailyConsumption.username == username)
+        
+        return {
+            row.date: {
+                'bytes_in': row.bytes_in or 0,
+                'bytes_out': row.bytes_out or 0,
+                'total_bytes': (row.bytes_in or 0) + (row.bytes_out or 0),
+                'session_time': row.session_time or 0,
+                'unique_users': row.unique_users
+            }
+            for row in query.group_by(DailyConsumption.date).all()
+        }
+    
+    @staticmethod
+    def daily_series(company_id, start_date, end_date, username=None):
+        """Série diária de consumo entre dois dias inclusivos, com zeros nos dias sem uso
+        
+        Uma única consulta agrupada em daily_consumption, independente do
+        número de dias.
+        """
+        daily_totals = UsageService.get_daily_rollup(company_id, start_date, end_date, username=username)
+        
+        series = []
+        current_date = start_date
+        while current_date <= end_date:
+            totals = daily_totals.get(current_date, {})
+            total_bytes = totals.get('total_bytes', 0)
+            
+            series.append({
+                'date': current_date,
+                'bytes_in': totals.get('bytes_in', 0),
+                'bytes_out': totals.get('bytes_out', 0),
+                'total_bytes': total_bytes,
+                'total_mb': round(total_bytes / (1024 * 1024), 2),
+                'session_time': totals.get('session_time', 0),
+                'unique_users': totals.get('unique_users', 0)
+            })
+            current_date += timedelta(days=1)
+        
+        return series
     
     @staticmethod
     def get_user_daily_consumption(username, company_id, date=None):
@@ -37,20 +230,14 @@ class UsageService:
             date = get_current_datetime().date()
         
         try:
-            # Buscar registros do dia
-            start_datetime = datetime.combine(date, datetime.min.time())
-            end_datetime = datetime.combine(date, datetime.max.time())
-            
-            usage_records = Usage.query.filter(
-                Usage.username == username,
-                Usage.company_id == company_id,
-                Usage.timestamp >= start_datetime,
-                Usage.timestamp <= end_datetime
-            ).all()
+            # Os registros de uso são deltas: o consumo do dia é a soma simples
+            total_bytes_in, total_bytes_out = db.session.query(
+                db.func.coalesce(db.func.sum(Usage.bytes_in), 0),
+                db.func.coalesce(db.func.sum(Usage.bytes_out), 0)
+            ).filter(
+                *UsageService.period_filter(company_id, date, username=username)
+            ).one()
             
-            total_bytes_in = sum(record.bytes_in for record in usage_records)
-            total_bytes_out = sum(record.bytes_out for record in usage_records)
-            total_session_time = sum(record.session_time for record in usage_records)
             total_bytes = total_bytes_in + total_bytes_out
             total_mb = total_bytes / (1024 * 1024)
             
@@ -101,24 +288,20 @@ class UsageService:
             date = get_current_datetime().date()
         
         try:
-            start_datetime = datetime.combine(date, datetime.min.time())
-            end_datetime = datetime.combine(date, datetime.max.time())
-            
-            usage_records = Usage.query.filter(
-                Usage.company_id == company_id,
-                Usage.timestamp >= start_datetime,
-                Usage.timestamp <= end_datetime
-            ).all()
-            
-            total_bytes = sum(record.bytes_in + record.bytes_out for record in usage_records)
-            total_session_time = sum(record.session_time for record in usage_records)
-            unique_users = len(set(record.username for record in usage_records))
+            total_bytes, total_session_time, unique_users, total_records = db.session.query(
+                db.func.coalesce(db.func.sum(Usage.bytes_in + Usage.bytes_out), 0),
+                db.func.coalesce(db.func.sum(Usage.session_time), 0),
+                db.func.count(db.distinct(Usage.username)),
+                db.func.count(Usage.id)
+            ).filter(
+                *UsageService.period_filter(company_id, date)
+            ).one()
             
             return {
                 'total_bytes': total_bytes,
                 'total_session_time': total_session_time,
                 'unique_users': unique_users,
-                'total_records': len(usage_records)
+                'total_records': total_records
             }
         except Exception as e:
             logger.error(f"Erro ao obter consumo da empresa: {e}")
@@ -162,21 +345,73 @@ class UsageService:
             return []
     
     @staticmethod
-    def cleanup_old_records(days_to_keep=90):
-        """Remove registros antigos"""
+    def cleanup_old_records(days_to_keep=90, batch_size=None, pause=None, archive=None):
+        """Remove registros antigos em lotes
+        
+        Cada lote é um DELETE por id com commit próprio, seguido de uma pausa
+        curta, para que o banco não fique bloqueado durante toda a limpeza.
+        Com arquivamento ativo, os registros são gravados num CSV compactado
+        antes de serem removidos.
+        """
+        batch_size = batch_size or Config.USAGE_CLEANUP_BATCH_SIZE
+        pause = Config.USAGE_CLEANUP_BATCH_PAUSE if pause is None else pause
+        archive = Config.USAGE_ARCHIVE_ENABLED if archive is None else archive
+        
+        cutoff_date = get_current_datetime() - timedelta(days=days_to_keep)
+        columns = list(Usage.__table__.c) if archive else [Usage.id]
+        archive_file = archive_writer = None
+        count = 0
+        
         try:
-            cutoff_date = get_current_datetime() - timedelta(days=days_to_keep)
-            
-            old_records = Usage.query.filter(Usage.timestamp < cutoff_date).all()
-            count = len(old_records)
+            while True:
+                rows = db.session.execute(
+                    db.select(*columns)
+                    .where(Usage.timestamp < cutoff_date)
+                    .order_by(Usage.timestamp)
+                    .limit(batch_size)
+                ).all()
+                if not rows:
+                    break
+                
+                if archive:
+                    if archive_file is None:
+                        archive_file, archive_writer = UsageService._open_archive(cutoff_date)
+                    archive_writer.writerows(row._asdict() for row in rows)
+                    archive_file.flush()
+                
+                db.session.execute(
+                    db.delete(Usage).where(Usage.id.in_([row.id for row in rows]))
+                )
+                db.session.commit()
+                count += len(rows)
+                
+                if len(rows) < batch_size:
+                    break
+                if pause:
+                    time.sleep(pause)
             
-            for record in old_records:
-                db.session.delete(record)
-            
-            db.session.commit()
             logger.info(f"Removidos {count} registros antigos")
             return count
         except Exception as e:
             logger.error(f"Erro ao limpar registros antigos: {e}")
             db.session.rollback()
-            return 0
+            return count
+        finally:
+            if archive_file is not None:
+                archive_file.close()
+    
+    @staticmethod
+    def _open_archive(cutoff_date):
+        """Abre um CSV compactado para os registros removidos nesta limpeza"""
+        os.makedirs(Config.USAGE_ARCHIVE_DIRECTORY, exist_ok=True)
+        filename = os.path.join(
+            Config.USAGE_ARCHIVE_DIRECTORY,
+            f"usage_ate_{cutoff_date.strftime('%Y%m%d')}_{get_current_datetime().strftime('%Y%m%d%H%M%S')}.csv.gz"
+        )
+        
+        archive_file = gzip.open(filename, 'wt', newline='', encoding='utf-8')
+        writer = csv.DictWriter(archive_file, fieldnames=[column.name for column in Usage.__table__.c])
+        writer.writeheader()
+        
+        logger.info(f"Arquivando registros removidos em: {filename}")
+        return archive_file, writer
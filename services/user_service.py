@@ -1,5 +1,7 @@
+import time
 from models import db, User, Company, OriginalProfile
 from services.mikrotik_service import MikroTikService
+from services.reference_cache import reference_cache
 from logger import get_logger
 from werkzeug.security import generate_password_hash
 
@@ -41,7 +43,7 @@ class UserService:
     def create_hotspot_user(company_id, username, password, profile='default'):
         """Cria um usuário hotspot"""
         try:
-            company = Company.query.get(company_id)
+            company = reference_cache.get_company(company_id)
             if not company:
                 logger.error(f"Empresa {company_id} não encontrada")
                 return False
@@ -92,7 +94,7 @@ class UserService:
     def block_hotspot_user(company_id, username, reason="Limite excedido"):
         """Bloqueia um usuário hotspot"""
         try:
-            company = Company.query.get(company_id)
+            company = reference_cache.get_company(company_id)
             if not company:
                 return False
             
@@ -123,7 +125,7 @@ class UserService:
     def unblock_hotspot_user(company_id, username):
         """Desbloqueia um usuário hotspot"""
         try:
-            company = Company.query.get(company_id)
+            company = reference_cache.get_company(company_id)
             if not company:
                 return False
             
@@ -150,6 +152,78 @@ class UserService:
             db.session.rollback()
             return False
     
+    @staticmethod
+    def block_hotspot_users(company_id, usernames, reason="Limite excedido"):
+        """Bloqueia vários usuários hotspot numa única conexão; retorna {username: sucesso}"""
+        return UserService.apply_hotspot_changes(company_id, {
+            username: ({'disabled': 'true'}, {'is_blocked': True, 'blocked_reason': reason})
+            for username in usernames
+        })
+    
+    @staticmethod
+    def unblock_hotspot_users(company_id, usernames):
+        """Desbloqueia vários usuários hotspot numa única conexão; retorna {username: sucesso}"""
+        return UserService.apply_hotspot_changes(company_id, {
+            username: ({'disabled': 'false'}, {'is_blocked': False, 'blocked_reason': None})
+            for username in usernames
+        })
+    
+    @staticmethod
+    def change_hotspot_users_profile(company_id, usernames, new_profile):
+        """Altera o perfil de vários usuários hotspot numa única conexão; retorna {username: sucesso}"""
+        return UserService.apply_hotspot_changes(company_id, {
+            username: ({'profile': new_profile}, {'current_profile': new_profile})
+            for username in usernames
+        })
+    
+    @staticmethod
+    def apply_hotspot_changes(company_id, changes):
+        """Aplica alterações em lote no roteador e em OriginalProfile
+        
+        `changes` é {username: (propriedades no roteador, campos de OriginalProfile)}.
+        O roteador é alterado numa única conexão do pool e os perfis dos
+        usuários alterados com sucesso são gravados numa única transação
+        (criados quando ainda não existem). Retorna {username: sucesso}.
+        """
+        results = {username: False for username in changes}
+        company = reference_cache.get_company(company_id)
+        if not company or not changes:
+            return results
+        
+        results = MikroTikService.update_users(
+            company, {username: properties for username, (properties, _) in changes.items()}
+        )
+        changed = [username for username, success in results.items() if success]
+        if not changed:
+            return results
+        
+        try:
+            profiles = {
+                profile.username: profile
+                for profile in OriginalProfile.query.filter(
+                    OriginalProfile.company_id == company_id,
+                    OriginalProfile.username.in_(changed)
+                )
+            }
+            
+            for username in changed:
+                profile = profiles.get(username)
+                if not profile:
+                    profile = OriginalProfile(username=username, company_id=company_id)
+                    db.session.add(profile)
+                
+                for field, value in changes[username][1].items():
+                    setattr(profile, field, value)
+            
+            db.session.commit()
+        except Exception as e:
+            # O roteador já foi alterado; só o registro local ficou para trás
+            logger.error(f"Erro ao gravar perfis dos usuários da empresa {company.name}: {e}")
+            db.session.rollback()
+        
+        logger.info(f"{len(changed)}/{len(changes)} usuários alterados em lote na empresa {company.name}")
+        return results
+    
     @staticmethod
     def get_user_status(company_id, username):
         """Obtém status de um usuário"""
@@ -175,41 +249,80 @@ class UserService:
     
     @staticmethod
     def sync_hotspot_users(company_id):
-        """Sincroniza usuários do hotspot com o banco"""
+        """Sincroniza usuários do hotspot com o banco
+        
+        Carrega os perfis da empresa numa consulta, compara com a lista do
+        roteador em memória e aplica as diferenças em lote: usuários novos são
+        inseridos, removidos do roteador são apagados e mudanças de perfil
+        atualizam current_profile. Retorna um resumo ou None em caso de erro.
+        """
+        started = time.monotonic()
         try:
-            company = Company.query.get(company_id)
+            company = reference_cache.get_company(company_id)
             if not company:
-                return False
+                return None
+            
+            # Obter usuários do MikroTik (um erro aqui não pode parecer "nenhum usuário");
+            # a sincronização sempre lê o roteador, ignorando o snapshot em cache
+            router_profiles = {
+                user['name']: user.get('profile', 'default')
+                for user in MikroTikService.list_hotspot_users(company, max_age=0)
+                if user.get('name')
+            }
+            fetched = time.monotonic()
             
-            # Obter usuários do MikroTik
-            mikrotik_users = MikroTikService.get_hotspot_users(company)
+            existing = {
+                row.username: row
+                for row in db.session.query(
+                    OriginalProfile.id, OriginalProfile.username, OriginalProfile.current_profile
+                ).filter(OriginalProfile.company_id == company_id)
+            }
             
-            synced_count = 0
-            for user in mikrotik_users:
-                username = user.get('name')
-                profile = user.get('profile', 'default')
-                
-                # Verificar se já existe no banco
-                existing_profile = OriginalProfile.query.filter_by(
-                    username=username,
-                    company_id=company_id
-                ).first()
-                
-                if not existing_profile:
-                    # Criar novo perfil
-                    new_profile = OriginalProfile(
-                        username=username,
-                        company_id=company_id,
-                        original_profile=profile,
-                        current_profile=profile
-                    )
-                    db.session.add(new_profile)
-                    synced_count += 1
+            added = router_profiles.keys() - existing.keys()
+            removed = existing.keys() - router_profiles.keys()
+            changed = [
+                username for username in router_profiles.keys() & existing.keys()
+                if existing[username].current_profile != router_profiles[username]
+            ]
+            
+            if added:
+                db.session.execute(db.insert(OriginalProfile), [
+                    {
+                        'username': username,
+                        'company_id': company_id,
+                        'original_profile': router_profiles[username],
+                        'current_profile': router_profiles[username]
+                    }
+                    for username in added
+                ])
+            if removed:
+                db.session.execute(db.delete(OriginalProfile).where(
+                    OriginalProfile.id.in_([existing[username].id for username in removed])
+                ))
+            if changed:
+                db.session.execute(db.update(OriginalProfile), [
+                    {'id': existing[username].id, 'current_profile': router_profiles[username]}
+                    for username in changed
+                ])
             
             db.session.commit()
-            logger.info(f"Sincronizados {synced_count} usuários para empresa {company.name}")
-            return True
+            
+            summary = {
+                'router_users': len(router_profiles),
+                'added': len(added),
+                'removed': len(removed),
+                'changed': len(changed),
+                'unchanged': len(router_profiles) - len(added) - len(changed),
+                'fetch_time': round(fetched - started, 3),
+                'apply_time': round(time.monotonic() - fetched, 3)
+            }
+            logger.info(
+                f"Usuários sincronizados para empresa {company.name}: {summary['added']} novos, "
+                f"{summary['removed']} removidos, {summary['changed']} alterados "
+                f"({summary['fetch_time']}s roteador, {summary['apply_time']}s banco)"
+            )
+            return summary
         except Exception as e:
             logger.error(f"Erro ao sincronizar usuários: {e}")
             db.session.rollback()
-            return False
+            return None
@@ -0,0 +1,79 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from models import db, Company, HotspotClass, Credit
+from services import credit_service
+from services.credit_service import CreditService
+from services.reference_cache import reference_cache
+
+TODAY = date(2026, 3, 10)
+YESTERDAY = TODAY - timedelta(days=1)
+MB = 1024 * 1024
+
+@pytest.fixture
+def company(app, monkeypatch):
+    monkeypatch.setattr(credit_service, 'get_current_datetime', lambda: datetime(2026, 3, 10, 0, 0, 30))
+
+    company = Company(name='Empresa', mikrotik_ip='10.0.0.1', mikrotik_username='admin',
+                      mikrotik_password='secret', is_active=True)
+    db.session.add(company)
+    db.session.flush()
+    db.session.add(HotspotClass(name='Turma', company_id=company.id, daily_limit_mb=100, is_active=True))
+    db.session.commit()
+    reference_cache.invalidate()
+    return company
+
+def add_yesterday_credit(company, class_id, used_mb):
+    credit = Credit(username='ana', company_id=company.id, class_id=class_id, date=YESTERDAY,
+                    total_available_mb=100, used_mb=used_mb, accumulated_credit_mb=0)
+    db.session.add(credit)
+    db.session.commit()
+
+def today_credits():
+    return Credit.query.filter_by(username='ana', date=TODAY).all()
+
+def test_rollover_after_usage_keeps_usage_and_carries_credit(company):
+    class_id = reference_cache.get_active_class(company.id).id
+    add_yesterday_credit(company, class_id, used_mb=30)
+
+    # Uso coletado entre 00:00 e o reset cria o crédito de hoje sem acumulado
+    CreditService.apply_usage_deltas([('ana', company.id, 5 * MB, 60)])
+    db.session.commit()
+    assert today_credits()[0].accumulated_credit_mb == 0
+
+    summary = CreditService.reset_daily_credits()
+    assert summary['credits'] == 1
+
+    credits = today_credits()
+    assert len(credits) == 1
+    assert credits[0].accumulated_credit_mb == 70
+    assert credits[0].total_available_mb == 100
+    assert credits[0].used_mb == 5
+    assert credits[0].used_time == 60
+    assert credits[0].remaining_mb == 165
+
+def test_rollover_is_idempotent_and_usage_keeps_accumulating(company):
+    class_id = reference_cache.get_active_class(company.id).id
+    add_yesterday_credit(company, class_id, used_mb=40)
+
+    CreditService.reset_daily_credits()
+    CreditService.reset_daily_credits()
+    CreditService.apply_usage_deltas([('ana', company.id, 2 * MB, 0)])
+    db.session.commit()
+
+    credits = today_credits()
+    assert len(credits) == 1
+    assert credits[0].accumulated_credit_mb == 60
+    assert credits[0].used_mb == 2
+
+def test_rollover_without_class_does_not_duplicate(company):
+    add_yesterday_credit(company, None, used_mb=100)
+
+    CreditService.reset_daily_credits()
+    CreditService.reset_daily_credits()
+
+    credits = today_credits()
+    assert len(credits) == 1
+    assert credits[0].class_id is None
+    assert credits[0].accumulated_credit_mb == 0
@@ -0,0 +1,47 @@
+from datetime import datetime
+
+import pytest
+
+from models import db, Company, Usage
+from services.reference_cache import ReferenceCache
+
+@pytest.fixture
+def company(app):
+    company = Company(name='Empresa', mikrotik_ip='10.0.0.1', mikrotik_username='admin',
+                      mikrotik_password='secret', is_active=True)
+    db.session.add(company)
+    db.session.commit()
+    return company
+
+def insert_usage(company_id):
+    db.session.execute(db.insert(Usage), [{
+        'username': 'ana', 'company_id': company_id, 'bytes_in': 1, 'bytes_out': 1,
+        'session_time': 0, 'timestamp': datetime(2026, 3, 10, 12, 0)
+    }])
+
+def rename_elsewhere(company_id, name):
+    """Altera a empresa e a versão como outro processo faria"""
+    db.session.execute(db.update(Company).where(Company.id == company_id).values(name=name))
+    db.session.commit()
+    ReferenceCache().invalidate()
+
+def test_reload_waits_for_caller_transaction(company):
+    cache = ReferenceCache(check_interval=0)
+    cache.refresh()
+    rename_elsewhere(company.id, 'Outra')
+
+    insert_usage(company.id)
+    assert cache.get_company(company.id).name == 'Empresa'
+    db.session.commit()
+
+    assert Usage.query.count() == 1
+    assert cache.get_company(company.id).name == 'Outra'
+
+def test_first_load_inside_transaction_keeps_pending_writes(company):
+    cache = ReferenceCache()
+
+    insert_usage(company.id)
+    assert cache.get_company(company.id).name == 'Empresa'
+    db.session.commit()
+
+    assert Usage.query.count() == 1
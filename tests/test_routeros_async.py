@@ -0,0 +1,339 @@
+import asyncio
+import binascii
+import contextlib
+import hashlib
+from types import SimpleNamespace
+
+import pytest
+
+from services import usage_collector
+from services.routeros_async import (
+    AsyncRouterOsClient, AsyncRouterSessions, RouterOsFatalError, RouterOsTrapError,
+    encode_length, encode_sentence, read_length, read_sentence
+)
+from services.usage_collector import UsageStream
+
+PASSWORD = 'segredo'
+CHALLENGE = b'0123456789abcdef'
+
+class FakeRouter:
+    """Servidor mínimo da API do RouterOS para os testes
+
+    Responde /login (texto ou desafio MD5), print com consultas, .proplist e
+    follow, listen, /cancel e comandos desconhecidos (!trap). Cada sentença
+    recebida fica em `sentences`; com `mute` o servidor para de responder,
+    como numa conexão meio aberta.
+    """
+
+    def __init__(self, menus, legacy=False, delays=None):
+        self.menus = menus
+        self.legacy = legacy
+        self.delays = delays or {}
+        self.sentences = []
+        self.connections = 0
+        self.mute = False
+        self.followers = []  # (writer, tag) de print follow/listen em andamento
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        for writer, _ in self.followers:
+            writer.close()
+        await self.server.wait_closed()
+
+    def client(self, password=PASSWORD, timeout=5):
+        return AsyncRouterOsClient('127.0.0.1', 'admin', password, port=self.port, timeout=timeout)
+
+    def target(self, company_id=1):
+        return SimpleNamespace(id=company_id, name='Empresa', mikrotik_ip='127.0.0.1', mikrotik_username='admin',
+                               mikrotik_password=PASSWORD, mikrotik_port=self.port)
+
+    def emit(self, row, dead=False):
+        """Envia uma alteração a quem está em follow/listen"""
+        words = [f'={key}={value}' for key, value in row.items()] + (['=.dead=true'] if dead else [])
+        for writer, tag in self.followers:
+            writer.write(encode_sentence(['!re', *words, f'.tag={tag}']))
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        tasks = {}
+
+        def send(*words):
+            writer.write(encode_sentence(list(words)))
+
+        try:
+            while True:
+                words = await read_sentence(reader)
+                self.sentences.append(words)
+                if self.mute:
+                    continue
+                command, attributes, queries, tag = words[0], {}, {}, None
+                for word in words[1:]:
+                    if word.startswith('.tag='):
+                        tag = word[5:]
+                    elif word.startswith('='):
+                        key, _, value = word[1:].partition('=')
+                        attributes[key] = value
+                    elif word.startswith('?'):
+                        key, _, value = word[1:].partition('=')
+                        queries[key] = value
+                suffix = f'.tag={tag}'
+
+                if command == '/login':
+                    if self.legacy and 'response' not in attributes:
+                        send('!done', '=ret=' + binascii.hexlify(CHALLENGE).decode(), suffix)
+                        continue
+                    if self.legacy:
+                        digest = hashlib.md5(b'\x00' + PASSWORD.encode() + CHALLENGE).hexdigest()
+                        accepted = attributes['response'] == '00' + digest
+                    else:
+                        accepted = attributes.get('password') == PASSWORD
+                    if not accepted:
+                        send('!trap', '=message=invalid user name or password (6)', suffix)
+                    send('!done', suffix)
+                elif command == '/cancel':
+                    task = tasks.pop(attributes['tag'], None)
+                    if task:
+                        task.cancel()
+                    send('!trap', '=category=2', '=message=interrupted', f".tag={attributes['tag']}")
+                    send('!done', f".tag={attributes['tag']}")
+                    send('!done', suffix)
+                elif command.endswith('/print') and command[:-6] in self.menus:
+                    tasks[tag] = asyncio.create_task(self.reply(writer, command[:-6], attributes, queries, tag))
+                elif command.endswith('/listen') and command[:-7] in self.menus:
+                    self.followers.append((writer, tag))
+                else:
+                    send('!trap', '=message=no such command', suffix)
+                    send('!done', suffix)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for task in tasks.values():
+                task.cancel()
+            writer.close()
+
+    async def reply(self, writer, path, attributes, queries, tag):
+        await asyncio.sleep(self.delays.get(path, 0))
+        fields = attributes['.proplist'].split(',') if '.proplist' in attributes else None
+        for row in self.menus[path]:
+            if any(row.get(key) != value for key, value in queries.items()):
+                continue
+            words = [f'={key}={value}' for key, value in row.items() if fields is None or key in fields]
+            writer.write(encode_sentence(['!re', *words, f'.tag={tag}']))
+
+        if 'follow' in attributes:
+            self.followers.append((writer, tag))
+            return
+        writer.write(encode_sentence(['!done', f'.tag={tag}']))
+
+MENUS = {
+    '/ip/hotspot/active': [
+        {'.id': '*1', 'user': 'ana', 'bytes-in': '100', 'bytes-out': '10'},
+        {'.id': '*2', 'user': 'joao', 'bytes-in': '200', 'bytes-out': '20'},
+    ],
+    '/ip/hotspot/user': [
+        {'.id': '*A', 'name': 'ana', 'profile': 'default'},
+        {'.id': '*B', 'name': 'joao', 'profile': 'bloqueado'},
+    ],
+}
+
+def run(scenario, **router_options):
+    """Executa `scenario(router)` num event loop com um FakeRouter ativo"""
+    async def main():
+        router = await FakeRouter(MENUS, **router_options).start()
+        try:
+            return await scenario(router)
+        finally:
+            await router.stop()
+    return asyncio.run(main())
+
+@pytest.mark.parametrize('length', [0, 0x7F, 0x80, 0x3FFF, 0x4000, 0x1FFFFF, 0x200000, 0xFFFFFFF, 0x10000000])
+def test_length_prefix_round_trip(length):
+    async def decode():
+        reader = asyncio.StreamReader()
+        reader.feed_data(encode_length(length))
+        return await read_length(reader)
+
+    assert asyncio.run(decode()) == length
+
+def test_plaintext_login():
+    async def scenario(router):
+        async with router.client():
+            pass
+        return router.sentences[0]
+
+    login = run(scenario)
+    assert login[:3] == ['/login', '=name=admin', f'=password={PASSWORD}']
+
+def test_md5_challenge_login():
+    async def scenario(router):
+        async with router.client() as client:
+            rows = await client.get('/ip/hotspot/user')
+        return router.sentences, rows
+
+    sentences, rows = run(scenario, legacy=True)
+    digest = hashlib.md5(b'\x00' + PASSWORD.encode() + CHALLENGE).hexdigest()
+    assert sentences[1][:3] == ['/login', '=name=admin', f'=response=00{digest}']
+    assert len(rows) == 2
+
+def test_wrong_password_raises_trap():
+    async def scenario(router):
+        with pytest.raises(RouterOsTrapError, match='invalid user name'):
+            await router.client(password='errada').connect()
+
+    run(scenario)
+
+def test_concurrent_commands_are_matched_by_tag():
+    async def scenario(router):
+        async with router.client() as client:
+            return await asyncio.gather(
+                client.get('/ip/hotspot/active'),
+                client.get('/ip/hotspot/user', name='joao'),
+                client.get('/ip/hotspot/user', name='ana')
+            )
+
+    # O primeiro comando responde por último
+    active, joao, ana = run(scenario, delays={'/ip/hotspot/active': 0.2})
+    assert [row['user'] for row in active] == ['ana', 'joao']
+    assert joao == [{'id': '*B', 'name': 'joao', 'profile': 'bloqueado'}]
+    assert ana == [{'id': '*A', 'name': 'ana', 'profile': 'default'}]
+
+def test_proplist_and_query_words():
+    async def scenario(router):
+        async with router.client() as client:
+            rows = await client.get('/ip/hotspot/user', ('.id', 'profile'), name='ana')
+        return router.sentences[-1], rows
+
+    sentence, rows = run(scenario)
+    assert sentence[:3] == ['/ip/hotspot/user/print', '=.proplist=.id,profile', '?name=ana']
+    assert sentence[3].startswith('.tag=')
+    assert rows == [{'id': '*A', 'profile': 'default'}]
+
+def test_trap_raises_and_connection_stays_usable():
+    async def scenario(router):
+        async with router.client() as client:
+            with pytest.raises(RouterOsTrapError, match='no such command'):
+                await client.get('/nao/existe')
+            assert client.connected
+            return await client.get('/ip/hotspot/user')
+
+    assert len(run(scenario)) == 2
+
+def test_follow_yields_updates_and_removed_rows():
+    async def scenario(router):
+        async with router.client() as client:
+            async with contextlib.aclosing(client.follow('/ip/hotspot/active', ('.id', 'bytes-in'))) as events:
+                received = [await anext(events), await anext(events)]
+                router.emit({'.id': '*1', 'bytes-in': '150'})
+                router.emit({'.id': '*2'}, dead=True)
+                received += [await anext(events), await anext(events)]
+        return received
+
+    assert run(scenario) == [
+        ('update', {'id': '*1', 'bytes-in': '100'}),
+        ('update', {'id': '*2', 'bytes-in': '200'}),
+        ('update', {'id': '*1', 'bytes-in': '150'}),
+        ('removed', {'id': '*2'}),
+    ]
+
+def test_closing_a_stream_sends_cancel():
+    async def scenario(router):
+        async with router.client() as client:
+            async with contextlib.aclosing(client.follow('/ip/hotspot/active')) as events:
+                await anext(events)
+            follow_tag = router.sentences[-1][-1][5:]
+
+            # A conexão continua atendendo outros comandos depois do /cancel
+            rows = await client.get('/ip/hotspot/user')
+            cancels = [sentence for sentence in router.sentences if sentence[0] == '/cancel']
+        return follow_tag, cancels, rows
+
+    follow_tag, cancels, rows = run(scenario)
+    assert cancels == [['/cancel', f'=tag={follow_tag}']]
+    assert len(rows) == 2
+
+def test_sessions_open_one_connection_per_company():
+    async def scenario(router):
+        sessions = AsyncRouterSessions()
+        target = router.target()
+        clients = await asyncio.gather(*(sessions.client(target) for _ in range(5)))
+
+        # Um !trap não descarta a conexão compartilhada
+        with pytest.raises(RouterOsTrapError):
+            await sessions._fetch(target, '/nao/existe', None)
+        assert sessions.clients[1][1] is clients[0]
+
+        await sessions._close_all()
+        return clients, router.connections
+
+    clients, connections = run(scenario)
+    assert connections == 1
+    assert all(client is clients[0] for client in clients)
+
+def test_idle_follow_pings_and_keeps_a_live_connection():
+    async def scenario(router):
+        async with router.client() as client:
+            async with contextlib.aclosing(client.follow('/ip/hotspot/active', idle_timeout=0.1)) as events:
+                await anext(events)
+                await anext(events)
+                # Nenhum evento por vários intervalos: o roteador responde aos pings
+                next_event = asyncio.ensure_future(anext(events))
+                await asyncio.sleep(0.35)
+                router.emit({'.id': '*1', 'bytes-in': '500'})
+                event = await next_event
+        pings = [sentence for sentence in router.sentences if sentence[0] == '/system/identity/print']
+        return event, pings
+
+    event, pings = run(scenario)
+    assert event == ('update', {'id': '*1', 'bytes-in': '500'})
+    assert len(pings) >= 2
+
+def test_idle_follow_fails_when_router_stops_answering():
+    async def scenario(router):
+        async with router.client(timeout=0.2) as client:
+            async with contextlib.aclosing(client.follow('/ip/hotspot/active', idle_timeout=0.1)) as events:
+                await anext(events)
+                await anext(events)
+                router.mute = True
+                with pytest.raises(RouterOsFatalError, match='ping'):
+                    await anext(events)
+            return client.connected
+
+    assert run(scenario) is False
+
+def shorter_timeout(init):
+    """Prazo curto para os clientes abertos pelas sessões"""
+    def wrapper(self, *args, **kwargs):
+        init(self, *args, **kwargs)
+        self.timeout = 0.2
+    return wrapper
+
+def test_stream_falls_back_to_polling_on_half_open_connection(monkeypatch):
+    async def scenario(router):
+        sessions = AsyncRouterSessions()
+        monkeypatch.setattr(usage_collector, 'router_sessions', sessions)
+        monkeypatch.setattr(AsyncRouterOsClient, '__init__', shorter_timeout(AsyncRouterOsClient.__init__))
+
+        stream = UsageStream(idle_timeout=0.1)
+        task = asyncio.create_task(stream._subscribe(router.target()))
+        for _ in range(50):
+            if stream.streaming_companies():
+                break
+            await asyncio.sleep(0.02)
+        assert stream.streaming_companies() == {1}
+
+        router.mute = True
+        await asyncio.sleep(0.5)
+        streaming = stream.streaming_companies()
+
+        task.cancel()
+        await sessions._close_all()
+        return streaming
+
+    assert run(scenario) == set()
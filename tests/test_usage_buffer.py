@@ -0,0 +1,145 @@
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+from models import db, Company, Usage, DailyConsumption
+from services.usage_buffer import UsageWriteBuffer
+
+MB = 1024 * 1024
+
+@pytest.fixture
+def company(app):
+    company = Company(name='Empresa', mikrotik_ip='10.0.0.1', mikrotik_username='admin',
+                      mikrotik_password='secret', is_active=True)
+    db.session.add(company)
+    db.session.commit()
+    return company
+
+@pytest.fixture
+def make_buffer(app):
+    buffers = []
+
+    def make(**kwargs):
+        kwargs.setdefault('batch_size', 100)
+        kwargs.setdefault('flush_interval', 60)
+        kwargs.setdefault('max_size', 1000)
+        kwargs.setdefault('put_timeout', 1)
+        buffer = UsageWriteBuffer(**kwargs)
+        buffers.append(buffer)
+        return buffer
+
+    yield make
+    for buffer in buffers:
+        buffer.stop()
+
+def usage_row(company, username='ana', bytes_in=MB):
+    return {
+        'username': username, 'company_id': company.id, 'bytes_in': bytes_in, 'bytes_out': 0,
+        'session_time': 60, 'session_id': None, 'timestamp': datetime(2026, 3, 10, 12, 0)
+    }
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+def test_full_batch_is_written_by_the_caller(company, make_buffer):
+    buffer = make_buffer(batch_size=3)
+
+    for _ in range(2):
+        assert buffer.record(usage_row(company))
+    assert Usage.query.count() == 0
+
+    assert buffer.record(usage_row(company))
+    assert Usage.query.count() == 3
+    rollup = DailyConsumption.query.one()
+    assert rollup.records == 3
+    assert rollup.bytes_in == 3 * MB
+
+def test_flush_does_not_commit_the_callers_session(company, make_buffer):
+    buffer = make_buffer(batch_size=1)
+    row = usage_row(company)
+
+    db.session.add(Company(name='Pendente', mikrotik_ip='10.0.0.2', mikrotik_username='admin',
+                           mikrotik_password='secret'))
+    assert buffer.record(row)
+    db.session.rollback()
+
+    assert Usage.query.count() == 1
+    assert Company.query.filter_by(name='Pendente').count() == 0
+
+def test_thread_writes_old_rows_without_a_full_batch(app, company, make_buffer):
+    buffer = make_buffer(flush_interval=0.2)
+    buffer.start(app)
+
+    assert buffer.record(usage_row(company))
+    assert wait_until(lambda: buffer.get_stats()['written'] == 1, timeout=2)
+    assert Usage.query.count() == 1
+
+def test_full_queue_waits_for_space_and_then_rejects(app, company, make_buffer):
+    buffer = make_buffer(max_size=2, put_timeout=0.1)
+    buffer.start(app)
+    for _ in range(2):
+        assert buffer.record(usage_row(company))
+
+    # Ninguém libera espaço dentro do prazo
+    assert not buffer.record(usage_row(company))
+    stats = buffer.get_stats()
+    assert stats['backpressure_waits'] == 1
+    assert stats['rejected'] == 1
+
+    # Um flush durante a espera libera a fila
+    buffer.put_timeout = 5
+
+    def flush_later():
+        time.sleep(0.1)
+        with app.app_context():
+            buffer.flush()
+
+    flusher = threading.Thread(target=flush_later)
+    flusher.start()
+    assert buffer.record(usage_row(company))
+    flusher.join()
+    assert Usage.query.count() == 2
+    assert buffer.get_stats()['queue_depth'] == 1
+
+def test_remaining_rows_are_written_on_shutdown(app, company, make_buffer):
+    running = make_buffer()
+    running.start(app)
+    assert running.record(usage_row(company, 'ana'))
+    running.stop()
+    assert not running.get_stats()['running']
+
+    # Sem a thread, a aplicação do primeiro record() grava a fila ao sair
+    idle = make_buffer()
+    assert idle.record(usage_row(company, 'bia'))
+    idle._flush_at_exit()
+
+    assert sorted(u.username for u in Usage.query.all()) == ['ana', 'bia']
+
+def test_stats_report_depth_age_and_latency(company, make_buffer):
+    buffer = make_buffer(batch_size=3)
+
+    buffer.record(usage_row(company))
+    time.sleep(0.05)
+    stats = buffer.get_stats()
+    assert stats['queue_depth'] == 1
+    assert stats['oldest_age'] > 0
+    assert stats['avg_flush_latency'] == 0.0
+
+    buffer.record(usage_row(company))
+    buffer.record(usage_row(company))
+    stats = buffer.get_stats()
+    assert stats['queue_depth'] == 0
+    assert stats['oldest_age'] == 0.0
+    assert stats['max_depth'] == 3
+    assert stats['flushes'] == 1
+    assert stats['written'] == 3
+    assert stats['last_flush_rows'] == 3
+    assert stats['avg_flush_latency'] > 0
+    assert 'total_flush_latency' not in stats
@@ -97,14 +97,15 @@ def initialize_default_data():
 def get_selected_company():
     """Obtém a empresa selecionada da sessão"""
     try:
-        from models import Company
+        from services.reference_cache import reference_cache
         
         company_id = session.get('selected_company_id')
         if company_id:
-            return Company.query.get(company_id)
+            return reference_cache.get_company(company_id)
         
         # Se não há empresa selecionada, retornar a primeira disponível
-        return Company.query.first()
+        companies = reference_cache.get_companies()
+        return companies[0] if companies else None
     except Exception as e:
         logger.error(f"Erro ao obter empresa selecionada: {e}")
         return None
@@ -118,6 +119,54 @@ def set_selected_company(company_id):
         logger.error(f"Erro ao definir empresa selecionada: {e}")
         return False
 
+class ListPagination:
+    """Paginação de uma lista em memória com a mesma interface do paginate() do Flask-SQLAlchemy"""
+    
+    def __init__(self, items, page, per_page, total):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+    
+    @property
+    def pages(self):
+        return max(1, -(-self.total // self.per_page))
+    
+    @property
+    def has_prev(self):
+        return self.page > 1
+    
+    @property
+    def has_next(self):
+        return self.page < self.pages
+    
+    @property
+    def prev_num(self):
+        return self.page - 1 if self.has_prev else None
+    
+    @property
+    def next_num(self):
+        return self.page + 1 if self.has_next else None
+    
+    def iter_pages(self, left_edge=2, left_current=2, right_current=4, right_edge=2):
+        last = 0
+        for num in range(1, self.pages + 1):
+            if (num <= left_edge or
+                    self.page - left_current <= num <= self.page + right_current or
+                    num > self.pages - right_edge):
+                if last + 1 != num:
+                    yield None
+                yield num
+                last = num
+
+def paginate_list(items, page=1, per_page=50):
+    """Recorta uma página de `items` (página fora do intervalo vai para a última)"""
+    total = len(items)
+    pages = max(1, -(-total // per_page))
+    page = min(max(1, page), pages)
+    start = (page - 1) * per_page
+    return ListPagination(items[start:start + per_page], page, per_page, total)
+
 def format_bytes(bytes_value):
     """Formata bytes em formato legível"""
     try: